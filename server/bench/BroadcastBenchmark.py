@@ -0,0 +1,93 @@
+#
+# CPU and buffers for one message sent to many recipients.
+#
+# Sends a chat line to every recipient the way User.handleCommand's "say"
+# did (a string built per recipient), as a Chat packet encoded separately
+# for each recipient, and as one Chat packet encoded once and handed to all
+# of them with Broadcast.send().  Recipients queue output like Connection
+# and then flush it to a socket which only keeps what it is given.  Buffers
+# counts the distinct strings that reached the sockets, and bytes their
+# total size, i.e. what had to be allocated for the broadcast.
+#
+# Usage: BroadcastBenchmark.py [-r recipients] [-n broadcasts]
+#
+
+import sys, os, time, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import Packets
+import Broadcast
+
+TEXT = "Is anyone heading to the north gate? Could use a hand with the wolves."
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+class FakeConnection(object):
+    """ Queues and flushes output as Connection does, less compression. """
+
+    def __init__(self):
+        self.clientsocket = FakeSocket()
+        self.outbound = []
+
+    def write(self, data):
+        self.outbound.append(data)
+
+    def writeLine(self, line):
+        self.write(line + "\r\n")
+
+    def flush(self):
+        if len(self.outbound) == 1:
+            data = self.outbound[0]
+        else:
+            data = ''.join(self.outbound)
+        self.outbound = []
+        self.clientsocket.send(data)
+
+def Legacy(speaker, recipients):
+    for recipient in recipients:
+        if recipient is speaker:
+            prefix = "You say: "
+        else:
+            prefix = "Someone says: "
+        recipient.writeLine(prefix + "\"%s\"" % TEXT)
+
+def PerRecipient(speaker, recipients):
+    chat = Packets.BY_NAME["Chat"]
+    for recipient in recipients:
+        recipient.write(chat.encode(1, TEXT))
+
+def EncodeOnce(speaker, recipients):
+    Broadcast.send(Packets.BY_NAME["Chat"].encode(1, TEXT), recipients)
+
+def Measure(name, method, count, broadcasts):
+    recipients = [ FakeConnection() for i in xrange(count) ]
+    speaker = recipients[0]
+    elapsed = 0.0
+    for i in xrange(broadcasts):
+        started = time.clock()
+        method(speaker, recipients)
+        for recipient in recipients:
+            recipient.flush()
+        elapsed += time.clock() - started
+
+    buffers = {}
+    for recipient in recipients:
+        for data in recipient.clientsocket.sent:
+            buffers[id(data)] = len(data)
+    print "%-13s %8.3f ms/broadcast  %6d buffers  %8d bytes per broadcast" % (
+        name, elapsed * 1000 / broadcasts, len(buffers) // broadcasts, sum(buffers.values()) // broadcasts)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-r", dest="recipients", type="int", default=5000)
+    parser.add_option("-n", dest="broadcasts", type="int", default=50)
+    options, args = parser.parse_args()
+    Measure("legacy say", Legacy, options.recipients, options.broadcasts)
+    Measure("per recipient", PerRecipient, options.recipients, options.broadcasts)
+    Measure("encode once", EncodeOnce, options.recipients, options.broadcasts)
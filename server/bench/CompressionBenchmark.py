@@ -0,0 +1,111 @@
+#
+# Bytes and CPU per packet of connection compression.
+#
+# Records what one connection is sent: a client standing in a crowd of NPCs
+# (Crowd) is sent its snapshot every tick by a Snapshot.Replicator, and
+# acknowledges each one a few ticks later, with the occasional chat line
+# in between.  Each tick's output is one write, the way Connection.flush
+# sends it.  The same traffic is sent uncompressed and through Compression's
+# stream compressor.  The first ticks, when the client is sent everything
+# near it afresh, are shown apart.
+#
+# Usage: CompressionBenchmark.py [-t ticks] [-n NPCs] [-s crowd size]
+#
+
+import sys, os, time, random, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import Packets
+import Compression
+import EntityStore
+import SpatialGrid
+import Snapshot
+import Crowd
+
+# Ticks between a snapshot and its ack arriving
+ACK_DELAY = 3
+
+class Recorder(object):
+    def __init__(self):
+        self.baseline = Snapshot.ClientBaseline()
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+class Client(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.entityId = None
+
+class Clients(object):
+    def __init__(self, client):
+        self.client = client
+
+    def characters(self):
+        return [ self.client ]
+
+def Traffic(ticks, npcs, size):
+    random.seed(1)
+    entities = EntityStore.EntityStore()
+    grid = SpatialGrid.SpatialGrid(entities)
+    crowd = Crowd.Crowd(entities, seed=1, bounds=(-size, -size, size, size))
+    crowd.spawn(npcs)
+    connection = Recorder()
+    client = Client(connection)
+    client.entityId = entities.allocate(0.0, 0.0, EntityStore.PLAYER, client)
+    replicator = Snapshot.Replicator(Clients(client), entities, grid)
+    chat = Packets.BY_NAME["Chat"]
+
+    batches = []
+    counts = []
+    sent = []
+    for tick in xrange(ticks):
+        crowd.tick(0.05)
+        entities.integrate(0.05)
+        grid.sync()
+        replicator.tick()
+        sent.append(replicator.history.sequence)
+        if len(sent) > ACK_DELAY:
+            connection.baseline.acknowledge(sent[-ACK_DELAY - 1])
+        if random.random() < 0.2:
+            connection.write(chat.encode(random.randrange(1, npcs), random.choice([ "hello", "anyone here?", "lol", "brb" ])))
+        counts.append(len(connection.written))
+        batches.append(''.join(connection.written))
+        connection.written = []
+    return batches, counts
+
+# Ticks counted as the start of the connection.
+EARLY_TICKS = 10
+
+def Report(name, sizes, counts, extra=""):
+    print "%-12s %7.2f bytes/packet (%7.2f early)%s" % (name, float(sum(sizes)) / sum(counts),
+        float(sum(sizes[:EARLY_TICKS])) / sum(counts[:EARLY_TICKS]), extra)
+
+def Measure(name, batches, counts, compressor, decompressor):
+    packets = sum(counts)
+    started = time.clock()
+    compressed = [ compressor.compress(batch) for batch in batches ]
+    compressTime = time.clock() - started
+
+    started = time.clock()
+    for data, batch in zip(compressed, batches):
+        if decompressor.decompress(data) != batch:
+            raise AssertionError("round trip failed")
+    decompressTime = time.clock() - started
+
+    Report(name, map(len, compressed), counts, "  compress %6.3f us/packet  decompress %6.3f us/packet" % (
+        compressTime * 1000000 / packets, decompressTime * 1000000 / packets))
+
+def Run(ticks, npcs, size):
+    batches, counts = Traffic(ticks, npcs, size)
+    Report("raw", map(len, batches), counts)
+    Measure("zlib", batches, counts, Compression.StreamCompressor(), Compression.StreamDecompressor())
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-t", dest="ticks", type="int", default=2000)
+    parser.add_option("-n", dest="npcs", type="int", default=2000)
+    parser.add_option("-s", dest="size", type="float", default=500.0)
+    options, args = parser.parse_args()
+    Run(options.ticks, options.npcs, options.size)
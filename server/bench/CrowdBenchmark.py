@@ -0,0 +1,84 @@
+#
+# Tick time of wandering NPCs, per object against the Crowd.
+#
+# Steps the given number of NPCs wandering as the client's Agent does,
+# first as Python objects each deciding and moving on its own, then as a
+# Crowd system followed by EntityStore.integrate() and the spatial grid
+# sync, i.e. all the world tick does for them short of replication.  The
+# world tick has 1000 / rate ms to fit into.
+#
+# Usage: CrowdBenchmark.py [-n npcs] [-t ticks] [-r tick rate]
+#                          [--terrain terrain.bin]
+#
+
+import sys, os, time, math, random, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import EntityStore
+import SpatialGrid
+import Crowd
+
+BOUNDS = (-4096.0, -4096.0, 4096.0, 4096.0)
+
+class Agent(object):
+    __slots__ = ("x", "y", "facing", "turning", "untilTurn")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.facing = random.uniform(-math.pi, math.pi)
+        self.turning = 0.0
+        self.untilTurn = random.uniform(0.0, Crowd.TURN_INTERVAL)
+
+    def move(self, interval):
+        self.untilTurn -= interval
+        if self.untilTurn <= 0.0:
+            self.turning = random.randint(-1, 1) * Crowd.TURN_RATE
+            self.untilTurn += Crowd.TURN_INTERVAL
+        self.facing += self.turning * interval
+        minX, minY, maxX, maxY = BOUNDS
+        x = self.x + math.cos(self.facing) * Crowd.SPEED * interval
+        y = self.y + math.sin(self.facing) * Crowd.SPEED * interval
+        if minX <= x <= maxX and minY <= y <= maxY:
+            self.x = x
+            self.y = y
+        else:
+            self.facing += math.pi
+
+def Objects(count, ticks, interval):
+    random.seed(1)
+    agents = [ Agent(random.uniform(-4000, 4000), random.uniform(-4000, 4000)) for i in xrange(count) ]
+    started = time.time()
+    for tick in xrange(ticks):
+        for agent in agents:
+            agent.move(interval)
+    return (time.time() - started) / ticks
+
+def Vectorized(count, ticks, interval, terrain):
+    entities = EntityStore.EntityStore(count + 1, BOUNDS)
+    grid = SpatialGrid.SpatialGrid(entities)
+    crowd = Crowd.Crowd(entities, terrain, count, seed=1)
+    crowd.spawn(count)
+    grid.sync()
+    started = time.time()
+    for tick in xrange(ticks):
+        entities.integrate(interval)
+        grid.sync()
+        crowd.tick(interval)
+    return (time.time() - started) / ticks
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="npcs", type="int", default=10000)
+    parser.add_option("-t", dest="ticks", type="int", default=100)
+    parser.add_option("-r", dest="rate", type="int", default=20)
+    parser.add_option("--terrain", default=None)
+    options, args = parser.parse_args()
+    terrain = None
+    if options.terrain:
+        import Terrain
+        terrain = Terrain.load(options.terrain)
+    interval = 1.0 / options.rate
+    print "budget:  %8.3f ms/tick" % (interval * 1000)
+    print "objects: %8.3f ms/tick" % (Objects(options.npcs, options.ticks, interval) * 1000)
+    print "crowd:   %8.3f ms/tick" % (Vectorized(options.npcs, options.ticks, interval, terrain) * 1000)
@@ -0,0 +1,108 @@
+#
+# Echo latency and idle CPU of the StacklessSocket managers.
+#
+# An echo server is run under Stackless in a child process using either the
+# stock polling manager (StacklessSocket.StartManager) or the epoll manager
+# (EpollManager).  This process then acts as a plain socket client, timing
+# round trips over a set of connections, and afterwards leaves the
+# connections open and idle while sampling the server's CPU time.
+#
+# Usage: EchoBenchmark.py [poll|epoll ...] [-n round trips] [-c connections]
+#                         [-i idle seconds]
+#
+
+import sys, os, time, subprocess, optparse
+import socket
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+def RunServer(manager, port):
+    sys.path.insert(0, SRC_DIR)
+    import stackless
+    import StacklessSocket
+    StacklessSocket.install()
+    if manager == "epoll":
+        import EpollManager
+        EpollManager.install()
+
+    listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listenSocket.bind(("127.0.0.1", port))
+    listenSocket.listen(128)
+
+    def Echo(clientSocket):
+        while 1:
+            data = clientSocket.recv(4096)
+            if not data:
+                break
+            clientSocket.send(data)
+        clientSocket.close()
+
+    def Accept():
+        while 1:
+            clientSocket, address = listenSocket.accept()
+            stackless.tasklet(Echo)(clientSocket)
+
+    stackless.tasklet(Accept)()
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    stackless.run()
+
+def ProcessCPU(pid):
+    # utime and stime in clock ticks, see proc(5).
+    fields = open("/proc/%d/stat" % pid).read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+def Percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def RunClient(manager, port, options):
+    server = subprocess.Popen([ sys.executable, __file__, "--server", manager, str(port) ], stdout=subprocess.PIPE)
+    try:
+        server.stdout.readline()
+
+        sockets = []
+        for i in range(options.connections):
+            s = socket.create_connection(("127.0.0.1", port))
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sockets.append(s)
+
+        payload = "x" * 64
+        latencies = []
+        for i in xrange(options.count):
+            s = sockets[i % len(sockets)]
+            started = time.time()
+            s.sendall(payload)
+            received = 0
+            while received < len(payload):
+                received += len(s.recv(4096))
+            latencies.append(time.time() - started)
+        latencies.sort()
+
+        cpuStarted = ProcessCPU(server.pid)
+        time.sleep(options.idle)
+        idleCPU = (ProcessCPU(server.pid) - cpuStarted) / options.idle
+
+        print "%-6s p50 %8.3f ms  p99 %8.3f ms  idle cpu %5.1f%%" % (
+            manager, Percentile(latencies, 0.5) * 1000, Percentile(latencies, 0.99) * 1000, idleCPU * 100)
+
+        for s in sockets:
+            s.close()
+    finally:
+        server.kill()
+        server.wait()
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--server":
+        RunServer(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+
+    parser = optparse.OptionParser(usage="%prog [poll|epoll ...]")
+    parser.add_option("-n", dest="count", type="int", default=5000)
+    parser.add_option("-c", dest="connections", type="int", default=100)
+    parser.add_option("-i", dest="idle", type="float", default=5.0)
+    parser.add_option("-p", dest="port", type="int", default=7600)
+    options, managers = parser.parse_args()
+
+    for i, manager in enumerate(managers or [ "poll", "epoll" ]):
+        RunClient(manager, options.port + i, options)
@@ -0,0 +1,63 @@
+#
+# Tick time of moving entities, per object against the EntityStore.
+#
+# Moves the given number of entities along their velocities for a number
+# of ticks, clamping them to the world bounds and keeping their headings up
+# to date, first as Python objects visited one by one and then with
+# EntityStore.integrate() working on whole arrays.
+#
+# Usage: EntityStoreBenchmark.py [-n entities] [-t ticks]
+#
+
+import sys, os, time, math, random, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import EntityStore
+
+DT = 0.05
+
+class Entity(object):
+    __slots__ = ("x", "y", "vx", "vy", "heading")
+
+    def __init__(self, x, y, vx, vy):
+        self.x = x
+        self.y = y
+        self.vx = vx
+        self.vy = vy
+        self.heading = 0.0
+
+def Motion(count):
+    random.seed(1)
+    return [ (random.uniform(-4000, 4000), random.uniform(-4000, 4000),
+              random.uniform(-10, 10), random.uniform(-10, 10)) for i in xrange(count) ]
+
+def Objects(motion, ticks, bounds):
+    entities = [ Entity(*m) for m in motion ]
+    minX, minY, maxX, maxY = bounds
+    started = time.time()
+    for tick in xrange(ticks):
+        for entity in entities:
+            entity.x = min(max(entity.x + entity.vx * DT, minX), maxX)
+            entity.y = min(max(entity.y + entity.vy * DT, minY), maxY)
+            if entity.vx or entity.vy:
+                entity.heading = math.atan2(entity.vy, entity.vx)
+    return (time.time() - started) / ticks
+
+def Store(motion, ticks, bounds):
+    store = EntityStore.EntityStore(len(motion) + 1, bounds)
+    for x, y, vx, vy in motion:
+        store.setVelocity(store.allocate(x, y), vx, vy)
+    started = time.time()
+    for tick in xrange(ticks):
+        store.integrate(DT)
+    return (time.time() - started) / ticks
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="entities", type="int", default=50000)
+    parser.add_option("-t", dest="ticks", type="int", default=100)
+    options, args = parser.parse_args()
+    motion = Motion(options.entities)
+    bounds = (-4096.0, -4096.0, 4096.0, 4096.0)
+    print "objects: %8.3f ms/tick" % (Objects(motion, options.ticks, bounds) * 1000)
+    print "store:   %8.3f ms/tick" % (Store(motion, options.ticks, bounds) * 1000)
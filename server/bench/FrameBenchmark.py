@@ -0,0 +1,82 @@
+#
+# Throughput of Framing.FrameDecoder and of Packets decoding and dispatch.
+#
+# A stream of movement frames is encoded up front, then fed to the decoder
+# in recv() sized chunks, so that frames regularly straddle chunk edges the
+# way they do on a real connection.
+#
+# The decoded payloads are then dispatched to handlers, once through the
+# Packets table and once through an if/elif chain calling struct.unpack
+# with a format string, as Connection used to.
+#
+# Usage: FrameBenchmark.py [-n frames] [-s chunk size]
+#
+
+import sys, os, time, struct, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import Framing
+import Messages
+import Packets
+
+def Run(count, chunkSize):
+    frame = Framing.encodeFrame(Messages.PACKET_CHAR_MOVE, struct.pack("!ii", 100, -200))
+    stream = frame * count
+    chunks = [ stream[i:i + chunkSize] for i in xrange(0, len(stream), chunkSize) ]
+
+    decoder = Framing.FrameDecoder()
+    decoded = 0
+    started = time.time()
+    for chunk in chunks:
+        decoded += len(decoder.feed(chunk))
+    elapsed = time.time() - started
+
+    if decoded != count:
+        raise AssertionError("decoded %d of %d frames" % (decoded, count))
+    Report("decode", count, elapsed)
+
+    frames = []
+    for chunk in chunks:
+        frames.extend(decoder.feed(chunk))
+    RunDispatch(frames)
+
+class Handler:
+    def packetLogin(self, username, password):
+        pass
+
+    def packetRegister(self, username, password, email):
+        pass
+
+    def packetCharMove(self, x, y):
+        pass
+
+def RunDispatch(frames):
+    handler = Handler()
+
+    started = time.time()
+    for message, payload in frames:
+        if message == Messages.PACKET_LOGIN:
+            handler.packetLogin(*struct.unpack("!32p32p", payload))
+        elif message == Messages.PACKET_REGISTER:
+            handler.packetRegister(*struct.unpack("!32p32p64p", payload))
+        elif message == Messages.PACKET_CHAR_MOVE:
+            handler.packetCharMove(*struct.unpack("!ii", payload))
+    Report("if/elif dispatch", len(frames), time.time() - started)
+
+    handlers = Packets.dispatchTable(handler)
+    decoders = Packets.DECODERS
+    started = time.time()
+    for message, payload in frames:
+        handlers[message](*decoders[message](payload))
+    Report("table dispatch", len(frames), time.time() - started)
+
+def Report(name, count, elapsed):
+    print "%-16s %d frames in %.3f s: %.0f frames/s, %.3f us/frame" % (
+        name, count, elapsed, count / elapsed, elapsed * 1000000 / count)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="count", type="int", default=1000000)
+    parser.add_option("-s", dest="chunkSize", type="int", default=4096)
+    options, args = parser.parse_args()
+    Run(options.count, options.chunkSize)
@@ -0,0 +1,71 @@
+#
+# Movement over the UDP channel through a lossy, jittery loopback link.
+#
+# A MovementSender sends a stream of moves to a MovementChannel on loopback
+# through a LossyLink, which drops some datagrams and delays the rest by a
+# random amount so that they arrive out of order.  Counts how many moves
+# were dropped by the link, discarded as stale by the channel and delivered,
+# and checks that the character ends up at the last position sent whenever
+# that datagram made it through.
+#
+# Usage: MovementLossTest.py [-n moves] [-r moves per second] [-l loss]
+#                            [-d latency] [-j jitter]
+#
+
+import sys, os, random, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import stackless
+import StacklessSocket
+StacklessSocket.install()
+import socket
+import EpollManager
+import Timers
+import MovementChannel
+
+class FakeConnection(object):
+    def __init__(self):
+        self.position = None
+        self.moves = 0
+
+    def packetCharMove(self, x, y):
+        self.position = (x, y)
+        self.moves += 1
+
+def Run(moves, rate, loss, latency, jitter):
+    EpollManager.install()
+    channel = MovementChannel.MovementChannel(("127.0.0.1", 0))
+    connection = FakeConnection()
+    token = channel.issueToken(connection)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    link = MovementChannel.LossyLink(sock, loss, latency, jitter, random.Random(1))
+    sender = MovementChannel.MovementSender(link, token, ("127.0.0.1", channel.port))
+
+    def Send():
+        for i in xrange(moves):
+            sender.send(i, -i)
+            Timers.sleep(1.0 / rate)
+        # Let everything still in flight arrive.
+        Timers.sleep(latency + jitter + 0.5)
+        print "sent      %d" % moves
+        print "dropped   %d" % link.dropped
+        print "stale     %d" % channel.stale
+        print "delivered %d" % channel.delivered
+        print "rejected  %d" % channel.rejected
+        print "final position %r (last sent %r)" % (connection.position, (moves - 1, 1 - moves))
+        sock.close()
+        channel.socket.close()
+
+    stackless.tasklet(Send)()
+    stackless.run()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="moves", type="int", default=2000)
+    parser.add_option("-r", dest="rate", type="float", default=200.0)
+    parser.add_option("-l", dest="loss", type="float", default=0.1)
+    parser.add_option("-d", dest="latency", type="float", default=0.03)
+    parser.add_option("-j", dest="jitter", type="float", default=0.04)
+    options, args = parser.parse_args()
+    Run(options.moves, options.rate, options.loss, options.latency, options.jitter)
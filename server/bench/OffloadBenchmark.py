@@ -0,0 +1,78 @@
+#
+# Password check throughput through Offload against pool size.
+#
+# Runs under Stackless.  A number of tasklets each check passwords through
+# Offload.call(Passwords.checkPassword, ...), the way UserManager does for
+# logins, while a heartbeat tasklet wakes every millisecond to show whether
+# the scheduler thread stays free.  A pool size of 0 runs the checks inline,
+# as happens without a pool installed.
+#
+# Usage: OffloadBenchmark.py [pool sizes ...] [-n checks] [-c concurrent]
+#                            [-i iterations] [-t (thread pools)]
+#
+
+import sys, os, time, select, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import stackless
+import Timers
+import Offload
+import Passwords
+
+def Run(poolSize, checks, concurrent, iterations, processes):
+    if poolSize:
+        Offload.install(poolSize, processes)
+    stored = Passwords.hashPassword("secret", iterations)
+    state = { "remaining": checks, "running": concurrent, "gap": 0.0 }
+
+    def Checker():
+        while state["remaining"] > 0:
+            state["remaining"] -= 1
+            if not Offload.call(Passwords.checkPassword, "secret", stored):
+                raise AssertionError("password check failed")
+        state["running"] -= 1
+
+    def Heartbeat():
+        last = time.time()
+        while state["running"]:
+            Timers.sleep(0.001)
+            now = time.time()
+            state["gap"] = max(state["gap"], now - last)
+            last = now
+
+    def Drive():
+        # What the socket managers do for Timers and Offload.
+        while state["running"]:
+            fd = Offload.wakeupFd()
+            timeout = 0
+            if stackless.getruncount() == 1:
+                timeout = Timers.timeUntilNext(0.05)
+            if fd is not None:
+                select.select([ fd ], [], [], timeout)
+            else:
+                time.sleep(timeout)
+            Timers.wakeExpired()
+            Offload.wakeCompleted()
+            stackless.schedule()
+
+    for i in xrange(concurrent):
+        stackless.tasklet(Checker)()
+    stackless.tasklet(Heartbeat)()
+    stackless.tasklet(Drive)()
+
+    started = time.time()
+    stackless.run()
+    elapsed = time.time() - started
+    Offload.uninstall()
+    print "pool %2d: %7.1f checks/s  longest scheduler stall %6.1f ms" % (
+        poolSize, checks / elapsed, state["gap"] * 1000)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="checks", type="int", default=200)
+    parser.add_option("-c", dest="concurrent", type="int", default=32)
+    parser.add_option("-i", dest="iterations", type="int", default=Passwords.ITERATIONS)
+    parser.add_option("-t", dest="threads", action="store_true", default=False)
+    options, args = parser.parse_args()
+    for poolSize in map(int, args or [ "0", "1", "2", "4" ]):
+        Run(poolSize, options.checks, options.concurrent, options.iterations, not options.threads)
@@ -0,0 +1,84 @@
+#
+# Time to answer a batch of simultaneous path requests.
+#
+# Asks the Pathfinder for paths between random walkable places, all at
+# once as when many NPCs are sent off on the same tick:
+#
+#   scattered   every request to a different goal, A* each time
+#   repeated    the same requests again, answered from the path cache
+#   popular     requests from everywhere to a few goals, by A* alone
+#               and then with flow fields shared by everyone going to
+#               the same goal
+#
+# Uses the given terrain from TerrainBaker, or else an open square with
+# random walls across it.
+#
+# Usage: PathfindingBenchmark.py [-n requests] [-g popular goals]
+#                                [--terrain terrain.bin]
+#
+
+import sys, os, time, random, optparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import Terrain
+import Pathfinding
+
+def Walls(size=1024, walls=200):
+    random.seed(1)
+    flags = numpy.empty((size, size), numpy.uint8)
+    flags.fill(Terrain.WALKABLE)
+    for i in xrange(walls):
+        row, column = random.randrange(size), random.randrange(size)
+        if random.random() < 0.5:
+            flags[row:row + 2, column:column + random.randint(20, 200)] = 0
+        else:
+            flags[row:row + random.randint(20, 200), column:column + 2] = 0
+    heights = numpy.zeros((size, size), numpy.float32)
+    return Terrain.Terrain(heights, flags, (0.0, 0.0), 2.0, 2.0)
+
+def Places(pathfinder, count):
+    cells = numpy.flatnonzero(numpy.array(pathfinder.passable).ravel())
+    chosen = numpy.random.RandomState(1).choice(cells, count)
+    x, y = pathfinder.centres(chosen)
+    return zip(x.tolist(), y.tolist())
+
+def Measure(name, pathfinder, requests):
+    started = time.time()
+    found = 0
+    for (fromX, fromY), (toX, toY) in requests:
+        if pathfinder.findPath(fromX, fromY, toX, toY) is not None:
+            found += 1
+    elapsed = time.time() - started
+    print "%-22s %9.1f ms  %7.3f ms/request  %d of %d found" % (
+        name, elapsed * 1000, elapsed * 1000 / len(requests), found, len(requests))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="requests", type="int", default=1000)
+    parser.add_option("-g", dest="goals", type="int", default=10)
+    parser.add_option("--terrain", default=None)
+    options, args = parser.parse_args()
+    if options.terrain:
+        terrain = Terrain.load(options.terrain)
+    else:
+        terrain = Walls()
+
+    started = time.time()
+    pathfinder = Pathfinding.Pathfinder(terrain, cacheSize=options.requests * 2)
+    print "nav grid %dx%d built in %.1f ms" % (pathfinder.columns - 2, pathfinder.rows - 2, (time.time() - started) * 1000)
+
+    starts = Places(pathfinder, options.requests)
+    ends = Places(pathfinder, options.requests * 2)[options.requests:]
+    scattered = zip(starts, ends)
+    popular = [ (start, ends[i % options.goals]) for i, start in enumerate(starts) ]
+
+    Measure("scattered", pathfinder, scattered)
+    Measure("repeated", pathfinder, scattered)
+
+    Pathfinding.POPULAR = options.requests + 1
+    pathfinder.build()
+    Measure("popular, A* only", pathfinder, popular)
+    Pathfinding.POPULAR = 8
+    pathfinder.build()
+    Measure("popular, flow fields", pathfinder, popular)
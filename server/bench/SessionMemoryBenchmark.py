@@ -0,0 +1,85 @@
+#
+# Memory per logged in user.
+#
+# Logs a crowd of users into a user manager's logged in table and measures
+# how much the process grew, per user, for the current __slots__ based
+# PlayerCharacter in UserManager.LoggedInUsers and for the representation
+# it replaced: a plain instance with a __dict__, in a dict which keeps a
+# None entry for everyone who has logged out.  Each is measured in a child
+# process of its own, from the resident set size.
+#
+# Usage: SessionMemoryBenchmark.py [-n users] [-l users who left]
+#
+
+import sys, os, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import Passwords
+import Character
+import UserManager
+
+class LegacyCharacter:
+    def __init__(self, username, password, email, starter):
+        self.username = username
+        self.password = password
+        self.email = email
+        self.starter = starter
+        self.x = 0
+        self.y = 0
+        self.entityId = None
+        self.connection = None
+
+def Resident():
+    pages = int(open("/proc/self/statm").read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+def Accounts(count, hashed):
+    # Strings of their own, as they would be loaded from the store
+    for i in xrange(count):
+        yield "user%d" % i, hashed[:-6] + "%06d" % i, "user%d@example.com" % i, 0
+
+def Legacy(users, left, hashed):
+    table = {}
+    for i, account in enumerate(Accounts(users + left, hashed)):
+        character = LegacyCharacter(*account)
+        character.entityId = i
+        table[character.username] = character
+    for i in xrange(users, users + left):
+        table["user%d" % i] = None
+    return table
+
+def Current(users, left, hashed):
+    table = UserManager.LoggedInUsers()
+    for i, account in enumerate(Accounts(users + left, hashed)):
+        character = Character.PlayerCharacter(*account)
+        character.entityId = i
+        table.add(character)
+    for i in xrange(users, users + left):
+        table.remove("user%d" % i)
+    return table
+
+def Measure(name, build, users, left):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        hashed = Passwords.hashPassword("password", 1)
+        before = Resident()
+        table = build(users, left, hashed)
+        grown = Resident() - before
+        # Measured with everyone still in it
+        assert len(table) >= users
+        os.write(write, str(grown))
+        os._exit(0)
+    os.close(write)
+    grown = int(os.read(read, 64))
+    os.waitpid(pid, 0)
+    print "%-8s %7.1f MB  %6.1f bytes/user" % (name, grown / 1048576.0, float(grown) / users)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="users", type="int", default=100000)
+    parser.add_option("-l", dest="left", type="int", default=100000)
+    options, args = parser.parse_args()
+    Measure("legacy", Legacy, options.users, options.left)
+    Measure("current", Current, options.users, options.left)
@@ -0,0 +1,108 @@
+#
+# Login rate against the number of user manager shards.
+#
+# Runs under Stackless.  Registers a population of users, then has a crowd
+# of client tasklets log in and out as fast as they can through
+# UserManager.UserShards, the way Connection does: a CONTROL_LOGIN to the
+# user's shard, waiting for MANAGER_LOGGEDIN on a manager channel of their
+# own, then a CONTROL_DISCONNECT.  Password checks go through Offload, on a
+# pool if one is asked for.
+#
+# Usage: ShardBenchmark.py [shard counts ...] [-u users] [-c clients]
+#                          [-n logins] [-p pool size] [-i iterations]
+#
+
+import sys, os, time, select, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import stackless
+import Timers
+import Offload
+import Passwords
+import Messages
+import Snapshot
+import UserStore
+import UserManager
+
+class FakeConnection(object):
+    def __init__(self):
+        self.baseline = Snapshot.ClientBaseline()
+        self.closed = False
+
+    def write(self, data):
+        pass
+
+def Run(shardCount, users, clients, logins, iterations):
+    # Every client needs users of its own.
+    users = max(users, clients)
+    backend = UserStore.SqliteBackend(":memory:")
+    backend.writeBatch([ ("user%d" % i, Passwords.hashPassword("password%d" % i, iterations), "", 0, 0, 0)
+                         for i in xrange(users) ])
+    shards = UserManager.UserShards(shardCount, backend=backend)
+    state = { "remaining": logins, "running": clients }
+
+    def Client(index):
+        manager = stackless.channel()
+        connection = FakeConnection()
+        # Each client sticks to its own users, so nobody is refused for
+        # already being logged in.
+        own = max(1, users // clients)
+        count = 0
+        while state["remaining"] > 0:
+            state["remaining"] -= 1
+            user = index + clients * (count % own)
+            count += 1
+            username = "user%d" % user
+            control = shards.control(username)
+            # Logins past the shard's limit are queued, or turned away
+            while 1:
+                control.send((Messages.CONTROL_LOGIN, (username, "password%d" % user, manager, connection)))
+                message, payload = manager.receive()
+                while message == Messages.MANAGER_QUEUED:
+                    message, payload = manager.receive()
+                if message == Messages.MANAGER_LOGGEDIN:
+                    break
+                Timers.sleep(payload)
+            control.send((Messages.CONTROL_DISCONNECT, username))
+        state["running"] -= 1
+
+    def Drive():
+        # What the socket managers do for Timers and Offload.
+        while state["running"]:
+            fd = Offload.wakeupFd()
+            timeout = 0
+            if stackless.getruncount() == 1:
+                timeout = Timers.timeUntilNext(0.05)
+            if fd is not None:
+                select.select([ fd ], [], [], timeout)
+            else:
+                time.sleep(timeout)
+            Timers.wakeExpired()
+            Offload.wakeCompleted()
+            stackless.schedule()
+
+    for i in xrange(clients):
+        stackless.tasklet(Client)(i)
+    stackless.tasklet(Drive)()
+
+    started = time.time()
+    while state["running"]:
+        stackless.schedule()
+    elapsed = time.time() - started
+    print "%2d shards: %8.1f logins/s" % (shardCount, logins / elapsed)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-u", dest="users", type="int", default=10000)
+    parser.add_option("-c", dest="clients", type="int", default=200)
+    parser.add_option("-n", dest="logins", type="int", default=5000)
+    parser.add_option("-p", dest="pool", type="int", default=0)
+    parser.add_option("-i", dest="iterations", type="int", default=1000)
+    options, args = parser.parse_args()
+    # Stored hashes are only good while they use the current iteration count.
+    Passwords.ITERATIONS = options.iterations
+    if options.pool:
+        Offload.install(options.pool)
+    for shardCount in map(int, args or [ "1", "2", "4", "8" ]):
+        Run(shardCount, options.users, options.clients, options.logins, options.iterations)
+    Offload.uninstall()
@@ -0,0 +1,71 @@
+#
+# Login lookup latency against a large registered user population.
+#
+# Fills a user store with the given number of accounts (or reuses one left
+# by an earlier run), then times opening it, as the server does on start up,
+# and the store side of a login: UserStore.get() and the password check.
+# Logins are timed for users not yet in the in-memory cache (cold), for a
+# small set of users logging in again (hot), and for unknown usernames.
+#
+# Usage: UserStoreBenchmark.py [sqlite|log ...] [-n accounts] [-l logins]
+#                              [-d directory]
+#
+
+import sys, os, time, random, tempfile, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import UserStore
+
+BATCH = 10000
+
+def Populate(kind, path, accounts):
+    if os.path.exists(path):
+        return
+    print "%s: creating %d accounts" % (kind, accounts)
+    started = time.time()
+    backend = UserStore.BACKENDS[kind](path)
+    for first in xrange(0, accounts, BATCH):
+        backend.writeBatch([ ("user%d" % i, "password%d" % i, "user%d@example.com" % i, 0, 0.0, 0.0)
+                             for i in xrange(first, min(first + BATCH, accounts)) ])
+    backend.close()
+    print "%s: created in %.1fs" % (kind, time.time() - started)
+
+def Percentiles(samples):
+    samples.sort()
+    return samples[len(samples) // 2] * 1000000, samples[len(samples) * 99 // 100] * 1000000
+
+def TimeLogins(store, usernames):
+    samples = []
+    for username in usernames:
+        started = time.time()
+        character = store.get(username)
+        if character is not None and character.password != "password" + username[4:]:
+            raise AssertionError("wrong record for %s" % username)
+        samples.append(time.time() - started)
+    return samples
+
+def Run(kind, directory, accounts, logins):
+    path = os.path.join(directory, "users-%d.%s" % (accounts, kind))
+    Populate(kind, path, accounts)
+
+    started = time.time()
+    store = UserStore.openStore(kind, path)
+    print "%s: opened in %.1fms" % (kind, (time.time() - started) * 1000)
+
+    random.seed(1)
+    cold = [ "user%d" % i for i in random.sample(xrange(accounts), logins) ]
+    hot = cold[:min(1000, logins)] * (logins // min(1000, logins))
+    unknown = [ "nobody%d" % i for i in xrange(logins) ]
+    for name, usernames in (("cold", cold), ("hot", hot), ("unknown", unknown)):
+        p50, p99 = Percentiles(TimeLogins(store, usernames))
+        print "%s: %-8s p50 %7.1f us  p99 %7.1f us" % (kind, name, p50, p99)
+    store.close()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="accounts", type="int", default=1000000)
+    parser.add_option("-l", dest="logins", type="int", default=20000)
+    parser.add_option("-d", dest="directory", default=tempfile.gettempdir())
+    options, args = parser.parse_args()
+    for kind in args or UserStore.BACKENDS.keys():
+        Run(kind, options.directory, options.accounts, options.logins)
@@ -0,0 +1,88 @@
+#
+# Cost of applying a tick's worth of character moves.
+#
+# Runs under Stackless.  Compares the tasklet per character the server used
+# to run, which took each move off a channel and then yielded, with the
+# world loop queueing moves and applying the latest per character in one
+# pass (World.tick).  Each tick every character sends the given number of
+# moves; times are per tick, snapshot replication included for the world.
+#
+# Usage: WorldTickBenchmark.py [-n characters] [-m moves per tick]
+#                              [-t ticks]
+#
+
+import sys, os, time, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import stackless
+import Character
+import World
+
+def CharacterTasklet(character, channel):
+    # What PlayerCharacter.handleNetworkMessage did
+    while 1:
+        x, y = channel.receive()
+        character.x = x
+        character.y = y
+        stackless.schedule()
+
+def Tasklets(characters, moves, ticks):
+    channels = []
+    for character in characters:
+        channel = stackless.channel()
+        stackless.tasklet(CharacterTasklet)(character, channel)
+        channels.append(channel)
+    stackless.schedule()
+
+    started = time.time()
+    for tick in xrange(ticks):
+        for move in xrange(moves):
+            for channel in channels:
+                channel.send((tick, move))
+        # Let every character tasklet finish with its last move
+        stackless.schedule()
+    return (time.time() - started) / ticks
+
+class Users(object):
+    def __init__(self, characters):
+        self.list = characters
+
+    def characters(self):
+        return self.list
+
+class BenchWorld(World.World):
+    def run(self):
+        # Ticked by hand below
+        pass
+
+def WorldLoop(characters, moves, ticks):
+    world = BenchWorld(Users(characters))
+    for character in characters:
+        character.entityId = world.entities.allocate(character.x, character.y)
+    stackless.schedule()
+
+    started = time.time()
+    for tick in xrange(ticks):
+        for move in xrange(moves):
+            for character in characters:
+                world.queueMove(character, tick, move)
+        world.tick()
+    return (time.time() - started) / ticks
+
+def Run(count, moves, ticks):
+    characters = []
+    for i in xrange(count):
+        character = Character.PlayerCharacter("user%d" % i, "", "", 0)
+        character.sessionIndex = i
+        characters.append(character)
+
+    print "tasklets: %8.3f ms/tick" % (Tasklets(characters, moves, ticks) * 1000)
+    print "world:    %8.3f ms/tick" % (WorldLoop(characters, moves, ticks) * 1000)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="characters", type="int", default=5000)
+    parser.add_option("-m", dest="moves", type="int", default=3)
+    parser.add_option("-t", dest="ticks", type="int", default=100)
+    options, args = parser.parse_args()
+    Run(options.characters, options.moves, options.ticks)
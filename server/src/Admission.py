@@ -0,0 +1,82 @@
+#
+# Login admission control.
+#
+# After a restart every client logs in again at once.  Rather than start
+# checking all their passwords together, each UserManager lets at most
+# MAX_IN_FLIGHT logins be checked at a time and queues the rest first come
+# first served, telling each client where it is in the queue.  Beyond
+# MAX_QUEUED waiting logins, new ones are turned away with a time after
+# which to try again, so those already queued still get in in good time.
+#
+
+import collections
+
+MAX_IN_FLIGHT = 8
+MAX_QUEUED = 1000
+# Seconds a turned away client is asked to wait
+RETRY_AFTER = 5
+
+ADMITTED = 0
+QUEUED = 1
+REJECTED = 2
+
+class LoginAdmission(object):
+    def __init__(self, maxInFlight=None, maxQueued=None):
+        if maxInFlight is None:
+            maxInFlight = MAX_IN_FLIGHT
+        if maxQueued is None:
+            maxQueued = MAX_QUEUED
+        self.maxInFlight = maxInFlight
+        self.maxQueued = maxQueued
+
+        self.inFlight = 0
+        # (ticket, client, login) in arrival order
+        self.waiting = collections.deque()
+        # Clients in the queue, each may only be in it once
+        self.clients = set()
+        # Tickets handed out and taken off the queue, so that a position is
+        # the difference
+        self.issued = 0
+        self.served = 0
+
+    def request(self, client, login):
+        """ Returns (ADMITTED, None) if the login may go ahead now,
+        (QUEUED, position in the queue) or (REJECTED, None) if it should
+        try again later. """
+        if self.inFlight < self.maxInFlight and not self.waiting:
+            self.inFlight += 1
+            return ADMITTED, None
+        if client in self.clients:
+            # Asked again while queued, it keeps its place
+            return QUEUED, self.positionOf(client)
+        if len(self.waiting) >= self.maxQueued:
+            return REJECTED, None
+        self.issued += 1
+        self.waiting.append((self.issued, client, login))
+        self.clients.add(client)
+        return QUEUED, self.position(self.issued)
+
+    def position(self, ticket):
+        return ticket - self.served
+
+    def finished(self):
+        """ A login is over, returns (client, login) of the next one to go
+        ahead or None. """
+        self.inFlight -= 1
+        if not self.waiting or self.inFlight >= self.maxInFlight:
+            return None
+        ticket, client, login = self.waiting.popleft()
+        self.clients.discard(client)
+        self.served = ticket
+        self.inFlight += 1
+        return client, login
+
+    def queued(self):
+        """ (client, position) of every queued login. """
+        return [ (client, self.position(ticket)) for ticket, client, login in self.waiting ]
+
+    def positionOf(self, client):
+        for ticket, queuedClient, login in self.waiting:
+            if queuedClient is client:
+                return self.position(ticket)
+        return None
@@ -0,0 +1,24 @@
+#
+# Sending one message to many clients.
+#
+# The message is encoded into a frame once, and every recipient's
+# Connection is handed a reference to that same string.  Connection.write()
+# only queues the reference, and a flush with nothing else pending passes
+# it on to the socket's send queue as it is (see StacklessSocket._sendqueue),
+# so the message is never copied per recipient.  Compressing connections
+# still compress it each, as their streams differ.
+#
+# Rather than patch a frame for each recipient, packets are laid out so
+# that they don't need it: a Chat packet carries the speaker's entity id
+# and each client tells for itself whether it was the one speaking.
+#
+
+def send(frame, connections, exclude=None):
+    """ Queue the frame on every connection but exclude, returning how many
+    it went to. """
+    count = 0
+    for connection in connections:
+        if connection is not exclude:
+            connection.write(frame)
+            count += 1
+    return count
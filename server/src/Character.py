@@ -1,28 +1,44 @@
-import stackless
-import Messages
-
-class Character:
+class Character(object):
+    __slots__ = ()
+    
     def move(self, direction):
         print "moving"
 
-class PlayerCharacter(Character):
+class Account(object):
+    """ What a user registered with, only needed at login and when saving. """
+    __slots__ = ("username", "password", "email", "starter")
+    
     def __init__(self, username, password, email, starter):
         self.username = username
         self.password = password
         self.email = email
         self.starter = starter
+
+# With a server full of characters the per instance __dict__ costs more
+# than the state itself, so characters use __slots__ and keep the account
+# apart from the state the game loop touches.
+class PlayerCharacter(Character):
+    __slots__ = ("account", "x", "y", "entityId", "connection", "sessionIndex", "zone")
+    
+    def __init__(self, username, password, email, starter):
+        self.account = Account(username, password, email, starter)
         
+        # Where the character was when last saved.  While it is logged in
+        # its position is kept in the world's EntityStore instead.
         self.x = 0
         self.y = 0
+        
+        # Set while logged in: its entity id in the EntityStore, the
+        # Connection of the client playing it and where it is in the logged
+        # in users (UserManager.LoggedInUsers)
+        self.entityId = None
+        self.connection = None
+        self.sessionIndex = None
+        
+        # The zone simulating the character when that isn't this process,
+        # in which case it has no entity here (see Zones)
+        self.zone = None
     
-    def handleNetworkMessage(self, networkChannel):
-        while 1:
-            # Get the packet
-            message, payload = networkChannel.receive()
-
-            if (message == Messages.CHAR_MOVE):
-                x, y = payload
-                
-                print message, payload
-            
-            stackless.schedule()
\ No newline at end of file
+    @property
+    def username(self):
+        return self.account.username
\ No newline at end of file
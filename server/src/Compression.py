@@ -0,0 +1,42 @@
+#
+# Stream compression for client connections.
+#
+# Negotiation: the client may open with a Hello packet giving the
+# capabilities it supports (CAP_* below).  It then sends nothing more until
+# the server's Hello reply, which holds the capabilities the server agreed
+# to.  If CAP_ZLIB was agreed, every byte after the reply, in both
+# directions, is a raw deflate stream.
+#
+# There is no preset dictionary.  Nearly all of what the server sends is
+# delta-encoded snapshots, whose varints don't repeat from one connection
+# to the next, and a dictionary trained on recorded Snapshot and Chat
+# traffic saved nothing on traffic it wasn't trained on, even over the
+# first few ticks of a connection.
+#
+
+import zlib
+
+CAP_ZLIB = 0x01
+
+# Flush policies: a sync flush after every write keeps latency down, a full
+# flush also lets the peer resynchronise at the cost of the history.
+FLUSH_SYNC = zlib.Z_SYNC_FLUSH
+FLUSH_FULL = zlib.Z_FULL_FLUSH
+
+# What a corrupt stream raises
+error = zlib.error
+
+class StreamCompressor(object):
+    def __init__(self, level=6, flushMode=FLUSH_SYNC):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.flushMode = flushMode
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(self.flushMode)
+
+class StreamDecompressor(object):
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
@@ -2,9 +2,70 @@ import stackless
 import socket, struct
 
 import Messages
+import Framing
+import Packets
+import Compression
+import Snapshot
+
+# What we offer clients in the Hello exchange, and how we compress.
+CAPABILITIES = Compression.CAP_ZLIB
+COMPRESSION_LEVEL = 6
+COMPRESSION_FLUSH = Compression.FLUSH_SYNC
+
+# Buffered output is sent straight away rather than at the end of the round
+# once there is this much of it.
+FLUSH_THRESHOLD = 16 * 1024
+
+# A client that leaves this much unsent (it stopped reading, or can't keep
+# up with its snapshots) is disconnected rather than buffered for forever.
+MAX_OUTBOUND = 8 * FLUSH_THRESHOLD
+
+class FlushScheduler(object):
+    """ Sends the output connections have buffered, once every tasklet
+    which was runnable when the first of it was written has had its turn.
+
+    All the output a connection produces in a scheduler round goes out in
+    one send, rather than a send (and a reschedule) per message. """
+
+    def __init__(self):
+        self.pending = []
+        self.wakeup = stackless.channel()
+        self.wakeup.preference = 1
+        stackless.tasklet(self.run)()
+
+    def schedule(self, connection):
+        self.pending.append(connection)
+        if self.wakeup.balance < 0:
+            self.wakeup.send(None)
+
+    def run(self):
+        while 1:
+            if not self.pending:
+                self.wakeup.receive()
+            # Go to the back of the queue, letting the rest of the round's
+            # tasklets add their output first.
+            stackless.schedule()
+            self.flushAll()
+
+    def flushAll(self):
+        pending, self.pending = self.pending, []
+        for connection in pending:
+            connection.flushPending = False
+            # Closed since, or already sent with a later flush
+            if connection.corked or connection.closed or not connection.outbound:
+                continue
+            connection.flushSoon()
+
+_flushScheduler = None
+
+def flushScheduler():
+    global _flushScheduler
+    if _flushScheduler is None:
+        _flushScheduler = FlushScheduler()
+    return _flushScheduler
 
 class Connection:
-    def __init__(self, clientsocket, address, control):
+    def __init__(self, clientsocket, address, users, movement=None):
         # Create a manager channel which can inform us
         # about the results of any external manager's
         # actions (logging in, registering, etc)
@@ -15,85 +76,229 @@ class Connection:
         # Handle management results in another tasklet
         stackless.tasklet(self.handleManagementMessage)(manager)
         
-        self.control = control
+        # Control messages go to the user's shard (UserManager.UserShards)
+        self.users = users
         self.manager = manager
         
+        # The UDP movement channel, and our token for it once logged in
+        self.movement = movement
+        self.movementToken = None
+        
+        # Output waiting to be sent, see write()
+        self.clientsocket = clientsocket
+        self.address = address
+        self.outbound = []
+        self.outboundSize = 0
+        self.flushPending = False
+        self.corked = 0
+        # Whether a tasklet of its own is sending our output, see flushSoon()
+        self.flushing = False
+        
+        # Set up if the client negotiates compression
+        self.compressor = None
+        self.decompressor = None
+        
         self.username = None
         self.character = None
+        self.closed = False
+        
+        # The world snapshot the client last acknowledged
+        self.baseline = Snapshot.ClientBaseline()
+        
+        # Handler methods by packet opcode
+        self.handlers = Packets.dispatchTable(self)
         
         stackless.schedule()
     
     def network(self, clientsocket, address):
         print "Client %s:%s connected..." % (address[0],address[1])
-        # For each send we expect the socket returns 1, if its 0 an error ocurred
-        if not clientsocket.send('Connection OK\n\rType q! to quit.\n\r> '):
-            clientsocket.close()
-            return
-        data = ''
+        # Everything we send is framed, the client speaks first with Hello
+        # or Login
+        decoder = Framing.FrameDecoder()
         while clientsocket.connect:
-            data += clientsocket.recv(4096)
+            data = clientsocket.recv(4096)
             if data == '':
                 break
-            # If we detect a \n filter the event
-            if '\0' in data:
-                print data
-                
-                data = data.rstrip('\0')
-                message = struct.unpack('I', data[:2])
-                
-                if message == Messages.PACKET_LOGIN:
-                    # username, password
-                    payload = struct.unpack('ss', data[2:])
-                elif message == Messages.PACKET_REGISTER:
-                    # username, password, email
-                    payload = struct.unpack('sss', data[2:])
-                elif message == Messages.PACKET_CHAR_MOVE:
-                    # x, y
-                    payload = struct.unpack('ii', data[2:])
-                
-                handlePacket(message, payload)
-                
-                clientsocket.send("> ")
-                data = ''
-                
-            stackless.schedule()
+            if self.decompressor:
+                try:
+                    data = self.decompressor.decompress(data)
+                except Compression.error:
+                    print "Corrupt compressed stream from %s:%s" % (address[0],address[1])
+                    break
+            # Handle every complete packet that has arrived
+            frames = decoder.feed(data)
+            for message, payload in frames:
+                self.handlePacket(message, payload)
         
         # Loop's over, we broke out for some reason
         # Close the connection
         self.close(clientsocket)
     
     def handlePacket(self, message, payload):
+        handler = self.handlers[message]
+        if handler is None:
+            print "Unhandled packet %d" % message
+            return
+        try:
+            fields = Packets.DECODERS[message](payload)
+        except struct.error:
+            print "Malformed %s packet" % Packets.PACKETS[message].name
+            return
+        handler(*fields)
+
+    def packetCharMove(self, x, y):
         if self.character:
-            # Pass the message onto the PlayerCharacter in a clean form
-            if message == Messages.PACKET_CHAR_MOVE:
-                self.character.send((Messages.CHAR_MOVE, payload))
-                
-        elif message == Messages.PACKET_LOGIN:
-            username, password = payload
-            print "Login: Username: %s, Password: %s" % payload
-            
-            payload = (username, password, self.manager)
-            self.control.send((Messages.CONTROL_LOGIN, payload))
-            
-        elif message == Messages.PACKET_REGISTER:
-            print "Register: Username: %s, Password: %s, Email: %s" % payload
-            self.control.send((Messages.CONTROL_REGISTER, payload))
+            # Applied on the next world tick, unless a newer move comes first
+            self.users.world.queueMove(self.character, x, y)
+
+    def packetLogin(self, username, password):
+        if self.character:
+            return
+        print "Login: Username: %s, Password: %s" % (username, password)
+        
+        payload = (username, password, self.manager, self)
+        self.users.control(username).send((Messages.CONTROL_LOGIN, payload))
+
+    def packetRegister(self, username, password, email):
+        if self.character:
+            return
+        print "Register: Username: %s, Password: %s, Email: %s" % (username, password, email)
+        self.users.control(username).send((Messages.CONTROL_REGISTER, (username, password, email)))
+
+    def packetSay(self, text):
+        if not self.character:
+            return
+        self.users.world.say(self.character, text)
+
+    def packetSnapshotAck(self, sequence):
+        if self.character:
+            self.users.world.acknowledge(self.character, sequence)
+
+    def packetHello(self, capabilities):
+        if self.compressor:
+            return
+        agreed = capabilities & CAPABILITIES
+        
+        # Whatever is already queued predates the agreement, then the reply
+        # itself goes out as is and everything after it is compressed.
+        self.flush()
+        try:
+            self.clientsocket.send(Packets.BY_NAME["Hello"].encode(agreed))
+        except socket.error:
+            return
+        if agreed & Compression.CAP_ZLIB:
+            self.compressor = Compression.StreamCompressor(COMPRESSION_LEVEL, COMPRESSION_FLUSH)
+            self.decompressor = Compression.StreamDecompressor()
+
+    def write(self, data):
+        """ Queue data to be sent to the client at the end of the round. """
+        if self.closed:
+            return
+        self.outbound.append(data)
+        self.outboundSize += len(data)
+        if self.outboundSize > MAX_OUTBOUND:
+            self.overflow()
+        elif self.outboundSize >= FLUSH_THRESHOLD:
+            self.flushSoon()
+        elif not self.flushPending and not self.corked:
+            self.flushPending = True
+            flushScheduler().schedule(self)
+
+    def writeLine(self, line):
+        self.write(line + "\r\n")
+
+    def cork(self):
+        """ Hold written output back until the matching uncork(), so that it
+        goes out together.  Output past FLUSH_THRESHOLD is still sent. """
+        self.corked += 1
+
+    def uncork(self):
+        self.corked -= 1
+        if not self.corked and self.outbound:
+            self.flushSoon()
+
+    def flushSoon(self):
+        """ Sends the output now if that won't wait on the client, or else
+        from a tasklet of its own, so that a slow client never holds up
+        whoever wrote to it (usually the world's tick). """
+        if self.flushing:
+            # Sent with the rest once it gets to it, still in order
+            return
+        if self.clientsocket.send_would_block():
+            self.flushing = True
+            stackless.tasklet(self.drain)()
+        else:
+            self.flush()
+
+    def overflow(self):
+        print "Client %s:%s fell too far behind, disconnecting" % (self.address[0],self.address[1])
+        self.closed = True
+        self.outbound = []
+        self.outboundSize = 0
+        # Wakes the network tasklet, which cleans up, and whatever send the
+        # drain tasklet is stuck in.
+        try:
+            self.clientsocket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def drain(self):
+        try:
+            while self.outbound and not self.closed:
+                self.flush()
+        finally:
+            self.flushing = False
+
+    def flush(self):
+        if not self.outbound:
+            return
+        if len(self.outbound) == 1:
+            data = self.outbound[0]
+        else:
+            data = ''.join(self.outbound)
+        self.outbound = []
+        self.outboundSize = 0
+        if self.compressor:
+            data = self.compressor.compress(data)
+        try:
+            self.clientsocket.send(data)
+        except socket.error:
+            # Closed under us, the network tasklet will clean up.
+            pass
 
     def close(self, clientsocket):
         clientsocket.close()
+        self.closed = True
+        self.outbound = []
+        self.outboundSize = 0
+        
+        if self.movementToken is not None:
+            self.movement.revokeToken(self.movementToken)
+            self.movementToken = None
         
         # If we are logged in, do some cleanup
         if (self.character):
-            self.control.send((Messages.CONTROL_DISCONNECT, self.username))
+            self.users.control(self.username).send((Messages.CONTROL_DISCONNECT, self.username))
         
     def handleManagementMessage(self, manager):
         while 1:
             message, payload = manager.receive()
             
             if (message == Messages.MANAGER_LOGGEDIN):
-                # Payload is character control channel
+                # Payload is the logged in character
                 self.username, self.character = payload
                 
-                # We can now send Messages over the channel
-                # Player character will handle them
-                print "Got networkChannel for player %s" % self.username
+                print "Logged in player %s" % self.username
+                
+                # Moves may now also come in over UDP
+                if self.movement:
+                    self.movementToken = self.movement.issueToken(self)
+                    self.write(Packets.BY_NAME["UdpToken"].encode(self.movementToken, self.movement.port))
+            
+            elif (message == Messages.MANAGER_QUEUED):
+                # Payload is our place in the login queue
+                self.write(Packets.BY_NAME["LoginQueued"].encode(payload))
+            
+            elif (message == Messages.MANAGER_REJECTED):
+                # Payload is how many seconds to wait before trying again
+                self.write(Packets.BY_NAME["LoginRetry"].encode(payload))
\ No newline at end of file
@@ -0,0 +1,247 @@
+#
+# Non-player characters, simulated together.
+#
+# The client's Agent runs forward all the time and once a second picks at
+# random whether to turn left, turn right or keep straight on.  A Crowd does
+# the same for all of its NPCs at once: their headings, turn rates and turn
+# timers are arrays, and each tick (as a World system) advances every one
+# of them with a handful of array operations, then sets their velocities in
+# the EntityStore for the next tick's integrate() to move them.  NPCs are
+# ordinary entities flagged EntityStore.NPC, so the snapshot replication
+# sends them to clients just as it sends player characters.
+#
+# An NPC may instead be given a goal, which it heads straight for until it
+# gets there and goes back to wandering, or a path of them (from
+# Pathfinding.Pathfinder.findPath()) to take one after another.  Or it can
+# follow a flow field (see Pathfinding) around whatever is in the way; NPCs
+# following the same field are steered by it together, and by a new one to
+# the same goal once the terrain's walkability changes and that has been
+# built.  Errands decides where they go.
+#
+# With a Terrain, NPCs about to step onto ground they can't walk on stop
+# and turn around instead, and new ones are only placed on walkable cells.
+# NPCs likewise turn back at the edge of the crowd's bounds, the world's
+# unless it is given its own.
+#
+
+import math, collections
+import numpy
+
+import EntityStore
+import Terrain
+
+# How fast NPCs run, in units a second, as the client's characters do
+SPEED = 5.0
+# How fast they turn, in radians a second
+TURN_RATE = math.radians(120)
+# How often each one makes up its mind about turning, in seconds
+TURN_INTERVAL = 1.0
+# How close to its goal an NPC has to get to have reached it
+ARRIVED = 1.0
+
+WANDER = 0
+SEEK = 1
+FOLLOW = 2
+
+class Crowd(object):
+    def __init__(self, entities, terrain=None, capacity=1024, seed=None, bounds=None):
+        self.entities = entities
+        self.terrain = terrain
+        # minX, minY, maxX, maxY NPCs are kept within
+        if bounds is None:
+            bounds = entities.bounds
+        self.bounds = bounds
+        self.random = numpy.random.RandomState(seed)
+
+        # Rows 0 to count - 1 are in use, the rest spare
+        self.count = 0
+        self.capacity = 0
+        self.ids = numpy.zeros(0, numpy.intp)
+        self.facing = numpy.zeros(0)
+        self.turning = numpy.zeros(0)
+        self.untilTurn = numpy.zeros(0)
+        self.speed = numpy.zeros(0)
+        self.mode = numpy.zeros(0, numpy.uint8)
+        self.goalX = numpy.zeros(0)
+        self.goalY = numpy.zeros(0)
+        self.route = numpy.zeros(0, numpy.int32)
+        self.grow(capacity)
+
+        # entity id -> row
+        self.rows = {}
+        # Flow fields followed, indexed by route
+        self.routes = []
+        # entity id -> the waypoints still ahead of it after its goal
+        self.waypoints = {}
+
+    def grow(self, capacity):
+        def resized(array):
+            bigger = numpy.zeros(capacity, array.dtype)
+            bigger[:len(array)] = array
+            return bigger
+        self.ids = resized(self.ids)
+        self.facing = resized(self.facing)
+        self.turning = resized(self.turning)
+        self.untilTurn = resized(self.untilTurn)
+        self.speed = resized(self.speed)
+        self.mode = resized(self.mode)
+        self.goalX = resized(self.goalX)
+        self.goalY = resized(self.goalY)
+        self.route = resized(self.route)
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.count
+
+    def spawn(self, count, bounds=None):
+        """ Adds count wandering NPCs at random places within bounds (minX,
+        minY, maxX, maxY, the crowd's by default), returning their entity
+        ids. """
+        if bounds is None:
+            bounds = self.bounds
+        x, y = self.places(count, bounds)
+        if self.count + count > self.capacity:
+            self.grow(max(self.capacity * 2, self.count + count))
+
+        allocate = self.entities.allocate
+        ids = [ allocate(x[i], y[i], EntityStore.NPC) for i in xrange(count) ]
+        rows = slice(self.count, self.count + count)
+        self.ids[rows] = ids
+        self.facing[rows] = self.random.uniform(-math.pi, math.pi, count)
+        self.turning[rows] = 0.0
+        # Spread out when they turn, rather than all on the same tick
+        self.untilTurn[rows] = self.random.uniform(0.0, TURN_INTERVAL, count)
+        self.speed[rows] = SPEED
+        self.mode[rows] = WANDER
+        for row, entityId in enumerate(ids):
+            self.rows[entityId] = self.count + row
+        self.count += count
+        return ids
+
+    def places(self, count, bounds):
+        minX, minY, maxX, maxY = bounds
+        terrain = self.terrain
+        if terrain is None:
+            return self.random.uniform(minX, maxX, count), self.random.uniform(minY, maxY, count)
+
+        # The centres of walkable cells within the bounds
+        row, column = numpy.nonzero(terrain.flags & Terrain.WALKABLE)
+        x = terrain.originX + (column + 0.5) * terrain.cellSize
+        y = terrain.originY + (row + 0.5) * terrain.cellSize
+        within = (x >= minX) & (x <= maxX) & (y >= minY) & (y <= maxY)
+        if not within.any():
+            raise ValueError("no walkable ground within %r" % (bounds,))
+        chosen = self.random.randint(0, numpy.count_nonzero(within), count)
+        return x[within][chosen], y[within][chosen]
+
+    def despawn(self, entityId):
+        row = self.rows.pop(entityId)
+        self.waypoints.pop(entityId, None)
+        self.entities.release(entityId)
+        # Move the last row into the gap
+        last = self.count - 1
+        if row != last:
+            for array in (self.ids, self.facing, self.turning, self.untilTurn, self.speed,
+                          self.mode, self.goalX, self.goalY, self.route):
+                array[row] = array[last]
+            self.rows[int(self.ids[row])] = row
+        self.count = last
+
+    def seek(self, entityId, x, y):
+        self.waypoints.pop(entityId, None)
+        row = self.rows[entityId]
+        self.mode[row] = SEEK
+        self.goalX[row] = x
+        self.goalY[row] = y
+
+    def travel(self, entityId, waypoints):
+        """ Sends the NPC to each of a list of (x, y) in turn. """
+        self.seek(entityId, *waypoints[0])
+        if len(waypoints) > 1:
+            self.waypoints[entityId] = collections.deque(waypoints[1:])
+
+    def follow(self, entityId, field):
+        """ Sends the NPC along a Pathfinding.FlowField to its goal. """
+        self.waypoints.pop(entityId, None)
+        if field not in self.routes:
+            self.routes.append(field)
+        row = self.rows[entityId]
+        self.mode[row] = FOLLOW
+        self.route[row] = self.routes.index(field)
+
+    def wander(self, entityId):
+        self.waypoints.pop(entityId, None)
+        self.mode[self.rows[entityId]] = WANDER
+
+    def tick(self, interval):
+        count = self.count
+        if not count:
+            return
+        ids = self.ids[:count]
+        facing = self.facing[:count]
+        turning = self.turning[:count]
+        untilTurn = self.untilTurn[:count]
+        speed = self.speed[:count]
+        mode = self.mode[:count]
+        x = self.entities.x[ids]
+        y = self.entities.y[ids]
+
+        # Those whose time is up pick left, right or straight on again
+        untilTurn -= interval
+        deciding = numpy.flatnonzero(untilTurn <= 0.0)
+        if len(deciding):
+            turning[deciding] = (self.random.randint(0, 3, len(deciding)) - 1) * TURN_RATE
+            untilTurn[deciding] += TURN_INTERVAL
+        facing += turning * interval
+
+        seeking = numpy.flatnonzero(mode == SEEK)
+        if len(seeking):
+            dx = self.goalX[seeking] - x[seeking]
+            dy = self.goalY[seeking] - y[seeking]
+            facing[seeking] = numpy.arctan2(dy, dx)
+            arrived = seeking[dx * dx + dy * dy <= ARRIVED * ARRIVED]
+            mode[arrived] = WANDER
+            if len(arrived) and self.waypoints:
+                # Those with further to go head for their next waypoint
+                for row in arrived.tolist():
+                    entityId = int(ids[row])
+                    waypoints = self.waypoints.get(entityId)
+                    if waypoints is None:
+                        continue
+                    self.goalX[row], self.goalY[row] = waypoints.popleft()
+                    mode[row] = SEEK
+                    if not waypoints:
+                        del self.waypoints[entityId]
+
+        following = numpy.flatnonzero(mode == FOLLOW)
+        if len(following):
+            route = self.route[:count]
+            for index in numpy.unique(route[following]).tolist():
+                rows = following[route[following] == index]
+                # Rebuilt if the terrain has changed under it
+                field = self.routes[index] = self.routes[index].current()
+                targetX, targetY, reachable, arrived = field.steer(x[rows], y[rows])
+                facing[rows] = numpy.arctan2(targetY - y[rows], targetX - x[rows])
+                # There, or no way there, either way back to wandering
+                mode[rows[arrived | ~reachable]] = WANDER
+        elif self.routes:
+            self.routes = []
+
+        # Turn back from the edge rather than run along it
+        minX, minY, maxX, maxY = self.bounds
+        vx = numpy.cos(facing) * speed
+        vy = numpy.sin(facing) * speed
+        aheadX = x + vx * interval
+        aheadY = y + vy * interval
+        blocked = (aheadX < minX) | (aheadX > maxX) | (aheadY < minY) | (aheadY > maxY)
+        if self.terrain is not None:
+            blocked |= ~self.terrain.validateMoves(x, y, aheadX, aheadY)
+        if blocked.any():
+            facing[blocked] += math.pi
+            vx[blocked] = 0.0
+            vy[blocked] = 0.0
+        numpy.remainder(facing + math.pi, 2 * math.pi, out=facing)
+        facing -= math.pi
+
+        self.entities.vx[ids] = vx
+        self.entities.vy[ids] = vy
@@ -0,0 +1,125 @@
+#
+# Entity state as a struct of NumPy arrays.
+#
+# Every entity in the world, player character or not, is a row across a
+# set of arrays: position, velocity, heading and flags.  The row number is
+# the entity's id, which stays the same for as long as the entity exists;
+# ids given back with release() are handed out again from a free list, so
+# the arrays stay dense.  Per tick work is done on whole arrays at once
+# rather than by visiting each entity in Python.
+#
+# Row 0 is never used, so an entity id is never 0.
+#
+# Alongside the arrays each row can have an owner, the Python object the
+# entity stands for, such as a PlayerCharacter.
+#
+
+import numpy
+
+ALIVE = 0x1
+PLAYER = 0x2
+NPC = 0x4
+# A copy of an entity simulated by another zone (see Zones)
+GHOST = 0x8
+
+class EntityStore(object):
+    def __init__(self, capacity=1024, bounds=(-4096.0, -4096.0, 4096.0, 4096.0)):
+        # minX, minY, maxX, maxY that entities are kept within
+        self.bounds = bounds
+
+        self.capacity = 0
+        self.x = self.y = numpy.zeros(0)
+        self.vx = self.vy = numpy.zeros(0)
+        self.heading = numpy.zeros(0)
+        self.flags = numpy.zeros(0, numpy.uint32)
+        self.owners = []
+        self.grow(max(capacity, 2))
+
+        # One past the highest id in use, work is done on rows below it
+        self.end = 1
+        self.free = set()
+        self.count = 0
+
+    def grow(self, capacity):
+        def resized(array):
+            bigger = numpy.zeros(capacity, array.dtype)
+            bigger[:len(array)] = array
+            return bigger
+        self.x = resized(self.x)
+        self.y = resized(self.y)
+        self.vx = resized(self.vx)
+        self.vy = resized(self.vy)
+        self.heading = resized(self.heading)
+        self.flags = resized(self.flags)
+        self.owners.extend([ None ] * (capacity - len(self.owners)))
+        self.capacity = capacity
+
+    def allocate(self, x=0.0, y=0.0, flags=0, owner=None):
+        if self.free:
+            entityId = self.free.pop()
+        else:
+            if self.end == self.capacity:
+                self.grow(self.capacity * 2)
+            entityId = self.end
+            self.end += 1
+        self.x[entityId] = x
+        self.y[entityId] = y
+        self.vx[entityId] = self.vy[entityId] = 0.0
+        self.heading[entityId] = 0.0
+        self.flags[entityId] = flags | ALIVE
+        self.owners[entityId] = owner
+        self.count += 1
+        return entityId
+
+    def release(self, entityId):
+        self.flags[entityId] = 0
+        self.vx[entityId] = self.vy[entityId] = 0.0
+        self.owners[entityId] = None
+        self.count -= 1
+        self.free.add(entityId)
+        # Give back trailing free rows, so the arrays worked on stay short
+        while self.end - 1 in self.free:
+            self.free.remove(self.end - 1)
+            self.end -= 1
+
+    def place(self, entityId, x, y):
+        self.x[entityId] = x
+        self.y[entityId] = y
+
+    def position(self, entityId):
+        return float(self.x[entityId]), float(self.y[entityId])
+
+    def setVelocity(self, entityId, vx, vy):
+        self.vx[entityId] = vx
+        self.vy[entityId] = vy
+
+    def live(self):
+        """ Ids of the live entities. """
+        return numpy.flatnonzero(self.flags[:self.end] & ALIVE)
+
+    def integrate(self, dt):
+        """ Move everything along its velocity for dt seconds, keeping it
+        within the bounds and facing the way it is going. """
+        end = self.end
+        x, y = self.x[:end], self.y[:end]
+        vx, vy = self.vx[:end], self.vy[:end]
+        x += vx * dt
+        y += vy * dt
+        minX, minY, maxX, maxY = self.bounds
+        numpy.clip(x, minX, maxX, out=x)
+        numpy.clip(y, minY, maxY, out=y)
+        # Released rows have no velocity, so they stay put
+        moving = (vx != 0.0) | (vy != 0.0)
+        numpy.arctan2(vy, vx, out=self.heading[:end], where=moving)
+
+    def quantized(self, scale, ids=None):
+        """ (ids, x, y) of the live entities, or of those among ids,
+        positions in fixed point with scale steps per unit, all as lists. """
+        if ids is None:
+            ids = self.live()
+        else:
+            ids = numpy.asarray(ids, numpy.intp)
+            ids = ids[(self.flags[ids] & ALIVE) != 0]
+        qx = numpy.rint(self.x[ids] * scale).astype(numpy.int64)
+        qy = numpy.rint(self.y[ids] * scale).astype(numpy.int64)
+        return ids.tolist(), qx.tolist(), qy.tolist()
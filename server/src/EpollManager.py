@@ -0,0 +1,180 @@
+#
+# Edge-triggered epoll socket manager for StacklessSocket.
+#
+# The stock StacklessSocket.ManageSockets() calls asyncore.poll(0.05) in a
+# loop, which rebuilds the select() sets from the whole socket map on every
+# pass and leaves each packet waiting up to 50ms to be noticed.  This manager
+# instead keeps every socket registered with a single edge-triggered epoll
+# object and only ever touches the sockets the kernel reported as ready, or
+# that told us they have new work (see StacklessSocket._fakesocket._wakeup).
+#
+# Because the events are edge-triggered, readiness is remembered per socket
+# until a handler reports that it ran the kernel dry (readBlocked and
+# writeBlocked on _fakesocket).  A socket which is ready but has nothing to
+# do, such as a listening socket with nobody in accept(), just stays marked
+# ready until it is woken up.
+#
+# When no other tasklet is runnable and no socket has outstanding work the
+# manager blocks in epoll, parking the scheduler rather than spinning, until
+# a socket is ready or a sleeping tasklet (see Timers) is due.
+#
+# Usage:
+#
+#   import StacklessSocket, EpollManager
+#   StacklessSocket.install()
+#   EpollManager.install()
+#
+
+import select, asyncore
+import stackless
+
+import StacklessSocket
+import Timers
+import Offload
+
+READ_EVENTS = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP | select.EPOLLERR
+WRITE_EVENTS = select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR
+
+class EpollManager(object):
+    def __init__(self, idleTimeout=-1, maxEvents=-1):
+        # How long to block when there is nothing to do, -1 means until a
+        # socket becomes ready.
+        self.idleTimeout = idleTimeout
+        self.maxEvents = maxEvents
+
+        self.epoll = select.epoll()
+        self.running = False
+
+        # fd -> dispatcher (a weakref proxy, as held in asyncore.socket_map)
+        self.sockets = {}
+        # fds the kernel said were ready that have not been drained since
+        self.readReady = set()
+        self.writeReady = set()
+        # fds which need servicing on the next pass
+        self.dirty = set()
+        # Offload's pipe, when we are watching it
+        self.offloadFd = None
+
+    # StacklessSocket manager hook, called whenever a socket is created.
+    def start(self):
+        if not self.running:
+            self.running = True
+            stackless.tasklet(self.run)()
+
+    # StacklessSocket watcher interface.
+    def add_socket(self, fd, dispatcher):
+        self.sockets[fd] = dispatcher
+        self.epoll.register(fd, READ_EVENTS | WRITE_EVENTS | select.EPOLLET)
+        # Accepted sockets don't go through the manager hook.
+        self.start()
+
+    def remove_socket(self, fd):
+        if self.sockets.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError):
+                pass
+        self.readReady.discard(fd)
+        self.writeReady.discard(fd)
+        self.dirty.discard(fd)
+
+    def wakeup(self, fd):
+        if fd in self.sockets:
+            self.dirty.add(fd)
+
+    def run(self):
+        try:
+            while self.sockets:
+                self.watchOffload()
+                if self.dirty or stackless.getruncount() > 1:
+                    timeout = 0
+                else:
+                    timeout = Timers.timeUntilNext(self.idleTimeout)
+                self.poll(timeout)
+                Timers.wakeExpired()
+                Offload.wakeCompleted()
+                # Yield to give other tasklets a chance to be scheduled.
+                stackless.schedule()
+        finally:
+            self.running = False
+
+    def watchOffload(self):
+        # Offload may be installed or removed after we have started.
+        fd = Offload.wakeupFd()
+        if fd != self.offloadFd:
+            if self.offloadFd is not None:
+                try:
+                    self.epoll.unregister(self.offloadFd)
+                except (IOError, OSError):
+                    pass
+            if fd is not None:
+                self.epoll.register(fd, select.EPOLLIN)
+            self.offloadFd = fd
+
+    def poll(self, timeout=0):
+        try:
+            events = self.epoll.poll(timeout, self.maxEvents)
+        except IOError, err:
+            # Interrupted by a signal.
+            if err.args[0] != 4:
+                raise
+            events = ()
+
+        dirty = self.dirty
+        for fd, flags in events:
+            if fd == self.offloadFd:
+                # Picked up by Offload.wakeCompleted()
+                continue
+            if flags & READ_EVENTS:
+                self.readReady.add(fd)
+            if flags & WRITE_EVENTS:
+                self.writeReady.add(fd)
+            dirty.add(fd)
+
+        self.dirty = set()
+        for fd in dirty:
+            dispatcher = self.sockets.get(fd)
+            if dispatcher is not None:
+                self.service(fd, dispatcher)
+
+    def service(self, fd, dispatcher):
+        try:
+            if fd in self.readReady and dispatcher.readable():
+                dispatcher.handle_read_event()
+                if dispatcher.readBlocked:
+                    self.readReady.discard(fd)
+                else:
+                    self.dirty.add(fd)
+
+            # The read handler may have closed the socket.
+            if fd not in self.sockets:
+                return
+
+            if fd in self.writeReady and dispatcher.writable():
+                dispatcher.handle_write_event()
+                if dispatcher.writeBlocked:
+                    self.writeReady.discard(fd)
+                elif dispatcher.writable():
+                    self.dirty.add(fd)
+        except ReferenceError:
+            # The socket was garbage collected without being closed.
+            self.remove_socket(fd)
+        except asyncore.ExitNow:
+            raise
+        except:
+            dispatcher.handle_error()
+
+
+def install(manager=None):
+    if manager is None:
+        manager = EpollManager()
+    StacklessSocket.stacklesssocket_manager(manager.start)
+    StacklessSocket.stacklesssocket_watcher(manager)
+    # Pick up any sockets that were created before we were installed.
+    for fd, dispatcher in asyncore.socket_map.items():
+        manager.add_socket(fd, dispatcher)
+    return manager
+
+def uninstall():
+    StacklessSocket.stacklesssocket_manager(StacklessSocket.StartManager)
+    StacklessSocket.stacklesssocket_watcher(None)
@@ -0,0 +1,87 @@
+#
+# Places for NPCs to go.
+#
+# Left to itself a Crowd only wanders.  Each tick (as a World system) some
+# of its wandering NPCs are sent somewhere instead, each of them on average
+# once every ERRAND_INTERVAL seconds.  SHARED of them go to one of a few
+# DESTINATIONS picked when the world starts, the places everyone goes,
+# following its flow field along with everyone else going there.  The rest
+# go somewhere of their own within ERRAND_RANGE of where they are, along a
+# path found with A*.  Either way they go back to wandering once they get
+# there, or find they can't.
+#
+# Searching and flooding are never done in the middle of the tick: they are
+# asked of the Pathfinder, which is given PATH_BUDGET seconds of each tick
+# to get on with them (see Pathfinding.Pathfinder.work()).  NPCs carry on
+# wandering until their path has been found, and nobody sets off for a
+# destination until its flow field has been built.  No more than
+# MAX_SEARCHES searches are waiting at once, further NPCs wander on.
+#
+
+import numpy
+
+import Crowd
+
+# Seconds an NPC wanders, on average, before being sent somewhere
+ERRAND_INTERVAL = 30.0
+# Places shared by the whole crowd, and the share of errands going to them
+DESTINATIONS = 4
+SHARED = 0.5
+# How far an NPC's own errands take it, in world units
+ERRAND_RANGE = 96.0
+# Seconds of each tick spent finding paths and building flow fields
+PATH_BUDGET = 0.005
+MAX_SEARCHES = 64
+
+class Errands(object):
+    def __init__(self, crowd, entities, pathfinder, destinations=DESTINATIONS, seed=None):
+        self.crowd = crowd
+        self.entities = entities
+        self.pathfinder = pathfinder
+        self.random = numpy.random.RandomState(seed)
+
+        x, y = crowd.places(destinations, crowd.bounds)
+        self.destinations = zip(x.tolist(), y.tolist())
+        for x, y in self.destinations:
+            # Start building their flow fields
+            pathfinder.requestFlowField(x, y)
+
+        # Entity ids of the NPCs waiting on a search
+        self.searching = set()
+
+    def tick(self, interval):
+        crowd = self.crowd
+        count = len(crowd)
+        if count:
+            wandering = numpy.flatnonzero(crowd.mode[:count] == Crowd.WANDER)
+            leaving = wandering[self.random.random_sample(len(wandering)) < interval / ERRAND_INTERVAL]
+            for entityId in crowd.ids[leaving].tolist():
+                self.send(entityId)
+        self.pathfinder.work(PATH_BUDGET)
+
+    def send(self, entityId):
+        if entityId in self.searching:
+            return
+        if self.random.random_sample() < SHARED:
+            x, y = self.destinations[self.random.randint(len(self.destinations))]
+            field = self.pathfinder.requestFlowField(x, y)
+            if field is not None:
+                self.crowd.follow(entityId, field)
+            return
+
+        if len(self.searching) >= MAX_SEARCHES:
+            return
+        fromX, fromY = self.entities.position(entityId)
+        minX, minY, maxX, maxY = self.crowd.bounds
+        toX = min(max(fromX + self.random.uniform(-ERRAND_RANGE, ERRAND_RANGE), minX), maxX)
+        toY = min(max(fromY + self.random.uniform(-ERRAND_RANGE, ERRAND_RANGE), minY), maxY)
+        self.searching.add(entityId)
+        self.pathfinder.requestPath(fromX, fromY, toX, toY, lambda waypoints: self.found(entityId, waypoints))
+
+    def found(self, entityId, waypoints):
+        self.searching.discard(entityId)
+        crowd = self.crowd
+        row = crowd.rows.get(entityId)
+        # Gone, or sent somewhere else meanwhile
+        if waypoints and row is not None and crowd.mode[row] == Crowd.WANDER:
+            crowd.travel(entityId, waypoints)
@@ -0,0 +1,64 @@
+import struct
+
+# Every packet on the wire is a header giving the payload length and the
+# packet opcode (see Messages), followed by that many bytes of payload.
+HEADER = struct.Struct("!HB")
+
+MAX_PAYLOAD = 0xFFFF
+
+class FrameError(Exception):
+    pass
+
+def encodeFrame(opcode, payload):
+    if len(payload) > MAX_PAYLOAD:
+        raise FrameError("payload of %d bytes is too long" % len(payload))
+    return HEADER.pack(len(payload), opcode) + payload
+
+class FrameDecoder(object):
+    """ Splits a byte stream back up into (opcode, payload) frames.
+
+    Each chunk of received data is parsed in a single pass, and the payloads
+    handed out are memoryviews into the chunk rather than copies.  Only a
+    frame which straddles two chunks gets copied, once it is complete. """
+
+    def __init__(self):
+        # The start of a frame which has not been completely received yet.
+        self.pending = ''
+
+    def feed(self, data):
+        frames = []
+        offset = 0
+        headerSize = HEADER.size
+
+        if self.pending:
+            pending = self.pending
+            if len(pending) < headerSize:
+                offset = headerSize - len(pending)
+                pending += data[:offset]
+                if len(pending) < headerSize:
+                    self.pending = pending
+                    return frames
+            length, opcode = HEADER.unpack_from(pending)
+            needed = headerSize + length - len(pending)
+            pending += data[offset:offset + needed]
+            offset += needed
+            if len(pending) < headerSize + length:
+                self.pending = pending
+                return frames
+            frames.append((opcode, memoryview(pending)[headerSize:]))
+            self.pending = ''
+
+        view = memoryview(data)
+        end = len(data)
+        unpack_from = HEADER.unpack_from
+        while end - offset >= headerSize:
+            length, opcode = unpack_from(data, offset)
+            stop = offset + headerSize + length
+            if stop > end:
+                break
+            frames.append((opcode, view[offset + headerSize:stop]))
+            offset = stop
+
+        if offset < end:
+            self.pending = data[offset:]
+        return frames
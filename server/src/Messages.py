@@ -1,11 +1,48 @@
 PACKET_LOGIN = 0x00
 PACKET_REGISTER = 0x01
 PACKET_CHAR_MOVE = 0x02
+PACKET_HELLO = 0x03
+PACKET_SNAPSHOT = 0x04
+PACKET_SNAPSHOT_ACK = 0x05
+PACKET_UDP_TOKEN = 0x06
+PACKET_LOGIN_QUEUED = 0x07
+PACKET_LOGIN_RETRY = 0x08
+PACKET_SAY = 0x09
+PACKET_CHAT = 0x0A
+
+# Payload layout of each packet: name, struct format (network byte order is
+# implied) and field names.  Packets builds its codec table from this.
+PACKET_SCHEMA = {
+    PACKET_LOGIN: ("Login", "32p32p", ("username", "password")),
+    PACKET_REGISTER: ("Register", "32p32p64p", ("username", "password", "email")),
+    PACKET_CHAR_MOVE: ("CharMove", "ii", ("x", "y")),
+    PACKET_HELLO: ("Hello", "I", ("capabilities",)),
+    PACKET_SNAPSHOT_ACK: ("SnapshotAck", "I", ("sequence",)),
+    PACKET_UDP_TOKEN: ("UdpToken", "QH", ("token", "port")),
+    PACKET_LOGIN_QUEUED: ("LoginQueued", "I", ("position",)),
+    PACKET_LOGIN_RETRY: ("LoginRetry", "H", ("retryAfter",)),
+    PACKET_SAY: ("Say", "128p", ("text",)),
+    PACKET_CHAT: ("Chat", "I128p", ("entityId", "text")),
+}
 
 CONTROL_LOGIN = 0x00
 CONTROL_REGISTER = 0x01
 CONTROL_DISCONNECT = 0x02
+CONTROL_FLUSH = 0x03
+CONTROL_PASSWORD_CHECKED = 0x04
+CONTROL_PASSWORD_HASHED = 0x05
 
 MANAGER_LOGGEDIN = 0x00
+MANAGER_QUEUED = 0x01
+MANAGER_REJECTED = 0x02
 
-CHAR_MOVE = 0x00
\ No newline at end of file
+# Between zone processes, see Zones
+ZONE_ENTER = 0x00
+ZONE_ROUTE = 0x01
+ZONE_MOVE = 0x02
+ZONE_SAY = 0x03
+ZONE_SNAPSHOT_ACK = 0x04
+ZONE_DELIVER = 0x05
+ZONE_LEAVE = 0x06
+ZONE_LEFT = 0x07
+ZONE_GHOSTS = 0x08
\ No newline at end of file
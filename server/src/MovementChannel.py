@@ -0,0 +1,121 @@
+#
+# Unreliable UDP side channel for character movement.
+#
+# Over TCP one lost segment holds up every position update behind it until
+# it has been retransmitted, yet only the newest position matters.  Once a
+# client has logged in over TCP it is sent a UdpToken packet holding a
+# random token and the UDP port to use, and may then send its moves as
+# datagrams:
+#
+#   token (Q), sequence number (I), x (i), y (i)
+#
+# The token ties a datagram to the logged in session, whatever address it
+# comes from.  Sequence numbers increase by one per move and wrap around,
+# and a datagram which is not newer than the last one accepted for the
+# session is stale and dropped.
+#
+
+import os, random, struct
+import stackless
+import socket
+
+import Timers
+
+DATAGRAM = struct.Struct("!QIii")
+
+def isNewer(sequence, previous):
+    """ Serial number comparison, so sequence numbers can wrap. """
+    return 0 < ((sequence - previous) & 0xFFFFFFFF) < 0x80000000
+
+class MovementSession(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.lastSequence = None
+        # Where the client's datagrams last came from
+        self.address = None
+
+class MovementChannel(object):
+    def __init__(self, address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.port = self.socket.getsockname()[1]
+
+        # token -> MovementSession
+        self.sessions = {}
+
+        self.delivered = 0
+        self.stale = 0
+        self.rejected = 0
+
+        stackless.tasklet(self.receive)()
+
+    def issueToken(self, connection):
+        while 1:
+            token = struct.unpack("!Q", os.urandom(8))[0]
+            if token not in self.sessions:
+                break
+        self.sessions[token] = MovementSession(connection)
+        return token
+
+    def revokeToken(self, token):
+        self.sessions.pop(token, None)
+
+    def receive(self):
+        while 1:
+            data, address = self.socket.recvfrom(512)
+            if len(data) != DATAGRAM.size:
+                self.rejected += 1
+                continue
+            token, sequence, x, y = DATAGRAM.unpack(data)
+            session = self.sessions.get(token)
+            if session is None:
+                self.rejected += 1
+                continue
+            if session.lastSequence is not None and not isNewer(sequence, session.lastSequence):
+                self.stale += 1
+                continue
+            session.lastSequence = sequence
+            session.address = address
+            self.delivered += 1
+            session.connection.packetCharMove(x, y)
+
+class MovementSender(object):
+    """ The client end: numbers moves and sends them as datagrams. """
+
+    def __init__(self, sock, token, address):
+        self.socket = sock
+        self.token = token
+        self.address = address
+        self.sequence = 0
+
+    def send(self, x, y):
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.socket.sendto_nowait(DATAGRAM.pack(self.token, self.sequence, x, y), self.address)
+
+class LossyLink(object):
+    """ Stands in for a socket when testing, dropping a fraction of the
+    datagrams sent through it and delaying the rest by a latency plus a
+    random jitter, which also reorders them. """
+
+    def __init__(self, sock, loss=0.0, latency=0.0, jitter=0.0, random=random.Random()):
+        self.socket = sock
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random
+        self.dropped = 0
+
+    def sendto_nowait(self, data, address):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return len(data)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            stackless.tasklet(self.sendLater)(delay, data, address)
+        else:
+            self.socket.sendto_nowait(data, address)
+        return len(data)
+
+    def sendLater(self, delay, data, address):
+        Timers.sleep(delay)
+        self.socket.sendto_nowait(data, address)
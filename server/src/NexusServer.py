@@ -1,31 +1,49 @@
-import sys, time
+import sys, os, time, select, signal, optparse, traceback
 import stackless
 
 import StacklessSocket
 #sys.modules["socket"] = stacklesssocket
 StacklessSocket.install()
 import socket
+import _socket
 
 import Connection
 import UserManager
+import SessionRegistry
+import MovementChannel
+import UserStore
+import Offload
+import Admission
+import World
+import Zones
+
+# Not all Python versions know the constant, this is its value on Linux.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
 
 class Server(object):
-    def __init__(self, conn):
+    def __init__(self, conn, reusePort=False, sessions=None, udpPort=None, backend=None, shards=1):
         # Create an INET, STREAMing socket
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Let every worker process bind its own listener to the same port,
+        # the kernel spreads incoming connections between them.
+        if reusePort:
+            self.serversocket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         # Bind the socket to an addres, and a port
         self.serversocket.bind(conn)
         # Become a server socket
-        self.serversocket.listen(5)
+        self.serversocket.listen(socket.SOMAXCONN)
         
-        control = stackless.channel()
+        # Moves can come in over UDP too, by default on the same port number
+        if udpPort is None:
+            udpPort = conn[1]
+        self.movement = MovementChannel.MovementChannel((conn[0], udpPort))
         
-        stackless.tasklet(self.acceptConnection)(control)
+        self.users = UserManager.UserShards(shards, sessions, backend)
         
-        UserManager.UserManager(control)
+        stackless.tasklet(self.acceptConnection)()
 
-    def acceptConnection(self, control):
+    def acceptConnection(self):
         while self.serversocket.accept:
             # Accept connections from outside
             (clientsocket, address) = self.serversocket.accept()
@@ -34,14 +52,200 @@ class Server(object):
             # In this case, each client is managed in a tasklet
             
             # Also activate the connection handler
-            Connection.Connection(clientsocket, address, control)
+            Connection.Connection(clientsocket, address, self.users, self.movement)
             # We don't track the clients until they are logged in now.
             #self.clients[clientsocket] = (address, Connection.Connection(clientsocket, address))
             
 
+def InstallSocketManager():
+    # Service sockets from epoll where the platform has it, rather than
+    # polling.  This has to happen in each worker process, as the epoll
+    # object would otherwise be shared between them.
+    if hasattr(select, "epoll"):
+        import EpollManager
+        EpollManager.install()
+
+def RunServer(conn, reusePort=False, sessions=None, udpPort=None, database=None, offload=0, shards=1, zone=None):
+    InstallSocketManager()
+    # Worker processes for password hashing and the like
+    if offload:
+        Offload.install(offload)
+    # Opened here rather than before forking, as an SQLite connection can't
+    # be shared between processes.
+    backend = None
+    if database:
+        kind, path = database
+        backend = UserStore.BACKENDS[kind](path)
+    if zone:
+        # This process only simulates its zone, and its NPCs stay in it
+        index, zoneMap, links = zone
+        World.BOUNDS = zoneMap.strip(index)
+    s = Server(conn, reusePort, sessions, udpPort, backend, shards)
+    if zone:
+        links = dict([ (other, StacklessSocket.wrap(link)) for other, link in links.items() ])
+        Zones.install(s.users.world, index, zoneMap, links)
+    try:
+        stackless.run()
+    finally:
+        s.users.close()
+        Offload.uninstall()
+
+def RunWorkers(conn, count, database=None, offload=0, shards=1):
+    # Logged in usernames are shared between the workers, so that nobody can
+    # log in to two of them at once.
+    sessions = SessionRegistry.SessionRegistry.create()
+    workers = {}
+
+    def StartWorker(index):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Datagrams can't be shared out by session like accepts
+                # are, so each worker has a UDP port of its own.
+                RunServer(conn, True, sessions, conn[1] + 1 + index, database, offload, shards)
+            except KeyboardInterrupt:
+                pass
+            except:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        print "Started worker %d (pid %d)" % (index, pid)
+        workers[pid] = index
+
+    def Shutdown(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, Shutdown)
+    try:
+        for index in range(count):
+            StartWorker(index)
+
+        while workers:
+            pid, status = os.wait()
+            index = workers.pop(pid, None)
+            if index is None:
+                continue
+            # Whoever was logged in to it is gone too.
+            sessions.releaseWorker(pid)
+            print "Worker %d (pid %d) exited with status %d, restarting" % (index, pid, status)
+            # Don't spin if it can't start at all.
+            time.sleep(1)
+            StartWorker(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sessions.destroy()
+
+def RunZones(conn, count, database=None, offload=0, shards=1):
+    # A process per zone, which like a worker also serves the clients the
+    # kernel gives it.
+    sessions = SessionRegistry.SessionRegistry.create()
+    zoneMap = Zones.ZoneMap(count)
+    # Each zone is linked to every other one by a socket pair.  These are
+    # real sockets, each zone wraps its own ends once it is running.
+    links = {}
+    for i in range(count):
+        for j in range(i + 1, count):
+            links[i, j], links[j, i] = _socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Each zone's share of the NPCs
+    World.NPCS //= count
+    zones = {}
+
+    def Shutdown(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, Shutdown)
+    try:
+        for index in range(count):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for (i, j), link in links.items():
+                        if i != index:
+                            link.close()
+                    ours = dict([ (j, link) for (i, j), link in links.items() if i == index ])
+                    RunServer(conn, True, sessions, conn[1] + 1 + index, database, offload, shards,
+                              (index, zoneMap, ours))
+                except KeyboardInterrupt:
+                    pass
+                except:
+                    traceback.print_exc()
+                    os._exit(1)
+                os._exit(0)
+            print "Started zone %d (pid %d), x from %.0f to %.0f" % ((index, pid) + zoneMap.strip(index)[0::2])
+            zones[pid] = index
+        for link in links.values():
+            link.close()
+
+        # The links can't be made again for a new process, so unlike workers
+        # zones aren't restarted; losing one takes the whole world down.
+        pid, status = os.wait()
+        print "Zone %d (pid %d) exited with status %d, shutting down" % (zones.pop(pid), pid, status)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in zones:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sessions.destroy()
+
 if __name__ == "__main__":
-    host = "127.0.0.1"
-    port = 7566
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=7566)
+    parser.add_option("--workers", type="int", default=1,
+                      help="number of server processes sharing the port")
+    parser.add_option("--db", default="users.db",
+                      help="where registered users are stored")
+    parser.add_option("--db-format", dest="dbFormat", default="sqlite",
+                      choices=UserStore.BACKENDS.keys(),
+                      help="sqlite, or log (a single process only)")
+    parser.add_option("--offload", type="int", default=2,
+                      help="processes for password hashing, per server process")
+    parser.add_option("--shards", type="int", default=1,
+                      help="user manager tasklets, per server process")
+    parser.add_option("--max-logins", dest="maxLogins", type="int", default=Admission.MAX_IN_FLIGHT,
+                      help="logins checked at once per shard, the rest are queued")
+    parser.add_option("--login-queue", dest="loginQueue", type="int", default=Admission.MAX_QUEUED,
+                      help="queued logins per shard before turning more away")
+    parser.add_option("--tick-rate", dest="tickRate", type="int", default=World.TICK_RATE,
+                      help="world ticks a second")
+    parser.add_option("--terrain", default=None,
+                      help="terrain file from TerrainBaker to check moves against")
+    parser.add_option("--npcs", type="int", default=World.NPCS,
+                      help="wandering NPCs to populate the world with")
+    parser.add_option("--zones", type="int", default=1,
+                      help="split the world into this many zone processes")
+    options, args = parser.parse_args()
+
+    host = options.host
+    port = options.port
     print "Starting up server on IP:port %s:%s" % (host, port)
-    s = Server((host,port))
-    stackless.run()
\ No newline at end of file
+    database = (options.dbFormat, options.db)
+    Admission.MAX_IN_FLIGHT = options.maxLogins
+    Admission.MAX_QUEUED = options.loginQueue
+    World.TICK_RATE = options.tickRate
+    World.NPCS = options.npcs
+    if options.terrain:
+        # Mapped before forking, so workers share the pages
+        import Terrain
+        World.TERRAIN = Terrain.load(options.terrain)
+    if options.zones > 1:
+        if options.workers > 1:
+            parser.error("zones are server processes themselves, use one or the other")
+        if options.dbFormat != "sqlite":
+            parser.error("only the sqlite user store can be shared by zones")
+        RunZones((host,port), options.zones, database, options.offload, options.shards)
+    elif options.workers > 1:
+        if options.dbFormat != "sqlite":
+            parser.error("only the sqlite user store can be shared by workers")
+        RunWorkers((host,port), options.workers, database, options.offload, options.shards)
+    else:
+        RunServer((host,port), database=database, offload=options.offload, shards=options.shards)
@@ -0,0 +1,130 @@
+#
+# Running blocking or CPU heavy calls off the scheduler thread.
+#
+# call(function, *args) hands the call to a pool of worker processes or
+# threads and blocks only the calling tasklet until the result is back,
+# while the rest keep running.  Pool threads can't touch stackless channels,
+# so a finished call is queued and a byte written to a pipe, and whoever
+# drives the scheduler calls wakeCompleted() to pass results back to the
+# waiting tasklets.  The epoll manager watches the pipe (wakeupFd()) so it
+# notices straight away, the stock manager at its next poll.
+#
+# Uses concurrent.futures where it is available, multiprocessing's pools
+# otherwise.  Until install() is called, call() just runs the function.
+# For a process pool the function and its arguments must be picklable.
+#
+
+import os, fcntl, collections
+import stackless
+
+try:
+    import concurrent.futures as futures
+except ImportError:
+    futures = None
+
+# The installed pool, and the pipe and queue finished calls come back on
+_pool = None
+_wakeupRead = _wakeupWrite = None
+_completed = collections.deque()
+_pending = 0
+
+def _invoke(function, args):
+    # Errors are returned rather than raised, as multiprocessing has no
+    # way to pass them to the callback.
+    try:
+        return True, function(*args)
+    except Exception, err:
+        return False, err
+
+def install(workers, processes=True):
+    global _pool, _wakeupRead, _wakeupWrite
+    if _pool is not None:
+        raise StandardError("Already installed")
+
+    if futures:
+        if processes:
+            _pool = futures.ProcessPoolExecutor(workers)
+        else:
+            _pool = futures.ThreadPoolExecutor(workers)
+    else:
+        import multiprocessing.pool
+        if processes:
+            _pool = multiprocessing.pool.Pool(workers)
+        else:
+            _pool = multiprocessing.pool.ThreadPool(workers)
+
+    _wakeupRead, _wakeupWrite = os.pipe()
+    for fd in (_wakeupRead, _wakeupWrite):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def uninstall():
+    global _pool, _wakeupRead, _wakeupWrite
+    if _pool is None:
+        return
+    if futures:
+        _pool.shutdown()
+    else:
+        _pool.close()
+        _pool.join()
+    os.close(_wakeupRead)
+    os.close(_wakeupWrite)
+    _pool = _wakeupRead = _wakeupWrite = None
+
+def wakeupFd():
+    """ Readable when there are finished calls to collect, None when no
+    pool is installed. """
+    return _wakeupRead
+
+def pending():
+    return _pending
+
+def _finished(channel, outcome):
+    # Called on a pool thread.
+    _completed.append((channel, outcome))
+    try:
+        os.write(_wakeupWrite, "x")
+    except OSError:
+        # The pipe is full, so a wake up is on its way already.
+        pass
+
+def _futureDone(channel, future):
+    try:
+        outcome = future.result()
+    except Exception, err:
+        # Such as the arguments not pickling.
+        outcome = False, err
+    _finished(channel, outcome)
+
+def call(function, *args):
+    global _pending
+    if _pool is None:
+        return function(*args)
+
+    channel = stackless.channel()
+    _pending += 1
+    try:
+        if futures:
+            future = _pool.submit(_invoke, function, args)
+            future.add_done_callback(lambda future: _futureDone(channel, future))
+        else:
+            _pool.apply_async(_invoke, (function, args), callback=lambda outcome: _finished(channel, outcome))
+        succeeded, result = channel.receive()
+    finally:
+        _pending -= 1
+    if not succeeded:
+        raise result
+    return result
+
+def wakeCompleted():
+    if _wakeupRead is None:
+        return
+    try:
+        while os.read(_wakeupRead, 4096):
+            pass
+    except OSError:
+        pass
+    while _completed:
+        channel, outcome = _completed.popleft()
+        # Make it runnable without switching to it.
+        channel.preference = 1
+        channel.send(outcome)
@@ -0,0 +1,40 @@
+import struct
+
+import Messages
+import Framing
+
+class PacketType(object):
+    """ The payload layout of one kind of packet, with a precompiled Struct
+    to decode it and to encode outgoing packets of the same kind. """
+
+    def __init__(self, opcode, name, format, fields):
+        self.opcode = opcode
+        self.name = name
+        self.struct = struct.Struct("!" + format)
+        self.fields = fields
+
+    def decode(self, payload):
+        return self.struct.unpack(payload)
+
+    def encode(self, *values):
+        return Framing.encodeFrame(self.opcode, self.struct.pack(*values))
+
+# Packet types indexed by opcode, None where there is no such packet, and
+# by name for building outgoing packets.
+PACKETS = [ None ] * 256
+BY_NAME = {}
+# The payload decoding functions alone, indexed by opcode, for the hot path.
+DECODERS = [ None ] * 256
+
+for opcode, (name, format, fields) in Messages.PACKET_SCHEMA.iteritems():
+    PACKETS[opcode] = BY_NAME[name] = PacketType(opcode, name, format, fields)
+    DECODERS[opcode] = PACKETS[opcode].struct.unpack
+
+def dispatchTable(handler, prefix="packet"):
+    """ Map opcodes to the bound methods of handler which handle them, by
+    name.  The CharMove packet is handled by handler.packetCharMove(x, y). """
+    table = [ None ] * len(PACKETS)
+    for opcode, packetType in enumerate(PACKETS):
+        if packetType is not None:
+            table[opcode] = getattr(handler, prefix + packetType.name, None)
+    return table
@@ -0,0 +1,31 @@
+#
+# Password hashing.
+#
+# Passwords are stored as "pbkdf2_sha256$iterations$salt$hash", salt and
+# hash in hex.  Hashing is deliberately slow, so UserManager runs these
+# through Offload rather than on the scheduler thread.  Users registered
+# before passwords were hashed still have theirs in plain text; they are
+# checked as such and rehashed once they log in (see needsRehash()).
+#
+
+import os, hashlib, hmac
+
+SCHEME = "pbkdf2_sha256"
+ITERATIONS = 100000
+SALT_SIZE = 16
+
+def hashPassword(password, iterations=ITERATIONS):
+    salt = os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac("sha256", password, salt, iterations)
+    return "%s$%d$%s$%s" % (SCHEME, iterations, salt.encode("hex"), digest.encode("hex"))
+
+def checkPassword(password, stored):
+    parts = stored.split("$")
+    if len(parts) != 4 or parts[0] != SCHEME:
+        return hmac.compare_digest(password, stored)
+    scheme, iterations, salt, digest = parts
+    return hmac.compare_digest(hashlib.pbkdf2_hmac("sha256", password, salt.decode("hex"), int(iterations)).encode("hex"), digest)
+
+def needsRehash(stored):
+    parts = stored.split("$")
+    return len(parts) != 4 or parts[0] != SCHEME or int(parts[1]) != ITERATIONS
@@ -0,0 +1,495 @@
+#
+# Paths across the terrain for NPCs.
+#
+# Searching is done on a navigation grid coarser than the Terrain's, each
+# nav cell covering scale by scale terrain cells.  A nav cell is open when
+# all of its terrain cells are walkable and none of them is more than the
+# terrain's max step above or below any of its neighbours, so that nothing
+# moving across open cells is turned back by Terrain.validateMoves().  A
+# step to one of its eight neighbours is allowed when both are open and
+# (going diagonally) neither cell beside the step is closed, so paths
+# don't cut corners.  The allowed steps of every cell are worked out with
+# array operations up front and kept as a bitmask per cell, which the
+# searches look up.
+#
+# The grid's connected regions are labelled when it is built, so asking for
+# a path to somewhere that can't be reached costs nothing.  Otherwise
+# findPath() runs A* and caches the result under the start and goal cells,
+# keeping the most recently used.  Many NPCs heading for the same place
+# don't each need a search though: once a goal cell has been asked for
+# POPULAR times, a FlowField is built for it, telling every cell which way
+# to go, and paths to it are read off that.  Flow fields are cached the
+# same way.
+#
+# A flow field is spread out from its goal a ring of cells at a time with
+# array operations.  Within it every step counts the same, diagonal or not,
+# and straight steps are tried first, so its paths go straight and then
+# diagonally rather than zigzag; they are as short as A*'s in the open, if
+# not always around obstacles.
+#
+# A search or a flood can take tens of milliseconds, too long to do in the
+# middle of a world tick.  requestPath() and requestFlowField() answer
+# straight away from the caches when they can, and otherwise queue the work,
+# which work() gets on with a little at a time for as long as it is given.
+# A Search stops to look at the clock every SLICE cells it takes from the
+# queue, a Flood after every ring.
+#
+# Everything cached is thrown away when the terrain's walkability changes
+# (see Terrain.setWalkable()), and the nav grid rebuilt; queued work starts
+# again on the new one.  Flow fields handed out before then know they are
+# out of date, and current() gives a new one to the same goal once it has
+# been built.
+#
+
+import math, time, heapq, collections
+import numpy
+
+import Terrain
+
+# Requests for a goal cell after which it gets a flow field
+POPULAR = 8
+
+SQRT2 = math.sqrt(2.0)
+
+# (row, column) of each of the eight steps, straight ones first
+STEPS = [ (0, 1), (1, 0), (0, -1), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1) ]
+
+# What a cached search found nothing for
+NO_PATH = ()
+
+# Cells a Search expands between looking at the clock
+SLICE = 64
+
+class FlowField(object):
+    """ Which way to go from every nav cell to reach one goal cell. """
+
+    def __init__(self, pathfinder, goal, following, distance, version):
+        self.pathfinder = pathfinder
+        self.goal = goal
+        # The terrain's version when it was built
+        self.version = version
+        # Nav cell to step to next, the goal for itself, -1 if unreachable
+        self.following = following
+        # How many steps each cell is from the goal, inf if unreachable
+        self.distance = distance
+
+    def current(self):
+        """ This field, or a new one to the same goal if the terrain has
+        changed since it was built and the new one is ready. """
+        pathfinder = self.pathfinder
+        if self.version == pathfinder.terrain.version:
+            return self
+        return pathfinder.requestFlowField(*pathfinder.centre(self.goal)) or self
+
+    def path(self, start):
+        """ Nav cells from start to the goal, or None. """
+        following = self.following
+        if following[start] < 0:
+            return None
+        cells = [ start ]
+        while start != self.goal:
+            start = int(following[start])
+            cells.append(start)
+        return cells
+
+    def steer(self, x, y):
+        """ For arrays of positions, the centres of the nav cells to head
+        for next, which of them can reach the goal at all and which are
+        already in the goal cell. """
+        cells, inside = self.pathfinder.cellsOf(x, y)
+        following = self.following[cells]
+        reachable = inside & (following >= 0)
+        following[~reachable] = cells[~reachable]
+        targetX, targetY = self.pathfinder.centres(following)
+        return targetX, targetY, reachable, reachable & (cells == self.goal)
+
+class Search(object):
+    """ A* from one nav cell to another, a bit at a time: advance() until
+    it returns True, when cells holds the cells on the way, or None. """
+
+    def __init__(self, pathfinder, start, goal):
+        self.pathfinder = pathfinder
+        self.start = start
+        self.goal = goal
+        self.reset()
+
+    def reset(self):
+        start = self.start
+        self.version = self.pathfinder.version
+        self.cost = { start: 0.0 }
+        self.previous = { start: -1 }
+        # Costs go in negated, so of equally promising cells the one
+        # furthest along comes first
+        self.queue = [ (0.0, 0.0, start) ]
+        self.cells = None
+
+    def advance(self, deadline=None):
+        """ Searches until done, or until time.time() passes deadline,
+        returning whether it is done. """
+        pathfinder = self.pathfinder
+        if self.version != pathfinder.version:
+            # Start again on the new nav grid
+            self.reset()
+        masks = pathfinder.masks
+        steps = pathfinder.steps
+        columns = pathfinder.columns
+        goal = self.goal
+        goalRow, goalColumn = divmod(goal, columns)
+        cost = self.cost
+        previous = self.previous
+        queue = self.queue
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        expanded = 0
+        while queue:
+            if deadline is not None:
+                expanded += 1
+                if expanded == SLICE:
+                    if time.time() >= deadline:
+                        return False
+                    expanded = 0
+            estimate, spent, cell = heappop(queue)
+            spent = -spent
+            if cell == goal:
+                cells = []
+                while cell >= 0:
+                    cells.append(cell)
+                    cell = previous[cell]
+                cells.reverse()
+                self.cells = cells
+                break
+            if spent > cost[cell]:
+                continue
+            for offset, step in steps[masks[cell]]:
+                neighbour = cell + offset
+                total = spent + step
+                if total < cost.get(neighbour, total + 1.0):
+                    cost[neighbour] = total
+                    previous[neighbour] = cell
+                    # Octile distance, exact on an open grid
+                    row, column = divmod(neighbour, columns)
+                    dr = abs(row - goalRow)
+                    dc = abs(column - goalColumn)
+                    if dr < dc:
+                        dr, dc = dc, dr
+                    heappush(queue, (total + dr + (SQRT2 - 1.0) * dc, -total, neighbour))
+        self.queue = []
+        self.cost = self.previous = None
+        return True
+
+class Flood(object):
+    """ Spreads out from the goal over all it can reach, a ring of cells
+    at a time.  Steps are the same both ways, so the cell each one was
+    reached from is its way back.  advance() until it returns True, when
+    following holds, for every cell, that cell (the goal for itself, -1 if
+    unreachable) and distance how many steps away the goal is (inf if
+    unreachable). """
+
+    def __init__(self, pathfinder, goal):
+        self.pathfinder = pathfinder
+        self.goal = goal
+        self.reset()
+
+    def reset(self):
+        pathfinder = self.pathfinder
+        goal = self.goal
+        self.version = pathfinder.version
+        size = len(pathfinder.maskArray)
+        self.following = numpy.empty(size, numpy.intp)
+        self.following.fill(-1)
+        self.distance = numpy.empty(size)
+        self.distance.fill(numpy.inf)
+        self.following[goal] = goal
+        self.distance[goal] = 0.0
+        self.ring = numpy.array([ goal ], numpy.intp)
+        self.steps = 0
+
+    def advance(self, deadline=None):
+        """ Spreads until done, or until time.time() passes deadline,
+        returning whether it is done. """
+        pathfinder = self.pathfinder
+        if self.version != pathfinder.version:
+            self.reset()
+        masks = pathfinder.maskArray
+        offsets = pathfinder.offsets
+        following = self.following
+        distance = self.distance
+        ring = self.ring
+        steps = self.steps
+        while len(ring):
+            steps += 1
+            reached = []
+            ringMasks = masks[ring]
+            for bit, offset in enumerate(offsets):
+                cells = ring[(ringMasks & (1 << bit)) != 0]
+                neighbours = cells + offset
+                unseen = following[neighbours] < 0
+                neighbours = neighbours[unseen]
+                following[neighbours] = cells[unseen]
+                distance[neighbours] = steps
+                reached.append(neighbours)
+            ring = numpy.unique(numpy.concatenate(reached))
+            if deadline is not None and time.time() >= deadline:
+                break
+        self.ring = ring
+        self.steps = steps
+        return not len(ring)
+
+class Pathfinder(object):
+    def __init__(self, terrain, scale=4, cacheSize=4096, flowFields=16):
+        self.terrain = terrain
+        self.scale = scale
+        self.cacheSize = cacheSize
+        self.flowFieldCount = flowFields
+        self.version = None
+        # (Search or Flood, what to call with it once it's done) for work()
+        self.pending = collections.deque()
+        # Goal cells of the queued floods
+        self.building = set()
+        self.build()
+
+    def build(self):
+        """ Derives the nav grid from the terrain and forgets all cached
+        paths and flow fields. """
+        terrain = self.terrain
+        scale = self.scale
+        self.version = terrain.version
+        self.cellSize = terrain.cellSize * scale
+        self.originX = terrain.originX
+        self.originY = terrain.originY
+
+        # Terrain cells which can be walked on and off in every direction
+        good = (terrain.flags & Terrain.WALKABLE) != 0
+        heights = numpy.pad(terrain.heights, 1, "edge")
+        for dr, dc in STEPS:
+            neighbour = heights[1 + dr:terrain.rows + 1 + dr, 1 + dc:terrain.columns + 1 + dc]
+            good &= numpy.abs(neighbour - terrain.heights) <= terrain.maxStep
+
+        # Pad the terrain to whole nav cells, the padding closed
+        rows = -(-terrain.rows // scale)
+        columns = -(-terrain.columns // scale)
+        walkable = numpy.zeros((rows * scale, columns * scale), bool)
+        walkable[:terrain.rows, :terrain.columns] = good
+
+        # A ring of closed cells round the edge, so steps never wrap around
+        self.rows = rows + 2
+        self.columns = columns + 2
+        passable = numpy.zeros((self.rows, self.columns), bool)
+        passable[1:-1, 1:-1] = walkable.reshape(rows, scale, columns, scale).all(axis=(1, 3))
+        self.passable = passable
+
+        def shifted(array, dr, dc):
+            # array[r + dr, c + dc] at [r, c], inside the ring
+            return array[1 + dr:self.rows - 1 + dr, 1 + dc:self.columns - 1 + dc]
+
+        masks = numpy.zeros((self.rows, self.columns), numpy.uint8)
+        inner = masks[1:-1, 1:-1]
+        here = shifted(passable, 0, 0)
+        for bit, (dr, dc) in enumerate(STEPS):
+            allowed = here & shifted(passable, dr, dc)
+            if dr and dc:
+                allowed &= shifted(passable, dr, 0) & shifted(passable, 0, dc)
+            inner |= allowed.astype(numpy.uint8) << bit
+        self.maskArray = masks.ravel()
+        self.masks = self.maskArray.tolist()
+
+        # The steps each mask allows, as (index offset, cost)
+        self.offsets = [ dr * self.columns + dc for dr, dc in STEPS ]
+        costs = [ dr and dc and SQRT2 or 1.0 for dr, dc in STEPS ]
+        self.steps = [ tuple((self.offsets[bit], costs[bit]) for bit in xrange(8) if mask & (1 << bit))
+                       for mask in xrange(256) ]
+
+        # Region of each cell, cells in different ones can't reach each
+        # other.  Cells with no way out at all are left as -1.
+        regions = numpy.empty(len(self.maskArray), numpy.int32)
+        regions.fill(-1)
+        for cell in numpy.flatnonzero(self.maskArray).tolist():
+            if regions[cell] < 0:
+                following, distance = self.flood(cell)
+                regions[following >= 0] = cell
+        self.regions = regions.tolist()
+
+        self.paths = collections.OrderedDict()
+        self.flowFields = collections.OrderedDict()
+        self.requests = collections.defaultdict(int)
+
+    def current(self):
+        if self.terrain.version != self.version:
+            self.build()
+
+    def cellOf(self, x, y):
+        """ The nav cell x, y is in, or None if off the grid. """
+        column = int(math.floor((x - self.originX) / self.cellSize)) + 1
+        row = int(math.floor((y - self.originY) / self.cellSize)) + 1
+        if 0 < column < self.columns - 1 and 0 < row < self.rows - 1:
+            return row * self.columns + column
+        return None
+
+    def cellsOf(self, x, y):
+        """ cellOf() for arrays of positions, with which are on the grid;
+        those which aren't get cell 0. """
+        column = numpy.floor((numpy.asarray(x, numpy.float64) - self.originX) / self.cellSize).astype(numpy.intp) + 1
+        row = numpy.floor((numpy.asarray(y, numpy.float64) - self.originY) / self.cellSize).astype(numpy.intp) + 1
+        inside = (column > 0) & (column < self.columns - 1) & (row > 0) & (row < self.rows - 1)
+        cells = row * self.columns + column
+        cells[~inside] = 0
+        return cells, inside
+
+    def centre(self, cell):
+        row, column = divmod(cell, self.columns)
+        return (self.originX + (column - 0.5) * self.cellSize,
+                self.originY + (row - 0.5) * self.cellSize)
+
+    def centres(self, cells):
+        row = cells // self.columns
+        column = cells % self.columns
+        return (self.originX + (column - 0.5) * self.cellSize,
+                self.originY + (row - 0.5) * self.cellSize)
+
+    def findPath(self, fromX, fromY, toX, toY):
+        """ Waypoints from one position to another, ending with the latter,
+        or None if there is no way there. """
+        self.current()
+        start = self.cellOf(fromX, fromY)
+        goal = self.cellOf(toX, toY)
+        if start is None or goal is None:
+            return None
+
+        key = (start, goal)
+        cells = self.paths.pop(key, None)
+        if cells is None:
+            self.requests[goal] += 1
+            field = self.flowFields.get(goal)
+            if field is None and self.requests[goal] >= POPULAR:
+                field = self.flowField(toX, toY)
+            if not self.connected(start, goal):
+                cells = None
+            elif field is not None:
+                cells = field.path(start)
+            else:
+                cells = self.search(start, goal)
+            if cells is None:
+                cells = NO_PATH
+            if len(self.paths) >= self.cacheSize:
+                self.paths.popitem(last=False)
+        self.paths[key] = cells
+        return self.waypoints(cells, toX, toY)
+
+    def requestPath(self, fromX, fromY, toX, toY, callback):
+        """ findPath() without searching there and then: callback gets
+        what findPath() would have returned, straight away if that's known
+        already, otherwise once work() has done the search. """
+        self.current()
+        start = self.cellOf(fromX, fromY)
+        goal = self.cellOf(toX, toY)
+        if start is None or goal is None or not self.connected(start, goal):
+            callback(None)
+        elif (start, goal) in self.paths or goal in self.flowFields:
+            callback(self.findPath(fromX, fromY, toX, toY))
+        else:
+            self.requests[goal] += 1
+            if self.requests[goal] >= POPULAR:
+                # For those asking after this one
+                self.requestFlowField(toX, toY)
+            self.pending.append((Search(self, start, goal),
+                                 lambda search: self.searched(search, toX, toY, callback)))
+
+    def searched(self, search, toX, toY, callback):
+        cells = search.cells
+        if cells is None:
+            cells = NO_PATH
+        key = (search.start, search.goal)
+        if key not in self.paths and len(self.paths) >= self.cacheSize:
+            self.paths.popitem(last=False)
+        self.paths[key] = cells
+        callback(self.waypoints(cells, toX, toY))
+
+    def connected(self, start, goal):
+        """ Whether there is any way from one nav cell to the other. """
+        regions = self.regions
+        return start == goal or (regions[start] >= 0 and regions[start] == regions[goal])
+
+    def waypoints(self, cells, toX, toY):
+        if cells is NO_PATH:
+            return None
+        waypoints = [ self.centre(cell) for cell in self.straighten(cells) ]
+        waypoints[-1] = (toX, toY)
+        return waypoints
+
+    def flowField(self, toX, toY):
+        """ The FlowField to the nav cell toX, toY is in, or None if that's
+        off the grid. """
+        self.current()
+        goal = self.cellOf(toX, toY)
+        if goal is None:
+            return None
+        field = self.flowFields.pop(goal, None)
+        if field is None:
+            following, distance = self.flood(goal)
+            field = FlowField(self, goal, following, distance, self.version)
+            if len(self.flowFields) >= self.flowFieldCount:
+                self.flowFields.popitem(last=False)
+        self.flowFields[goal] = field
+        return field
+
+    def requestFlowField(self, toX, toY):
+        """ The FlowField to the nav cell toX, toY is in if it has been
+        built, otherwise None, and unless that's off the grid the field is
+        queued for work() to build. """
+        self.current()
+        goal = self.cellOf(toX, toY)
+        if goal is None:
+            return None
+        field = self.flowFields.pop(goal, None)
+        if field is not None:
+            self.flowFields[goal] = field
+        elif goal not in self.building:
+            self.building.add(goal)
+            self.pending.append((Flood(self, goal), self.built))
+        return field
+
+    def built(self, flood):
+        goal = flood.goal
+        self.building.discard(goal)
+        if goal not in self.flowFields and len(self.flowFields) >= self.flowFieldCount:
+            self.flowFields.popitem(last=False)
+        self.flowFields[goal] = FlowField(self, goal, flood.following, flood.distance, self.version)
+
+    def work(self, budget):
+        """ Gets on with the queued searches and floods for about budget
+        seconds at most, returning how many are still to do. """
+        self.current()
+        deadline = time.time() + budget
+        pending = self.pending
+        while pending:
+            task, finish = pending[0]
+            if not task.advance(deadline):
+                break
+            pending.popleft()
+            finish(task)
+            if time.time() >= deadline:
+                break
+        return len(pending)
+
+    def straighten(self, cells):
+        """ Only the cells where the path changes direction, and its ends. """
+        if len(cells) < 3:
+            return cells
+        kept = [ cells[0] ]
+        for i in xrange(1, len(cells) - 1):
+            if cells[i] - cells[i - 1] != cells[i + 1] - cells[i]:
+                kept.append(cells[i])
+        kept.append(cells[-1])
+        return kept
+
+    def search(self, start, goal):
+        """ A* from one nav cell to another, the cells on the way or None. """
+        search = Search(self, start, goal)
+        search.advance()
+        return search.cells
+
+    def flood(self, goal):
+        """ Every cell's way to the goal and distance from it, see Flood. """
+        flood = Flood(self, goal)
+        flood.advance()
+        return flood.following, flood.distance
@@ -0,0 +1,57 @@
+import os, errno, hashlib, shutil, tempfile
+
+class SessionRegistry(object):
+    """ Usernames logged in across all the worker processes of a server.
+
+    Each session is a file named after a hash of the username, in a
+    directory shared by the workers.  It is created with O_EXCL so only one
+    worker can claim a name, and holds the claiming worker's pid so that
+    the sessions of a worker which dies can be released. """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls):
+        # Prefer shared memory so that logins never touch the disk.
+        if os.path.isdir("/dev/shm"):
+            root = "/dev/shm"
+        else:
+            root = None
+        return cls(tempfile.mkdtemp(prefix="nexus-sessions-", dir=root))
+
+    def destroy(self):
+        shutil.rmtree(self.path, True)
+
+    def sessionPath(self, username):
+        return os.path.join(self.path, hashlib.sha1(username).hexdigest())
+
+    def claim(self, username):
+        try:
+            fd = os.open(self.sessionPath(username), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        except OSError, err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            os.write(fd, str(os.getpid()))
+        finally:
+            os.close(fd)
+        return True
+
+    def release(self, username):
+        try:
+            os.unlink(self.sessionPath(username))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def releaseWorker(self, pid):
+        pid = str(pid)
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if open(path).read() == pid:
+                    os.unlink(path)
+            except (IOError, OSError):
+                pass
@@ -0,0 +1,262 @@
+#
+# Delta-compressed world snapshots.
+#
+# Every replication tick is a numbered snapshot, sending each client the
+# quantized state of the entities around it.  Each client acknowledges the
+# snapshots it receives, and is sent the next one as a delta against the
+# latest snapshot it acknowledged (its baseline), so entities which have
+# not changed since then cost nothing at all.  A client with no usable
+# baseline is sent everything relative to an empty world.
+#
+# A client is only sent the entities within INTEREST_RADIUS of its
+# character, found with the world's SpatialGrid, and only those are ever
+# quantized, so what a tick costs and what it sends depend on how crowded
+# the clients' surroundings are rather than on the population of the whole
+# world.  Entities going out of range are removed on the client as if they
+# were gone.  Each client remembers what it was sent in each of its last
+# few snapshots, which are its baselines; the world keeps no copy of its
+# own.
+#
+# However crowded it is, a packet carries at most MAX_ENTRIES changes, so
+# that it fits in a frame.  When there are more, the ones nearest the
+# client go first and the rest are left for the following snapshots.
+#
+# Snapshot packet payload:
+#
+#   header        sequence (I), baseline sequence or 0 (I), entry count (H)
+#   masks         4 bits per entry, two entries per byte, low nibble first
+#   entity ids    varint, each the difference from the previous entry's id
+#   field values  zigzag varints, for each entry in turn its changed fields
+#
+# Entries are in entity id order.  Mask bits say which fields follow, and
+# whether the entity is new (the values are absolute) or has been removed
+# (nothing follows).  Otherwise values are differences from the baseline.
+#
+
+import struct, collections
+
+import Messages
+import Framing
+
+HEADER = struct.Struct("!IIH")
+
+# Positions are sent in fixed point with this many steps per world unit.
+POSITION_SCALE = 16
+
+# How far from its character a client is sent entities, in world units
+INTEREST_RADIUS = 256.0
+
+# Most entries in one packet.  Even at 5 bytes for every varint that is
+# 15.5 bytes an entry, which keeps the payload within Framing.MAX_PAYLOAD.
+MAX_ENTRIES = 4096
+
+MASK_X = 0x1
+MASK_Y = 0x2
+MASK_NEW = 0x4
+MASK_REMOVED = 0x8
+
+def quantize(value):
+    return int(round(value * POSITION_SCALE))
+
+def _writeVarint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _writeSigned(out, value):
+    # Zigzag, so that small negative differences stay small too.
+    if value < 0:
+        _writeVarint(out, (-value << 1) - 1)
+    else:
+        _writeVarint(out, value << 1)
+
+def _readVarint(data, offset):
+    value = 0
+    shift = 0
+    while 1:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def _readSigned(data, offset):
+    value, offset = _readVarint(data, offset)
+    if value & 1:
+        return -((value + 1) >> 1), offset
+    return value >> 1, offset
+
+class SnapshotHistory(object):
+    """ The sequence numbers of the last few snapshots. """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.sequence = 0
+        self.recent = collections.deque()
+
+    def advance(self):
+        """ Numbers a new snapshot, returning its sequence. """
+        self.sequence += 1
+        self.recent.append(self.sequence)
+        if len(self.recent) > self.size:
+            self.recent.popleft()
+        return self.sequence
+
+    def __contains__(self, sequence):
+        return sequence in self.recent
+
+def encodeDelta(sequence, state, baselineSequence, baseline):
+    """ The payload taking a client from baseline to state. """
+    masks = bytearray()
+    ids = bytearray()
+    values = bytearray()
+    count = 0
+    previousId = 0
+
+    for entityId in sorted(set(state) | set(baseline)):
+        current = state.get(entityId)
+        previous = baseline.get(entityId)
+        if current is None:
+            mask = MASK_REMOVED
+        elif previous is None:
+            mask = MASK_NEW | MASK_X | MASK_Y
+            _writeSigned(values, current[0])
+            _writeSigned(values, current[1])
+        else:
+            mask = 0
+            if current[0] != previous[0]:
+                mask |= MASK_X
+                _writeSigned(values, current[0] - previous[0])
+            if current[1] != previous[1]:
+                mask |= MASK_Y
+                _writeSigned(values, current[1] - previous[1])
+            if not mask:
+                continue
+
+        if count & 1:
+            masks[-1] |= mask << 4
+        else:
+            masks.append(mask)
+        _writeVarint(ids, entityId - previousId)
+        previousId = entityId
+        count += 1
+
+    return HEADER.pack(sequence, baselineSequence, count) + str(masks) + str(ids) + str(values)
+
+def decodeDelta(payload, baseline):
+    """ Apply a snapshot payload to the baseline it was encoded against,
+    returning (sequence, baseline sequence, new state). """
+    sequence, baselineSequence, count = HEADER.unpack_from(payload)
+    data = bytearray(payload)
+    masksOffset = HEADER.size
+    offset = masksOffset + (count + 1) // 2
+
+    entityIds = []
+    entityId = 0
+    for i in xrange(count):
+        difference, offset = _readVarint(data, offset)
+        entityId += difference
+        entityIds.append(entityId)
+
+    state = dict(baseline)
+    for i, entityId in enumerate(entityIds):
+        mask = (data[masksOffset + i // 2] >> ((i & 1) * 4)) & 0xF
+        if mask & MASK_REMOVED:
+            state.pop(entityId, None)
+            continue
+        if mask & MASK_NEW:
+            x = y = 0
+        else:
+            x, y = state[entityId]
+        if mask & MASK_X:
+            difference, offset = _readSigned(data, offset)
+            x += difference
+        if mask & MASK_Y:
+            difference, offset = _readSigned(data, offset)
+            y += difference
+        state[entityId] = (x, y)
+    return sequence, baselineSequence, state
+
+def _nearestChanges(state, baseline, centre):
+    """ state with only the MAX_ENTRIES changes from baseline nearest
+    centre made, the other entities left as they were in baseline. """
+    changed = [ entityId for entityId in set(state) | set(baseline)
+                if state.get(entityId) != baseline.get(entityId) ]
+    if len(changed) <= MAX_ENTRIES:
+        return state
+    centreX, centreY = centre
+    def distance(entityId):
+        x, y = state.get(entityId) or baseline[entityId]
+        return (x - centreX) ** 2 + (y - centreY) ** 2
+    changed.sort(key=distance)
+    state = dict(state)
+    for entityId in changed[MAX_ENTRIES:]:
+        previous = baseline.get(entityId)
+        if previous is None:
+            del state[entityId]
+        else:
+            state[entityId] = previous
+    return state
+
+class ClientBaseline(object):
+    """ What one client has acknowledged receiving, and what it was sent. """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.acked = 0
+        # sequence -> the state that snapshot gave the client
+        self.sent = {}
+        self.order = collections.deque()
+
+    def acknowledge(self, sequence):
+        # Acks can arrive out of order, only ever move forwards, and only
+        # to snapshots still remembered.
+        if sequence > self.acked and sequence in self.sent:
+            self.acked = sequence
+
+    def encode(self, sequence, state, centre=(0, 0)):
+        """ The snapshot packet taking this client to state, what it is to
+        see of snapshot sequence, or as far towards it as fits in a packet
+        starting with the entities nearest centre (quantized x, y). """
+        baseline = self.sent.get(self.acked)
+        if baseline is None:
+            # Too old, or nothing acknowledged yet: send it all.
+            baselineSequence, baseline = 0, {}
+        else:
+            baselineSequence = self.acked
+        if len(state) + len(baseline) > MAX_ENTRIES:
+            state = _nearestChanges(state, baseline, centre)
+        payload = encodeDelta(sequence, state, baselineSequence, baseline)
+        self.sent[sequence] = state
+        self.order.append(sequence)
+        if len(self.order) > self.size:
+            del self.sent[self.order.popleft()]
+        return Framing.encodeFrame(Messages.PACKET_SNAPSHOT, payload)
+
+class Replicator(object):
+    """ Sends every logged in client a snapshot of the entities near it,
+    each world tick (see World). """
+
+    def __init__(self, users, entities, grid, radius=INTEREST_RADIUS):
+        # Anything with a characters() method listing the logged in ones
+        self.users = users
+        # The EntityStore, and the SpatialGrid over it
+        self.entities = entities
+        self.grid = grid
+        self.radius = radius
+        self.history = SnapshotHistory()
+
+    def tick(self):
+        sequence = self.history.advance()
+        entities = self.entities
+        for character in self.users.characters():
+            connection = character.connection
+            if connection is None:
+                continue
+            x, y = entities.position(character.entityId)
+            ids, xs, ys = entities.quantized(POSITION_SCALE, self.grid.queryRadius(x, y, self.radius))
+            state = dict(zip(ids, zip(xs, ys)))
+            centre = (quantize(x), quantize(y))
+            connection.write(connection.baseline.encode(sequence, state, centre))
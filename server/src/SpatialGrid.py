@@ -0,0 +1,98 @@
+#
+# Uniform grid spatial index over the EntityStore.
+#
+# The world is cut into square cells and each live entity is filed under
+# the cell its position falls in, so finding what is near a point only
+# means looking in the few cells around it, however many entities there
+# are elsewhere.
+#
+# sync() is called once a tick, after the entities have moved.  It works
+# out every entity's cell with array operations but only refiles the ones
+# whose cell has changed, were created or were released, which is usually
+# a small fraction of them.
+#
+
+import numpy
+
+import EntityStore
+
+# Cell key of a row without a live entity
+EMPTY = -1
+# Cell coordinates are offset by this to keep keys positive
+OFFSET = 1 << 20
+STRIDE = 1 << 21
+
+class SpatialGrid(object):
+    def __init__(self, entities, cellSize=64.0):
+        self.entities = entities
+        self.cellSize = float(cellSize)
+
+        # cell key -> set of entity ids
+        self.cells = {}
+        # Cell key each row is filed under, EMPTY if none
+        self.keys = numpy.empty(0, numpy.int64)
+        # One past the highest row filed
+        self.end = 0
+
+    def cellOf(self, x, y):
+        return (int(numpy.floor(x / self.cellSize)) + OFFSET) * STRIDE + int(numpy.floor(y / self.cellSize)) + OFFSET
+
+    def sync(self):
+        entities = self.entities
+        if len(self.keys) < entities.capacity:
+            keys = numpy.empty(entities.capacity, numpy.int64)
+            keys.fill(EMPTY)
+            keys[:len(self.keys)] = self.keys
+            self.keys = keys
+
+        # Rows above the store's end may still be filed from before
+        end = max(self.end, entities.end)
+        cx = numpy.floor(entities.x[:end] / self.cellSize).astype(numpy.int64) + OFFSET
+        cy = numpy.floor(entities.y[:end] / self.cellSize).astype(numpy.int64) + OFFSET
+        alive = (entities.flags[:end] & EntityStore.ALIVE) != 0
+        current = numpy.where(alive, cx * STRIDE + cy, EMPTY)
+
+        previous = self.keys[:end]
+        cells = self.cells
+        for entityId in numpy.flatnonzero(current != previous).tolist():
+            old = int(previous[entityId])
+            if old != EMPTY:
+                cell = cells[old]
+                cell.discard(entityId)
+                if not cell:
+                    del cells[old]
+            new = int(current[entityId])
+            if new != EMPTY:
+                cell = cells.get(new)
+                if cell is None:
+                    cell = cells[new] = set()
+                cell.add(entityId)
+        self.keys[:end] = current
+        self.end = entities.end
+
+    def candidates(self, minX, minY, maxX, maxY):
+        """ Ids filed in the cells overlapping the rectangle. """
+        size = self.cellSize
+        found = []
+        cells = self.cells
+        for cx in xrange(int(numpy.floor(minX / size)) + OFFSET, int(numpy.floor(maxX / size)) + OFFSET + 1):
+            base = cx * STRIDE + OFFSET
+            for cy in xrange(int(numpy.floor(minY / size)), int(numpy.floor(maxY / size)) + 1):
+                cell = cells.get(base + cy)
+                if cell:
+                    found.extend(cell)
+        return numpy.array(found, numpy.intp)
+
+    def queryRect(self, minX, minY, maxX, maxY):
+        """ Ids of the entities within the rectangle, as of the last sync. """
+        ids = self.candidates(minX, minY, maxX, maxY)
+        x = self.entities.x[ids]
+        y = self.entities.y[ids]
+        return ids[(x >= minX) & (x <= maxX) & (y >= minY) & (y <= maxY)].tolist()
+
+    def queryRadius(self, x, y, radius):
+        """ Ids of the entities within radius of (x, y), as of the last sync. """
+        ids = self.candidates(x - radius, y - radius, x + radius, y + radius)
+        dx = self.entities.x[ids] - x
+        dy = self.entities.y[ids] - y
+        return ids[dx * dx + dy * dy <= radius * radius].tolist()
@@ -23,13 +23,14 @@
 # Possible improvements:
 # - More correct error handling.  When there is an error on a socket found by
 #   poll, there is no idea what it actually is.
-# - Launching each bit of incoming data in its own tasklet on the recvChannel
-#   send is a little over the top.  It should be possible to add it to the
-#   rest of the queued data
 
 import stackless
-import asyncore, weakref
+import os
+import asyncore, weakref, collections, struct
+from errno import EWOULDBLOCK, EAGAIN, ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE
 import socket as stdsocket # We need the "socket" name for the function we export.
+import Timers
+import Offload
 
 # If we are to masquerade as the socket module, we need to provide the constants.
 if "__all__" in stdsocket.__dict__:
@@ -73,8 +74,15 @@ def ManageSockets():
     global managerRunning
 
     while len(asyncore.socket_map):
-        # Check the sockets for activity.
-        asyncore.poll(0.05)
+        # Check the sockets for activity.  We don't watch for offloaded
+        # calls finishing, so look more often while any are outstanding.
+        timeout = Timers.timeUntilNext(0.05)
+        if Offload.pending():
+            timeout = min(timeout, 0.005)
+        asyncore.poll(timeout)
+        # Wake any tasklets whose sleep is over, or whose call has returned.
+        Timers.wakeExpired()
+        Offload.wakeCompleted()
         # Yield to give other tasklets a chance to be scheduled.
         stackless.schedule()
 
@@ -92,11 +100,111 @@ def stacklesssocket_manager(mgr):
     global _manage_sockets_func
     _manage_sockets_func = mgr
 
+# A manager which only services the sockets the kernel reports as ready,
+# rather than polling every entry in asyncore.socket_map, also needs to be
+# told when sockets come and go and when a socket gains work outside of a
+# readiness event (data queued by send(), a tasklet blocking in accept()).
+# Register such an object using stacklesssocket_watcher().  It must provide
+# add_socket(fd, dispatcher), remove_socket(fd) and wakeup(fd).
+#
+# See EpollManager.py for an example.
+#
+
+_socket_watcher = None
+
+def stacklesssocket_watcher(watcher):
+    global _socket_watcher
+    _socket_watcher = watcher
+
+# Outbound backpressure.  A tasklet sending on a stream socket with more
+# than the high water mark of data queued is blocked until the queue has
+# drained to the low water mark.  These are the defaults for new sockets.
+_send_high_water = 256 * 1024
+_send_low_water = 64 * 1024
+
+def stacklesssocket_watermarks(high, low):
+    global _send_high_water, _send_low_water
+    if low > high:
+        raise ValueError("low water mark above the high water mark")
+    _send_high_water = high
+    _send_low_water = low
+
+# sendmmsg(2) lets a whole batch of datagrams go out in one system call.  It
+# is called through ctypes where the C library provides it, otherwise the
+# batch is sent with a sendto() per datagram.
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc_sendmmsg = _libc.sendmmsg
+except (ImportError, OSError, AttributeError):
+    _libc_sendmmsg = None
+
+if _libc_sendmmsg is not None:
+    class _iovec(ctypes.Structure):
+        _fields_ = [ ("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t) ]
+
+    class _sockaddr_in(ctypes.Structure):
+        _fields_ = [ ("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint16),
+                     ("sin_addr", ctypes.c_uint32), ("sin_zero", ctypes.c_char * 8) ]
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [ ("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                     ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                     ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                     ("msg_flags", ctypes.c_int) ]
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [ ("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint) ]
+
+    _libc_sendmmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int ]
+    _libc_sendmmsg.restype = ctypes.c_int
+
+    def _sendmmsg(fd, datagrams):
+        """ Send a list of (data, address) pairs to IPv4 addresses given as
+        dotted quads.  Returns how many of them were sent, raises ValueError
+        when they can't be sent this way. """
+        count = len(datagrams)
+        messages = (_mmsghdr * count)()
+        iovecs = (_iovec * count)()
+        names = (_sockaddr_in * count)()
+        for i, (data, address) in enumerate(datagrams):
+            if type(data) is not str:
+                raise ValueError("not a string")
+            host, port = address
+            try:
+                # Both of these stay in network byte order.
+                names[i].sin_addr = struct.unpack("=I", inet_aton(host))[0]
+            except error:
+                raise ValueError("not an IPv4 address")
+            names[i].sin_family = AF_INET
+            names[i].sin_port = htons(port)
+            # The pointer is to the string's own buffer, nothing is copied.
+            iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+            iovecs[i].iov_len = len(data)
+            header = messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(names[i])
+            header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            header.msg_iov = ctypes.pointer(iovecs[i])
+            header.msg_iovlen = 1
+
+        sent = _libc_sendmmsg(fd, messages, count, 0)
+        if sent < 0:
+            errno = ctypes.get_errno()
+            if errno in (EWOULDBLOCK, EAGAIN):
+                return 0
+            raise error(errno, os.strerror(errno))
+        return sent
+else:
+    _sendmmsg = None
+
 def socket(*args, **kwargs):
     import sys
     if "socket" in sys.modules and sys.modules["socket"] is not stdsocket:
         raise RuntimeError("Use 'stacklesssocket.install' instead of replacing the 'socket' module")
 
+# Errors which mean the other end has gone away.
+_DISCONNECTED = frozenset((ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE, EBADF))
+
 _realsocket_old = stdsocket._realsocket
 _socketobject_old = stdsocket._socketobject
 
@@ -119,6 +227,12 @@ class _socketobject_new(_socketobject_old):
         
     accept.__doc__ = _socketobject_old.accept.__doc__
 
+    def sendto_nowait(self, *args):
+        return self._sock.sendto_nowait(*args)
+
+    def send_would_block(self):
+        return self._sock.send_would_block()
+
 
 def check_still_connected(f):
     " Decorate socket functions to check they are still connected. "
@@ -133,6 +247,14 @@ def check_still_connected(f):
     return new_f
 
 
+def wrap(realSocket):
+    """ A socket for tasklets to use from an already connected real one,
+    such as either end of a socketpair() made before forking. """
+    sock = _fakesocket(realSocket)
+    sock.wasConnected = True
+    _manage_sockets_func()
+    return _socketobject_new(_sock=sock)
+
 def install():
     if stdsocket._realsocket is socket:
         raise StandardError("Still installed")
@@ -144,11 +266,65 @@ def uninstall():
     stdsocket.socket = stdsocket.SocketType = stdsocket._socketobject = _socketobject_old
 
 
+class _sendqueue(object):
+    """ Outbound stream data, held as the strings the caller passed in.
+
+    Nothing is copied once queued.  The kernel is handed memoryviews over
+    the unsent part of the oldest string, and a string is only dropped once
+    all of it has gone. """
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        # Bytes of chunks[0] that have already been sent.
+        self.offset = 0
+        self.size = 0
+        # Total bytes that have left the queue, whether sent or dropped.
+        self.flushed = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def clear(self):
+        self.chunks.clear()
+        self.flushed += self.size
+        self.offset = 0
+        self.size = 0
+
+    def peek(self):
+        return memoryview(self.chunks[0])[self.offset:]
+
+    def consume(self, byteCount):
+        self.size -= byteCount
+        self.flushed += byteCount
+        self.offset += byteCount
+        if self.offset == len(self.chunks[0]):
+            self.chunks.popleft()
+            self.offset = 0
+
+
 class _fakesocket(asyncore.dispatcher):
     connectChannel = None
     acceptChannel = None
     recvChannel = None
+    sendChannel = None
     wasConnected = False
+    # Set by the handlers when the last read or write stopped short because
+    # the kernel had nothing more to give or take.  Edge-triggered managers
+    # use these to know when to wait for the next readiness event.
+    readBlocked = True
+    writeBlocked = True
+    # Most datagrams sent per writable event.
+    sendToBatch = 64
+    # Size of the per-socket buffer stream input is received into.  When it
+    # fills up the socket stops being readable until it is drained.
+    recvBufferSize = 16384
+    readBuffer = None
+    readError = None
 
     def __init__(self, realSocket):
         # This is worth doing.  I was passing in an invalid socket which
@@ -160,12 +336,30 @@ class _fakesocket(asyncore.dispatcher):
         asyncore.dispatcher.__init__(self, realSocket)
         self.socket = realSocket
 
+        # Tasklets blocked waiting for input wait on this channel.  Nothing
+        # is sent over it, it is just used to wake them when input arrives.
         self.recvChannel = stackless.channel()
-        self.readString = ''
-        self.readIdx = 0
-
-        self.sendBuffer = ''
-        self.sendToBuffers = []
+        # Prefer the sender, so that the manager carries on servicing other
+        # sockets rather than switching to the woken tasklet.
+        self.recvChannel.preference = 1
+        # Stream input is held in readBuffer[readStart:readEnd].
+        self.readStart = 0
+        self.readEnd = 0
+        # Datagram input is held as (data, address) tuples.
+        self.recvQueue = collections.deque()
+
+        self.sendBuffer = _sendqueue()
+        # Datagrams waiting to go out, queued per destination address as
+        # (data, channel) where the channel is None for fire and forget.
+        self.sendToQueues = {}
+        # Destinations with queued datagrams, serviced round robin.
+        self.sendToOrder = collections.deque()
+        self.sendToCount = 0
+        self.sendHighWater = _send_high_water
+        self.sendLowWater = _send_low_water
+        # Tasklets blocked on a full or draining send buffer wait on this.
+        self.sendChannel = stackless.channel()
+        self.sendChannel.preference = 1
 
     def __del__(self):
         # There are no more users (sockets or files) of this fake socket, we
@@ -183,16 +377,41 @@ class _fakesocket(asyncore.dispatcher):
     def add_channel(self, map=None):
         if map is None:
             map = self._map
-        map[self._fileno] = weakref.proxy(self)
+        proxy = weakref.proxy(self)
+        map[self._fileno] = proxy
+        if _socket_watcher is not None:
+            _socket_watcher.add_socket(self._fileno, proxy)
+
+    def del_channel(self, map=None):
+        if _socket_watcher is not None and self._fileno is not None:
+            _socket_watcher.remove_socket(self._fileno)
+        asyncore.dispatcher.del_channel(self, map)
+
+    # Let the socket watcher know that readable() or writable() may now
+    # give a different answer.
+    def _wakeup(self):
+        if _socket_watcher is not None and self._fileno is not None:
+            _socket_watcher.wakeup(self._fileno)
+
+    def readable(self):
+        # Don't accept connections that nobody is waiting for, they'd only
+        # end up queued on tasklets blocked sending to the accept channel.
+        if self.accepting:
+            return self.acceptChannel is not None and self.acceptChannel.balance < 0
+        # Stop reading when there is nowhere to put the data.
+        if self.readBuffer is not None:
+            return self.readEnd - self.readStart < len(self.readBuffer)
+        return True
 
     def writable(self):
         if self.socket.type != SOCK_DGRAM and not self.connected:
             return True
-        return len(self.sendBuffer) or len(self.sendToBuffers)
+        return len(self.sendBuffer) or self.sendToCount
 
     def accept(self):
         if not self.acceptChannel:
             self.acceptChannel = stackless.channel()
+        self._wakeup()
         return self.acceptChannel.receive()
 
     def connect(self, address):
@@ -206,22 +425,54 @@ class _fakesocket(asyncore.dispatcher):
                 self.connectChannel.preference = 1
             self.connectChannel.receive()
 
+    # Block while the send buffer is over the high water mark.
+    def _waitForSendSpace(self):
+        if len(self.sendBuffer) >= self.sendHighWater:
+            while self.sendBuffer is not None and len(self.sendBuffer) > self.sendLowWater:
+                self.sendChannel.receive()
+            if self.sendBuffer is None:
+                raise error(EPIPE, 'Broken pipe')
+
+    # Whether send would block the caller because of backpressure.
+    def send_would_block(self):
+        return self.sendBuffer is not None and len(self.sendBuffer) >= self.sendHighWater
+
+    # Wake the tasklets blocked sending, for them to check how far the
+    # buffer has drained.
+    def _wakeSenders(self):
+        while self.sendChannel.balance < 0:
+            self.sendChannel.send(None)
+
     @check_still_connected
     def send(self, data, flags=0):
-        self.sendBuffer += data
-        stackless.schedule()
+        self._waitForSendSpace()
+        self.sendBuffer.append(data)
+        self._wakeup()
         return len(data)
 
     @check_still_connected
     def sendall(self, data, flags=0):
-        # WARNING: this will busy wait until all data is sent
-        # It should be possible to do away with the busy wait with
-        # the use of a channel.
-        self.sendBuffer += data
-        while self.sendBuffer:
-            stackless.schedule()
+        self._waitForSendSpace()
+        self.sendBuffer.append(data)
+        self._wakeup()
+        # Wait until handle_write has written out everything up to and
+        # including this data.
+        target = self.sendBuffer.flushed + len(self.sendBuffer)
+        while self.sendBuffer is not None and self.sendBuffer.flushed < target:
+            self.sendChannel.receive()
+        if self.sendBuffer is None:
+            raise error(EPIPE, 'Broken pipe')
         return len(data)
 
+    def _queueDatagram(self, data, address, channel):
+        queue = self.sendToQueues.get(address)
+        if queue is None:
+            queue = self.sendToQueues[address] = collections.deque()
+            self.sendToOrder.append(address)
+        queue.append((data, channel))
+        self.sendToCount += 1
+        self._wakeup()
+
     def sendto(self, sendData, sendArg1=None, sendArg2=None):
         # sendto(data, address)
         # sendto(data [, flags], address)
@@ -231,83 +482,139 @@ class _fakesocket(asyncore.dispatcher):
         else:
             flags = 0
             sendAddress = sendArg1
-            
-        waitChannel = None
-        for idx, (data, address, channel, sentBytes) in enumerate(self.sendToBuffers):
-            if address == sendAddress:
-                self.sendToBuffers[idx] = (data + sendData, address, channel, sentBytes)
-                waitChannel = channel
-                break
-        if waitChannel is None:
-            waitChannel = stackless.channel()
-            self.sendToBuffers.append((sendData, sendAddress, waitChannel, 0))
+
+        waitChannel = stackless.channel()
+        waitChannel.preference = 1
+        self._queueDatagram(sendData, sendAddress, waitChannel)
         return waitChannel.receive()
 
+    # As sendto, but return straight away rather than waiting for the
+    # datagram to be sent.  Errors sending it are dropped.
+    def sendto_nowait(self, sendData, sendArg1=None, sendArg2=None):
+        if sendArg2 is not None:
+            sendAddress = sendArg2
+        else:
+            sendAddress = sendArg1
+        self._queueDatagram(sendData, sendAddress, None)
+        return len(sendData)
+
+    # Block until there is buffered input, returning False at EOF.
+    def _waitForInput(self):
+        while self.readStart == self.readEnd:
+            if self.readError is not None:
+                err, self.readError = self.readError, None
+                raise err
+            if not self.connected:
+                # Sockets which have never been connected do this.
+                if not self.wasConnected:
+                    raise error(10057, 'Socket is not connected')
+                # Sockets which were connected, but no longer are, use
+                # up the remaining input.  Observed this with urllib.urlopen
+                # where it closes the socket and then allows the caller to
+                # use a file to access the body of the web page.
+                return False
+            self.recvChannel.receive()
+        return True
+
+    # Take byteCount bytes out of the receive buffer.
+    def _consumeInput(self, byteCount):
+        wasFull = self.readEnd - self.readStart == len(self.readBuffer)
+        self.readStart += byteCount
+        if self.readStart == self.readEnd:
+            self.readStart = self.readEnd = 0
+        # A full buffer makes the socket unreadable, it can read again now.
+        if wasFull:
+            self._wakeup()
+
     # Read at most byteCount bytes.
-    def recv(self, byteCount, flags=0):        
+    def recv(self, byteCount, flags=0):
         # recv() must not concatenate two or more data fragments sent with
         # send() on the remote side. Single fragment sent with single send()
         # call should be split into strings of length less than or equal
         # to 'byteCount', and returned by one or more recv() calls.
+        if self.socket.type == SOCK_DGRAM:
+            return self.recvfrom(byteCount, flags)[0]
 
-        remainingBytes = self.readIdx != len(self.readString)
-        # TODO: Verify this connectivity behaviour.
+        if not self._waitForInput():
+            # '' is EOF.
+            return ''
 
-        if not self.connected:
-            # Sockets which have never been connected do this.
-            if not self.wasConnected:
-                raise error(10057, 'Socket is not connected')
-
-            # Sockets which were connected, but no longer are, use
-            # up the remaining input.  Observed this with urllib.urlopen
-            # where it closes the socket and then allows the caller to
-            # use a file to access the body of the web page.
-        elif not remainingBytes:            
-            self.readString = self.recvChannel.receive()
-            self.readIdx = 0
-            remainingBytes = len(self.readString)
-
-        if byteCount == 1 and remainingBytes:
-            ret = self.readString[self.readIdx]
-            self.readIdx += 1
-        elif self.readIdx == 0 and byteCount >= len(self.readString):
-            ret = self.readString
-            self.readString = ""
-        else:
-            idx = self.readIdx + byteCount
-            ret = self.readString[self.readIdx:idx]
-            self.readString = self.readString[idx:]
-            self.readIdx = 0
-
-        # ret will be '' when EOF.
+        byteCount = min(byteCount, self.readEnd - self.readStart)
+        ret = memoryview(self.readBuffer)[self.readStart:self.readStart + byteCount].tobytes()
+        self._consumeInput(byteCount)
         return ret
 
+    # Read at most nbytes bytes into the given writable buffer.
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if self.socket.type == SOCK_DGRAM:
+            return self.recvfrom_into(buffer, nbytes, flags)[0]
+
+        if not self._waitForInput():
+            return 0
+
+        if nbytes <= 0:
+            nbytes = len(buffer)
+        nbytes = min(nbytes, self.readEnd - self.readStart)
+        memoryview(buffer)[:nbytes] = memoryview(self.readBuffer)[self.readStart:self.readStart + nbytes]
+        self._consumeInput(nbytes)
+        return nbytes
+
+    # Block until there is a datagram, returning None once closed.
+    def _waitForDatagram(self):
+        while not self.recvQueue:
+            if self.readError is not None:
+                err, self.readError = self.readError, None
+                raise err
+            if self._fileno is None:
+                return None
+            self.recvChannel.receive()
+        return self.recvQueue.popleft()
+
     def recvfrom(self, byteCount, flags=0):
         if self.socket.type == SOCK_STREAM:
             return self.recv(byteCount), None
 
         # recvfrom() must not concatenate two or more Messages.
         # Each call should return the first 'byteCount' part of the packet.
-        data, address = self.recvChannel.receive()
+        packet = self._waitForDatagram()
+        if packet is None:
+            return '', None
+        data, address = packet
         return data[:byteCount], address
 
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        if self.socket.type == SOCK_STREAM:
+            return self.recv_into(buffer, nbytes, flags), None
+
+        packet = self._waitForDatagram()
+        if packet is None:
+            return 0, None
+        data, address = packet
+        if nbytes <= 0:
+            nbytes = len(buffer)
+        nbytes = min(nbytes, len(data))
+        memoryview(buffer)[:nbytes] = data[:nbytes]
+        return nbytes, address
+
     def close(self):
         asyncore.dispatcher.close(self)
 
         self.connected = False
         self.accepting = False
-        self.sendBuffer = None  # breaks the loop in sendall
+        self.sendBuffer = None  # breaks the loops in send and sendall
 
         # Clear out all the channels with relevant errors.
         while self.acceptChannel and self.acceptChannel.balance < 0:
             self.acceptChannel.send_exception(error, 9, 'Bad file descriptor')
         while self.connectChannel and self.connectChannel.balance < 0:
             self.connectChannel.send_exception(error, 10061, 'Connection refused')
+        while self.sendChannel and self.sendChannel.balance < 0:
+            self.sendChannel.send(None)
         while self.recvChannel and self.recvChannel.balance < 0:
             # The closing of a socket is indicted by receiving nothing.  The
             # exception would have been sent if the server was killed, rather
             # than closed down gracefully.
-            self.recvChannel.send("")
+            self.recvChannel.send(None)
             #self.recvChannel.send_exception(error, 10054, 'Connection reset by peer')
 
     # asyncore doesn't support this.  Why not?
@@ -318,7 +625,9 @@ class _fakesocket(asyncore.dispatcher):
         if self.acceptChannel and self.acceptChannel.balance < 0:
             t = asyncore.dispatcher.accept(self)
             if t is None:
+                self.readBlocked = True
                 return
+            self.readBlocked = False
             t[0].setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             stackless.tasklet(self.acceptChannel.send)(t)
 
@@ -342,36 +651,141 @@ class _fakesocket(asyncore.dispatcher):
     def handle_read(self):
         try:
             if self.socket.type == SOCK_DGRAM:
-                ret = self.socket.recvfrom(20000)
+                self.recvQueue.append(self.socket.recvfrom(20000))
+                self.readBlocked = False
             else:
-                ret = asyncore.dispatcher.recv(self, 20000)
+                if self.readBuffer is None:
+                    self.readBuffer = bytearray(self.recvBufferSize)
+                elif self.readEnd == len(self.readBuffer):
+                    # Move what is left to the front to make room.
+                    remaining = self.readEnd - self.readStart
+                    self.readBuffer[:remaining] = self.readBuffer[self.readStart:self.readEnd]
+                    self.readStart, self.readEnd = 0, remaining
+
+                space = len(self.readBuffer) - self.readEnd
+                try:
+                    nbytes = self.socket.recv_into(memoryview(self.readBuffer)[self.readEnd:], space)
+                except stdsocket.error, err:
+                    if err.args[0] not in _DISCONNECTED:
+                        raise
+                    nbytes = 0
+                # A short read means the kernel buffer is drained.
+                self.readBlocked = nbytes < space
+                self.readEnd += nbytes
                 # Not sure this is correct, but it seems to give the
                 # right behaviour.  Namely removing the socket from
                 # asyncore.
-                if not ret:
+                if not nbytes:
                     self.close()
-            stackless.tasklet(self.recvChannel.send)(ret)
+                    return
         except stdsocket.error, err:
+            if err.args[0] in (EWOULDBLOCK, EAGAIN):
+                # Nothing there after all, wait for the next event.
+                self.readBlocked = True
+                return
+            self.readBlocked = True
             # If there's a read error assume the connection is
             # broken and drop any pending output
             if self.sendBuffer:
-                self.sendBuffer = ""
-            self.recvChannel.send_exception(stdsocket.error, err)
+                self.sendBuffer.clear()
+                self._wakeSenders()
+            self.readError = err
+
+        # Wake whoever is waiting for the input.
+        if self.recvChannel.balance < 0:
+            self.recvChannel.send(None)
 
     def handle_write(self):
+        self.writeBlocked = False
         if len(self.sendBuffer):
-            sentBytes = asyncore.dispatcher.send(self, self.sendBuffer[:512])
-            self.sendBuffer = self.sendBuffer[sentBytes:]
-        elif len(self.sendToBuffers):
-            data, address, channel, oldSentBytes = self.sendToBuffers[0]
-            sentBytes = self.socket.sendto(data, address)
-            totalSentBytes = oldSentBytes + sentBytes
-            if len(data) > sentBytes:
-                self.sendToBuffers[0] = data[sentBytes:], address, channel, totalSentBytes
+            # Keep writing until the kernel stops taking it all.
+            while self.sendBuffer:
+                chunk = self.sendBuffer.peek()
+                sentBytes = asyncore.dispatcher.send(self, chunk)
+                if sentBytes:
+                    self.sendBuffer.consume(sentBytes)
+                if sentBytes < len(chunk):
+                    self.writeBlocked = True
+                    break
+            if self.sendChannel.balance < 0 and len(self.sendBuffer) <= self.sendLowWater:
+                self._wakeSenders()
+        elif self.sendToCount:
+            self.writeDatagrams()
+
+    # Take the next batch of datagrams off the queues, a destination at a
+    # time so one busy address can't starve the rest.
+    def _takeDatagrams(self):
+        batch = []
+        while self.sendToOrder and len(batch) < self.sendToBatch:
+            address = self.sendToOrder.popleft()
+            queue = self.sendToQueues[address]
+            data, channel = queue.popleft()
+            batch.append((data, address, channel))
+            if queue:
+                self.sendToOrder.append(address)
             else:
-                del self.sendToBuffers[0]
-                stackless.tasklet(channel.send)(totalSentBytes)
-
+                del self.sendToQueues[address]
+        self.sendToCount -= len(batch)
+        return batch
+
+    # Put datagrams the kernel wouldn't take back at the front.
+    def _requeueDatagrams(self, batch):
+        for data, address, channel in reversed(batch):
+            queue = self.sendToQueues.get(address)
+            if queue is None:
+                queue = self.sendToQueues[address] = collections.deque()
+                self.sendToOrder.appendleft(address)
+            queue.appendleft((data, channel))
+            self.sendToCount += 1
+
+    # Send batch[sent:stop] a datagram at a time, returning how far it got
+    # and whether it stopped because the kernel's buffer is full.
+    def _sendEachDatagram(self, batch, sent, stop):
+        while sent < stop:
+            data, address, channel = batch[sent]
+            try:
+                self.socket.sendto(data, address)
+            except stdsocket.error, err:
+                if err.args[0] in (EWOULDBLOCK, EAGAIN):
+                    return sent, True
+                # Only the sender of this datagram gets to hear of it.
+                if channel is not None and channel.balance < 0:
+                    channel.send_exception(stdsocket.error, *err.args)
+                batch[sent] = data, address, None
+            sent += 1
+        return sent, False
+
+    def writeDatagrams(self):
+        batch = self._takeDatagrams()
+        sent = None
+        if _sendmmsg is not None and len(batch) > 1 and self.socket.family == AF_INET:
+            try:
+                sent = _sendmmsg(self.socket.fileno(), [ (data, address) for data, address, channel in batch ])
+            except (ValueError, error):
+                # Sort it out a datagram at a time below.
+                pass
+
+        if sent is None:
+            sent, blocked = self._sendEachDatagram(batch, 0, len(batch))
+        elif sent == 0:
+            # EAGAIN, nothing went
+            blocked = True
+        elif sent < len(batch):
+            # sendmmsg() stops short at a datagram it couldn't send without
+            # saying why, which needn't be a full buffer.  Sent on its own
+            # that one tells, and if it failed its sender hears of it.
+            sent, blocked = self._sendEachDatagram(batch, sent, sent + 1)
+        else:
+            blocked = False
+
+        for data, address, channel in batch[:sent]:
+            if channel is not None and channel.balance < 0:
+                channel.send(len(data))
+        if sent < len(batch):
+            # Unless the kernel is full the rest go on the next pass, the
+            # manager calls us again while there are datagrams queued.
+            self.writeBlocked = blocked
+            self._requeueDatagrams(batch[sent:])
 
 if __name__ == '__main__':
     import sys
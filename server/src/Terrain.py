@@ -0,0 +1,136 @@
+#
+# Baked terrain: ground height and walkability on a grid.
+#
+# The client keeps characters on the ground by casting a ray down at the
+# world geometry every frame, and refuses moves onto anything but terrain.
+# The server can't afford raycasts, so TerrainBaker turns the geometry into
+# a grid of cells, each with the height of the ground and whether it can be
+# walked on, and the server checks moves against that with array lookups.
+# The ground is looked at every half a cell along each move, so a move can't
+# jump over what it couldn't walk across.
+#
+# File layout, little endian:
+#
+#   header   magic "NXTR", version (H), unused (H), width (I), height (I),
+#            origin x (f), origin y (f), cell size (f), max step (f)
+#   heights  float32 per cell, row by row (y major)
+#   flags    uint8 per cell, WALKABLE
+#
+# The file is mapped rather than read, so server processes share one copy.
+# Walkability can still be changed at run time with setWalkable(), which
+# first copies the flags into the process's own memory, and bumps version
+# so anything derived from the grid knows to rebuild.
+#
+
+import mmap, struct
+import numpy
+
+HEADER = struct.Struct("<4sHHIIffff")
+MAGIC = "NXTR"
+VERSION = 1
+
+WALKABLE = 0x1
+
+class Terrain(object):
+    def __init__(self, heights, flags, origin, cellSize, maxStep):
+        # Both indexed [row, column], that is [y, x]
+        self.heights = heights
+        self.flags = flags
+        self.originX, self.originY = origin
+        self.cellSize = cellSize
+        # How far up or down a single move may go
+        self.maxStep = maxStep
+        self.rows, self.columns = heights.shape
+        # Changes whenever the flags do
+        self.version = 0
+
+    def cells(self, x, y):
+        """ Row and column arrays of the cells under points x, y, and which
+        of the points are on the grid at all. """
+        column = numpy.floor((numpy.asarray(x, numpy.float64) - self.originX) / self.cellSize).astype(numpy.intp)
+        row = numpy.floor((numpy.asarray(y, numpy.float64) - self.originY) / self.cellSize).astype(numpy.intp)
+        inside = (column >= 0) & (column < self.columns) & (row >= 0) & (row < self.rows)
+        # Anything off the grid looks at cell 0, 0 and is rejected anyway
+        column[~inside] = 0
+        row[~inside] = 0
+        return row, column, inside
+
+    def heightAt(self, x, y):
+        row, column, inside = self.cells([ x ], [ y ])
+        if not inside[0]:
+            return None
+        return float(self.heights[row[0], column[0]])
+
+    def setWalkable(self, minX, minY, maxX, maxY, walkable):
+        """ Opens or closes every cell overlapping the rectangle. """
+        if not self.flags.flags.writeable:
+            self.flags = self.flags.copy()
+        # Clamped to the grid rather than dropped when partly off it
+        c0, c1 = [ int(min(max(numpy.floor((x - self.originX) / self.cellSize), 0), self.columns - 1)) for x in (minX, maxX) ]
+        r0, r1 = [ int(min(max(numpy.floor((y - self.originY) / self.cellSize), 0), self.rows - 1)) for y in (minY, maxY) ]
+        cells = self.flags[r0:r1 + 1, c0:c1 + 1]
+        if walkable:
+            cells |= WALKABLE
+        else:
+            cells &= ~WALKABLE & 0xFF
+        self.version += 1
+
+    def validateMoves(self, fromX, fromY, toX, toY, maxDistance=None):
+        """ Which of a batch of moves are allowed: no longer than maxDistance
+        if given, ending on the grid, and only over walkable ground with no
+        step along the way too steep. """
+        fromX = numpy.asarray(fromX, numpy.float64)
+        fromY = numpy.asarray(fromY, numpy.float64)
+        dx = numpy.asarray(toX, numpy.float64) - fromX
+        dy = numpy.asarray(toY, numpy.float64) - fromY
+        length = numpy.hypot(dx, dy)
+        allowed = numpy.ones(len(length), bool)
+        if maxDistance is not None:
+            allowed &= length <= maxDistance
+        checked = numpy.flatnonzero(allowed)
+        if not len(checked):
+            return allowed
+
+        # Points every half a cell or less along each move, ends included,
+        # a move a row
+        samples = max(int(numpy.ceil(length[checked].max() / (self.cellSize * 0.5))), 1)
+        along = numpy.arange(samples + 1) / float(samples)
+        row, column, inside = self.cells(fromX[checked, None] + dx[checked, None] * along,
+                                         fromY[checked, None] + dy[checked, None] * along)
+        cell = row * self.columns + column
+        walkable = (self.flags.ravel()[cell] & WALKABLE) != 0
+        heights = self.heights.ravel()[cell]
+        climb = numpy.abs(heights[:, 1:] - heights[:, :-1])
+        wasInside = inside[:, :-1]
+        isInside = inside[:, 1:]
+        onto = isInside & walkable[:, 1:] & ((climb <= self.maxStep) | ~wasInside)
+        # Somebody already off the grid may still walk back onto it, but
+        # has to end up on it
+        stillOff = ~isInside & ~wasInside
+        stillOff[:, -1] = False
+        allowed[checked] = (onto | stillOff).all(axis=1)
+        return allowed
+
+def write(path, heights, flags, origin, cellSize, maxStep):
+    rows, columns = heights.shape
+    out = open(path, "wb")
+    try:
+        out.write(HEADER.pack(MAGIC, VERSION, 0, columns, rows, origin[0], origin[1], cellSize, maxStep))
+        out.write(numpy.ascontiguousarray(heights, "<f4").tostring())
+        out.write(numpy.ascontiguousarray(flags, numpy.uint8).tostring())
+    finally:
+        out.close()
+
+def load(path):
+    terrainFile = open(path, "rb")
+    try:
+        data = mmap.mmap(terrainFile.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        terrainFile.close()
+    magic, version, unused, columns, rows, originX, originY, cellSize, maxStep = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d terrain file" % (path, VERSION))
+    count = columns * rows
+    heights = numpy.frombuffer(data, "<f4", count, HEADER.size).reshape(rows, columns)
+    flags = numpy.frombuffer(data, numpy.uint8, count, HEADER.size + count * 4).reshape(rows, columns)
+    return Terrain(heights, flags, (originX, originY), cellSize, maxStep)
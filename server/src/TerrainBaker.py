@@ -0,0 +1,168 @@
+#
+# Bakes the world mesh into a Terrain file for the server.
+#
+# Reads the meshes of a text DirectX (.x) model, as exported for the client
+# under client/res/models, and samples every triangle at the centre of the
+# grid cells it covers.  A cell takes the height of the highest surface
+# over it, and is walkable when that surface is no steeper than the maximum
+# slope, isn't of a blocked material (water by default) and has no more
+# than the clearance between it and the lowest walkable surface under it,
+# which keeps roofs, tree tops and the like off limits just as the client
+# only lets characters onto the terrain itself.  A roof with no floor
+# modelled under it still counts as ground, but the server's step check
+# keeps anyone from climbing onto it.
+#
+# The model is Y up.  Its x and z become the server's x and y, and y the
+# height.  Frame transforms are not applied; the exporter doesn't write any.
+#
+# Usage: TerrainBaker.py [-c cell size] [--max-step height]
+#                        [--max-slope degrees] [--clearance height]
+#                        [--block material] model.x terrain.bin
+#
+
+import re, math, time, optparse
+import numpy
+
+import Terrain
+
+MESH = re.compile(r"^\s*Mesh\s+\w*\s*\{", re.MULTILINE)
+NUMBER = re.compile(r"-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?")
+REFERENCE = re.compile(r"\{\s*(\w+)\s*\}")
+
+def readMeshes(path):
+    """ The triangles of every mesh in the model as an array of vertex
+    positions, shape (n, 3, 3), with the name of each one's material. """
+    text = open(path).read()
+    triangles = []
+    materials = []
+    starts = [ match.end() for match in MESH.finditer(text) ]
+    for index, start in enumerate(starts):
+        if index + 1 < len(starts):
+            end = starts[index + 1]
+        else:
+            end = len(text)
+        body = text[start:end]
+        materialList = body.find("MeshMaterialList")
+        if materialList < 0:
+            geometry = body
+        else:
+            geometry = body[:materialList]
+
+        numbers = NUMBER.findall(geometry)
+        vertexCount = int(numbers[0])
+        vertices = numpy.array(numbers[1:1 + vertexCount * 3], numpy.float64).reshape(vertexCount, 3)
+        position = 1 + vertexCount * 3
+        faceCount = int(numbers[position])
+        position += 1
+        faces = []
+        for face in xrange(faceCount):
+            corners = int(numbers[position])
+            indexes = [ int(number) for number in numbers[position + 1:position + 1 + corners] ]
+            position += 1 + corners
+            faces.append(indexes)
+
+        faceMaterials = [ None ] * faceCount
+        if materialList >= 0:
+            # The list ends where the next block of the mesh starts
+            section = body[materialList:]
+            following = re.search(r"\n\s*Mesh\w+\s*\{", section)
+            if following:
+                section = section[:following.start()]
+            numbers = NUMBER.findall(section[:section.find("{", section.find("{") + 1)])
+            names = REFERENCE.findall(section)
+            indexes = [ int(number) for number in numbers[2:2 + faceCount] ]
+            if names and len(indexes) == faceCount:
+                faceMaterials = [ names[i] for i in indexes ]
+
+        # Polygons are fanned out into triangles
+        for indexes, material in zip(faces, faceMaterials):
+            for i in xrange(1, len(indexes) - 1):
+                triangles.append(vertices[[ indexes[0], indexes[i], indexes[i + 1] ]])
+                materials.append(material)
+
+    if not triangles:
+        raise ValueError("no meshes in %s" % path)
+    triangles = numpy.array(triangles)
+    # Y up to the server's x, y and height
+    return triangles[:, :, [ 0, 2, 1 ]], materials
+
+def walkableTriangles(triangles, materials, maxSlope, blocked):
+    edge1 = triangles[:, 1] - triangles[:, 0]
+    edge2 = triangles[:, 2] - triangles[:, 0]
+    normal = numpy.cross(edge1, edge2)
+    length = numpy.sqrt((normal * normal).sum(axis=1))
+    length[length == 0] = 1.0
+    gentle = numpy.abs(normal[:, 2]) / length >= math.cos(math.radians(maxSlope))
+    allowed = numpy.array([ material not in blocked for material in materials ], bool)
+    return gentle & allowed
+
+def bake(triangles, walkable, cellSize, clearance):
+    """ The heights and flags of the grid over the triangles, and its origin. """
+    minX = math.floor(triangles[:, :, 0].min() / cellSize) * cellSize
+    minY = math.floor(triangles[:, :, 1].min() / cellSize) * cellSize
+    columns = int(math.ceil((triangles[:, :, 0].max() - minX) / cellSize)) + 1
+    rows = int(math.ceil((triangles[:, :, 1].max() - minY) / cellSize)) + 1
+
+    top = numpy.empty((rows, columns))
+    top.fill(-numpy.inf)
+    topWalkable = numpy.zeros((rows, columns), bool)
+    ground = numpy.empty((rows, columns))
+    ground.fill(numpy.inf)
+
+    for triangle, canWalk in zip(triangles, walkable.tolist()):
+        (x0, y0, h0), (x1, y1, h1), (x2, y2, h2) = triangle.tolist()
+        # Cells whose centre could be inside the triangle
+        c0 = max(int(math.ceil((min(x0, x1, x2) - minX) / cellSize - 0.5)), 0)
+        c1 = min(int(math.floor((max(x0, x1, x2) - minX) / cellSize - 0.5)), columns - 1)
+        r0 = max(int(math.ceil((min(y0, y1, y2) - minY) / cellSize - 0.5)), 0)
+        r1 = min(int(math.floor((max(y0, y1, y2) - minY) / cellSize - 0.5)), rows - 1)
+        determinant = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+        if c1 < c0 or r1 < r0 or abs(determinant) < 1e-12:
+            continue
+
+        px = minX + (numpy.arange(c0, c1 + 1) + 0.5) * cellSize - x2
+        py = (minY + (numpy.arange(r0, r1 + 1) + 0.5) * cellSize - y2)[:, None]
+        a = ((y1 - y2) * px + (x2 - x1) * py) / determinant
+        b = ((y2 - y0) * px + (x0 - x2) * py) / determinant
+        c = 1.0 - a - b
+        inside = (a >= -1e-9) & (b >= -1e-9) & (c >= -1e-9)
+        height = a * h0 + b * h1 + c * h2
+
+        cells = (slice(r0, r1 + 1), slice(c0, c1 + 1))
+        higher = inside & (height > top[cells])
+        top[cells][higher] = height[higher]
+        topWalkable[cells][higher] = canWalk
+        if canWalk:
+            lower = inside & (height < ground[cells])
+            ground[cells][lower] = height[lower]
+
+    covered = numpy.isfinite(top)
+    flags = numpy.where(topWalkable & (top - ground <= clearance), Terrain.WALKABLE, 0).astype(numpy.uint8)
+    heights = numpy.where(covered, top, 0.0).astype(numpy.float32)
+    return heights, flags, (minX, minY)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] model.x terrain.bin")
+    parser.add_option("-c", dest="cellSize", type="float", default=2.0,
+                      help="size of a grid cell")
+    parser.add_option("--max-step", dest="maxStep", type="float", default=2.0,
+                      help="height a single move may climb or drop")
+    parser.add_option("--max-slope", dest="maxSlope", type="float", default=40.0,
+                      help="steepest walkable surface, in degrees")
+    parser.add_option("--clearance", type="float", default=8.0,
+                      help="how far above the ground a surface is still walkable")
+    parser.add_option("--block", action="append", default=None,
+                      help="material which can't be walked on, may be repeated")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("expected a model and an output file")
+    blocked = set(options.block or [ "_Pool_Water_" ])
+
+    started = time.time()
+    triangles, materials = readMeshes(args[0])
+    walkable = walkableTriangles(triangles, materials, options.maxSlope, blocked)
+    heights, flags, origin = bake(triangles, walkable, options.cellSize, options.clearance)
+    Terrain.write(args[1], heights, flags, origin, options.cellSize, options.maxStep)
+    rows, columns = heights.shape
+    print "%d triangles to %dx%d cells, %d walkable, in %.1fs" % (
+        len(triangles), columns, rows, numpy.count_nonzero(flags), time.time() - started)
@@ -0,0 +1,40 @@
+#
+# Tasklet sleeping.
+#
+# A tasklet calling sleep() blocks on a channel of its own until whoever
+# drives the scheduler calls wakeExpired() after the wake up time.  The
+# socket managers do this on every pass, and use timeUntilNext() to bound
+# how long they block waiting for socket activity.
+#
+
+import time, heapq
+import stackless
+
+# (wake up time, sequence number, channel) in wake up order
+_sleepers = []
+_sequence = 0
+
+def sleep(seconds):
+    global _sequence
+    channel = stackless.channel()
+    _sequence += 1
+    heapq.heappush(_sleepers, (time.time() + seconds, _sequence, channel))
+    channel.receive()
+
+def wakeExpired():
+    now = time.time()
+    while _sleepers and _sleepers[0][0] <= now:
+        wakeTime, sequence, channel = heapq.heappop(_sleepers)
+        # Make it runnable without switching to it.
+        channel.preference = 1
+        channel.send(None)
+
+def timeUntilNext(default):
+    """ Seconds until the next sleeper is due, or default if there are no
+    sleepers.  A negative default means forever, as with epoll. """
+    if not _sleepers:
+        return default
+    wait = max(0.0, _sleepers[0][0] - time.time())
+    if default >= 0:
+        wait = min(wait, default)
+    return wait
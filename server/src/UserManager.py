@@ -1,29 +1,121 @@
+import zlib, itertools
 import stackless
 
-import Character
 import Messages
+import World
+import EntityStore
+import Timers
+import UserStore
+import Offload
+import Passwords
+import Admission
+import Zones
+
+class LoggedInUsers(object):
+    """ Logged in characters by username, and packed into a list in no
+    particular order so that going over them never meets anyone who has
+    left.  Removing swaps the last character into the hole. """
+    
+    def __init__(self):
+        self.byName = {}
+        self.characters = []
+    
+    def __len__(self):
+        return len(self.characters)
+    
+    def get(self, username, default=None):
+        return self.byName.get(username, default)
+    
+    def add(self, character):
+        character.sessionIndex = len(self.characters)
+        self.characters.append(character)
+        self.byName[character.username] = character
+    
+    def remove(self, username):
+        character = self.byName.pop(username, None)
+        if character is None:
+            return None
+        last = self.characters.pop()
+        if last is not character:
+            self.characters[character.sessionIndex] = last
+            last.sessionIndex = character.sessionIndex
+        character.sessionIndex = None
+        return character
 
 class UserManager(object):
-    def __init__(self, control):
-        # FIXME: registered user DB
-        self.userDB = {}
+    def __init__(self, control, sessions=None, store=None, flushInterval=1.0, entities=None):
+        # Registered users, kept in memory only unless we're given a store
+        if store is None:
+            store = UserStore.openStore("sqlite", ":memory:")
+        self.store = store
         
         # Logged in user list
-        self.users = {}
+        self.users = LoggedInUsers()
+        
+        # Usernames logged in on any worker process, when there are several
+        self.sessions = sessions
+        
+        # Limits how many logins are checked at once
+        self.admission = Admission.LoginAdmission()
+        
+        # Where logged in characters are in the world, which may be shared
+        # with other managers
+        if entities is None:
+            entities = EntityStore.EntityStore()
+        self.entities = entities
         
         # We have a special control channel through which user management occurs
         stackless.tasklet(self.handleControlMessage)(control)
+        
+        # Changed users are written back in batches, by the control tasklet
+        # so that the store only ever has one user
+        stackless.tasklet(self.requestFlushes)(control, flushInterval)
     
-    def login(self, username, password):
+    def findUser(self, username):
         # make sure we're not logged in already and then do basic existence check
-        if (not self.users.get(username, 0) and self.userDB.get(username, 0)):
+        character = None
+        if not self.users.get(username, 0):
+            character = self.store.get(username)
+        if not character:
+            print "Failed existence check"
+        return character
+    
+    def characters(self):
+        return self.users.characters
+    
+    def beginLogin(self, control, loginPayload):
+        # Start checking an admitted login, False if it is over already
+        username, password, manager, connection = loginPayload
+        if connection.closed:
+            return False
+        character = self.findUser(username)
+        if not character:
+            return False
+        stackless.tasklet(self.checkPassword)(control, character, password, loginPayload)
+        return True
+    
+    def endLogin(self, control):
+        # Let the next queued login go ahead
+        while 1:
+            admitted = self.admission.finished()
+            if admitted is None or self.beginLogin(control, admitted[1]):
+                break
+    
+    def login(self, character, passwordMatched):
+        # They may have logged in on another connection while the password
+        # was being checked
+        if not self.users.get(character.username, 0):
             # this is the authenticator/password check
-            if (self.userDB[username].password == password):
+            if passwordMatched:
+                # Another worker process may have them logged in
+                if self.sessions and not self.sessions.claim(character.username):
+                    print "Failed session check"
+                    return None
+                
                 print "Authentication successful"
-                character = self.userDB[username]
                 
                 # We are in!
-                self.users[username] = character
+                self.users.add(character)
                 
                 return character
             else:
@@ -32,6 +124,37 @@ class UserManager(object):
             print "Failed existence check"
             
         return None
+    
+    # Password hashing is slow, so it is done by tasklets of its own which
+    # wait on Offload and report back over the control channel.  The control
+    # tasklet carries on with other users meanwhile.  They always report
+    # back, even if the hashing failed (a malformed stored hash, a broken
+    # pool), as the login's admission slot is only given back then.
+    def checkPassword(self, control, character, password, loginPayload):
+        matched = False
+        rehashed = None
+        try:
+            matched = Offload.call(Passwords.checkPassword, password, character.account.password)
+            if matched and Passwords.needsRehash(character.account.password):
+                rehashed = Offload.call(Passwords.hashPassword, password)
+        except Exception, err:
+            print "Password check for %s failed: %s" % (character.username, err)
+            # Still in if the check itself went through
+            rehashed = None
+        control.send((Messages.CONTROL_PASSWORD_CHECKED, (character, matched, rehashed, loginPayload)))
+    
+    def hashPassword(self, control, username, password, email):
+        try:
+            hashed = Offload.call(Passwords.hashPassword, password)
+        except Exception, err:
+            print "Password hashing for %s failed: %s" % (username, err)
+            hashed = None
+        control.send((Messages.CONTROL_PASSWORD_HASHED, (username, hashed, email)))
+    
+    def requestFlushes(self, control, interval):
+        while 1:
+            Timers.sleep(interval)
+            control.send((Messages.CONTROL_FLUSH, None))
         
     def handleControlMessage(self, control):
         while 1:
@@ -41,31 +164,138 @@ class UserManager(object):
             if message == Messages.CONTROL_LOGIN:
                 # payload is username and password
                 # manager is used to send back the login result
-                username, password, manager = payload
+                username, password, manager, connection = payload
+            
+                status, position = self.admission.request(connection, payload)
+                if status == Admission.ADMITTED:
+                    if not self.beginLogin(control, payload):
+                        self.endLogin(control)
+                elif status == Admission.QUEUED:
+                    manager.send((Messages.MANAGER_QUEUED, position))
+                else:
+                    manager.send((Messages.MANAGER_REJECTED, Admission.RETRY_AFTER))
             
-                character = self.login(username, password)
+            elif message == Messages.CONTROL_PASSWORD_CHECKED:
+                character, matched, rehashed, (username, password, manager, connection) = payload
+                self.endLogin(control)
+                
+                # Nobody to log in if they have gone meanwhile
+                if connection.closed:
+                    character = None
+                else:
+                    character = self.login(character, matched)
                 if character:
-                    # Create a channel and tasklet which can handle networking
-                    # for this guy (i.e. allow the connection tasklet to delegate
-                    # most Messages to the character's networking tasklet)
-                    characterChannel = stackless.channel()
-                    stackless.tasklet(character.handleNetworkMessage)(characterChannel)
-
-                    # Give the Connection access to the network channel
-                    # so it can pass on Messages to the PlayerCharacter.
-                    manager.send((Messages.MANAGER_LOGGEDIN, (username, characterChannel)))
+                    if rehashed:
+                        character.account.password = rehashed
+                        self.store.save(character)
+                    
+                    character.entityId = self.entities.allocate(character.x, character.y, EntityStore.PLAYER, character)
+                    character.connection = connection
+                    
+                    # Give the Connection the character, its moves are
+                    # queued for the world loop to apply.
+                    manager.send((Messages.MANAGER_LOGGEDIN, (username, character)))
                     
                     print "Logged in"
                     
             elif message == Messages.CONTROL_REGISTER:
                 # payload is triple of registration data
                 username, password, email = payload
-                self.userDB[username] = Character.PlayerCharacter(username, password, email, 0)
-                print "Registered"
+                if self.store.get(username) is not None:
+                    # Not worth hashing the password for
+                    print "Username %s is taken" % username
+                else:
+                    stackless.tasklet(self.hashPassword)(control, username, password, email)
+            
+            elif message == Messages.CONTROL_PASSWORD_HASHED:
+                username, hashed, email = payload
+                if hashed is None:
+                    print "Registration of %s failed" % username
+                elif self.store.register(username, hashed, email):
+                    print "Registered"
+                else:
+                    print "Username %s is taken" % username
             
             elif message == Messages.CONTROL_DISCONNECT:
                 # Payload is username of the disconnected
                 # Just delete them from the logged in list
-                self.users[payload] = None
+                character = self.users.remove(payload)
+                if character:
+                    character.connection = None
+                    if character.zone is not None:
+                        # Another zone has them, and sends back where they
+                        # were to be saved again
+                        Zones.local.leave(character)
+                    else:
+                        # Remember where they were
+                        character.x, character.y = self.entities.position(character.entityId)
+                        self.entities.release(character.entityId)
+                        character.entityId = None
+                    self.store.save(character)
+                if self.sessions:
+                    # Written back before anybody else can log them in
+                    self.store.flush()
+                    self.sessions.release(payload)
+                
+                print "Logged out %s" % payload
+            
+            elif message == Messages.CONTROL_FLUSH:
+                self.store.flush()
                 
-                print "Logged out %s" % payload
\ No newline at end of file
+                # Once a second also tell queued logins where they are now
+                for connection, position in self.admission.queued():
+                    if not connection.closed:
+                        connection.manager.send((Messages.MANAGER_QUEUED, position))
+
+class UserShards(object):
+    """ Users split between several UserManagers by a hash of the username,
+    each with a control channel and tasklet of its own, so that a login
+    storm isn't handled one message at a time. """
+
+    def __init__(self, count=1, sessions=None, backend=None, cacheSize=10000, flushInterval=1.0):
+        # The shards share one backend, but each caches its own users.  Not
+        # so when other processes share it too (as sessions says they do),
+        # their changes would go unseen.
+        if sessions is not None:
+            cacheSize = 0
+        if backend is None:
+            backend = UserStore.SqliteBackend(":memory:")
+        self.backend = backend
+        
+        # Steps the world and keeps the clients up to date with the logged
+        # in characters
+        self.world = World.World(self)
+        
+        self.controls = []
+        self.shards = []
+        for i in range(count):
+            control = stackless.channel()
+            store = UserStore.UserStore(backend, cacheSize and max(1, cacheSize // count))
+            self.controls.append(control)
+            self.shards.append(UserManager(control, sessions, store, flushInterval, self.world.entities))
+    
+    def shard(self, username):
+        """ Index of the shard the user belongs to. """
+        return (zlib.crc32(username) & 0xFFFFFFFF) % len(self.controls)
+    
+    def control(self, username):
+        """ The control channel of the shard the user belongs to. """
+        return self.controls[self.shard(username)]
+    
+    def findCharacter(self, username):
+        """ The user's character if they are logged in, else None. """
+        return self.shards[self.shard(username)].users.get(username)
+    
+    def save(self, character):
+        self.shards[self.shard(character.username)].store.save(character)
+    
+    def characters(self):
+        if len(self.shards) == 1:
+            return self.shards[0].characters()
+        return list(itertools.chain(*[ shard.characters() for shard in self.shards ]))
+    
+    def close(self):
+        # Write back whatever hasn't been yet.
+        for shard in self.shards:
+            shard.store.flush()
+        self.backend.close()
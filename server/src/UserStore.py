@@ -0,0 +1,334 @@
+#
+# Registered user storage.
+#
+# UserStore keeps the characters of recently seen users in memory and loads
+# the rest from a backend on demand, so starting up never means reading
+# every account.  Changes are not written straight through: save() marks a
+# character dirty and flush() hands all the dirty records to the backend in
+# one batch.  UserManager calls flush() from its control tasklet every so
+# often (see Messages.CONTROL_FLUSH) and on the way out.  Registrations are
+# the exception, going straight to the backend, which turns away a username
+# that is already taken.
+#
+# When other processes share the backend they change records behind the
+# store's back, so such a store is given no cache and always loads users
+# afresh.
+#
+# Backends store records of (username, password, email, starter, x, y) and
+# provide load(username), insert(record), writeBatch(records) and close():
+#
+#   SqliteBackend  a single table in an SQLite database in WAL mode, the
+#                  default.  Several worker processes can share it.
+#
+#   LogBackend     an append-only log of records plus a compact index of
+#                  (username hash, log offset) pairs, sorted by hash and
+#                  searched in place through mmap.  Records appended since
+#                  the index was last written are found by scanning the end
+#                  of the log at start up.  For a single process only.
+#
+
+import os, mmap, struct, zlib, bisect, hashlib, sqlite3, collections
+
+import Character
+
+def characterRecord(character):
+    account = character.account
+    return (account.username, account.password, account.email,
+            account.starter, character.x, character.y)
+
+def recordCharacter(record):
+    username, password, email, starter, x, y = record
+    character = Character.PlayerCharacter(username, password, email, starter)
+    character.x = x
+    character.y = y
+    return character
+
+class SqliteBackend(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        # Readers don't block the writer and a commit is one append to the
+        # write-ahead log, only synced at checkpoints.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Other workers may be committing at the same moment.
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users ("
+                        "username TEXT PRIMARY KEY, password TEXT, email TEXT, "
+                        "starter INTEGER, x REAL, y REAL) WITHOUT ROWID")
+        self.db.commit()
+
+    def load(self, username):
+        return self.db.execute("SELECT username, password, email, starter, x, y "
+                               "FROM users WHERE username = ?", (username,)).fetchone()
+
+    def writeBatch(self, records):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)", records)
+
+    def insert(self, record):
+        """ Adds a new user's record, False if the username is taken. """
+        with self.db:
+            cursor = self.db.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?, ?)", record)
+        return cursor.rowcount == 1
+
+    def close(self):
+        self.db.close()
+
+class LogBackend(object):
+    # crc32 of the rest of the record, username, password and email lengths,
+    # starter, x, y; followed by the three strings.
+    RECORD = struct.Struct("!IHHHidd")
+    # magic, length of the log the index covers, entry count
+    INDEX_HEADER = struct.Struct("!8sQQ")
+    INDEX_ENTRY = struct.Struct("!QQ")
+    INDEX_MAGIC = "NXUSIDX1"
+
+    def __init__(self, path, compactAfter=65536, sync=True):
+        self.path = path
+        self.indexPath = path + ".idx"
+        # Rewrite the index once this many records have been appended since.
+        self.compactAfter = compactAfter
+        self.sync = sync
+
+        self.log = open(path, "a+b")
+        self.indexMap = None
+        self.indexCount = 0
+        # username -> offset of records newer than the index
+        self.recent = {}
+
+        indexed = self.openIndex()
+        self.scanLog(indexed)
+
+    def keyOf(self, username):
+        return struct.unpack("!Q", hashlib.md5(username).digest()[:8])[0]
+
+    def openIndex(self):
+        """ Map the index, returning how much of the log it covers. """
+        try:
+            indexFile = open(self.indexPath, "rb")
+        except IOError:
+            return 0
+        try:
+            header = indexFile.read(self.INDEX_HEADER.size)
+            if len(header) < self.INDEX_HEADER.size:
+                return 0
+            magic, indexed, count = self.INDEX_HEADER.unpack(header)
+            if magic != self.INDEX_MAGIC or not count:
+                return 0
+            self.indexMap = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+            self.indexCount = count
+            return indexed
+        finally:
+            indexFile.close()
+
+    def scanLog(self, offset):
+        self.log.seek(0, os.SEEK_END)
+        end = self.log.tell()
+        if offset > end:
+            # The log is not the one the index was written for.
+            self.dropIndex()
+            offset = 0
+        while offset < end:
+            record = self.readRecord(offset)
+            if record is None:
+                # A write cut short by a crash, nobody was told it was saved.
+                self.log.truncate(offset)
+                break
+            self.recent[record[0]] = offset
+            offset = self.log.tell()
+
+    def readRecord(self, offset):
+        self.log.seek(offset)
+        header = self.log.read(self.RECORD.size)
+        if len(header) < self.RECORD.size:
+            return None
+        crc, usernameLength, passwordLength, emailLength, starter, x, y = self.RECORD.unpack(header)
+        strings = self.log.read(usernameLength + passwordLength + emailLength)
+        if len(strings) < usernameLength + passwordLength + emailLength:
+            return None
+        if zlib.crc32(header[4:] + strings) & 0xFFFFFFFF != crc:
+            return None
+        username = strings[:usernameLength]
+        password = strings[usernameLength:usernameLength + passwordLength]
+        email = strings[usernameLength + passwordLength:]
+        return username, password, email, starter, x, y
+
+    def encodeRecord(self, record):
+        username, password, email, starter, x, y = record
+        body = self.RECORD.pack(0, len(username), len(password), len(email), starter, x, y)[4:] + username + password + email
+        return struct.pack("!I", zlib.crc32(body) & 0xFFFFFFFF) + body
+
+    def indexEntry(self, position):
+        return self.INDEX_ENTRY.unpack_from(self.indexMap, self.INDEX_HEADER.size + position * self.INDEX_ENTRY.size)
+
+    def indexLookup(self, username):
+        """ Offsets of the indexed records whose username hashes the same,
+        newest first. """
+        if self.indexMap is None:
+            return []
+        key = self.keyOf(username)
+        low, high = 0, self.indexCount
+        while low < high:
+            middle = (low + high) // 2
+            if self.indexEntry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        offsets = []
+        while low < self.indexCount:
+            entryKey, offset = self.indexEntry(low)
+            if entryKey != key:
+                break
+            offsets.append(offset)
+            low += 1
+        offsets.reverse()
+        return offsets
+
+    def load(self, username):
+        offset = self.recent.get(username)
+        if offset is not None:
+            return self.readRecord(offset)
+        for offset in self.indexLookup(username):
+            record = self.readRecord(offset)
+            if record is not None and record[0] == username:
+                return record
+        return None
+
+    def insert(self, record):
+        if self.load(record[0]) is not None:
+            return False
+        self.writeBatch([ record ])
+        return True
+
+    def writeBatch(self, records):
+        self.log.seek(0, os.SEEK_END)
+        offset = self.log.tell()
+        data = []
+        for record in records:
+            encoded = self.encodeRecord(record)
+            data.append(encoded)
+            self.recent[record[0]] = offset
+            offset += len(encoded)
+        self.log.write("".join(data))
+        self.log.flush()
+        if self.sync:
+            os.fsync(self.log.fileno())
+        if len(self.recent) >= self.compactAfter:
+            self.compact()
+
+    def compact(self):
+        """ Fold the recent records into a new index. """
+        if not self.recent:
+            return
+        keys = offsets = ()
+        if self.indexCount:
+            values = struct.unpack_from("!%dQ" % (self.indexCount * 2), self.indexMap, self.INDEX_HEADER.size)
+            keys = values[0::2]
+            offsets = values[1::2]
+
+        superseded = set()
+        entries = []
+        for username, offset in self.recent.iteritems():
+            key = self.keyOf(username)
+            # Drop the older record of the same user, but keep any record
+            # of another user which merely hashes the same.
+            position = bisect.bisect_left(keys, key)
+            while position < len(keys) and keys[position] == key:
+                if self.readRecord(offsets[position])[0] == username:
+                    superseded.add(offsets[position])
+                position += 1
+            entries.append((key, offset))
+        entries.extend([ entry for entry in zip(keys, offsets) if entry[1] not in superseded ])
+        entries.sort()
+
+        self.log.seek(0, os.SEEK_END)
+        indexed = self.log.tell()
+        temporaryPath = self.indexPath + ".new"
+        indexFile = open(temporaryPath, "wb")
+        try:
+            indexFile.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, indexed, len(entries)))
+            indexFile.write(struct.pack("!%dQ" % (len(entries) * 2), *[ value for entry in entries for value in entry ]))
+            indexFile.flush()
+            os.fsync(indexFile.fileno())
+        finally:
+            indexFile.close()
+        os.rename(temporaryPath, self.indexPath)
+
+        self.dropIndex()
+        self.recent = {}
+        self.openIndex()
+
+    def dropIndex(self):
+        if self.indexMap is not None:
+            self.indexMap.close()
+        self.indexMap = None
+        self.indexCount = 0
+
+    def close(self):
+        self.compact()
+        self.dropIndex()
+        self.log.close()
+
+BACKENDS = {
+    "sqlite": SqliteBackend,
+    "log": LogBackend,
+}
+
+class UserStore(object):
+    def __init__(self, backend, cacheSize=10000):
+        self.backend = backend
+        self.cacheSize = cacheSize
+        # username -> PlayerCharacter, least recently used first
+        self.cache = collections.OrderedDict()
+        # username -> PlayerCharacter changed since the last flush
+        self.dirty = {}
+
+    def get(self, username):
+        """ The registered user's character, or None. """
+        character = self.cache.pop(username, None)
+        if character is None:
+            character = self.dirty.get(username)
+            if character is None:
+                record = self.backend.load(username)
+                if record is None:
+                    return None
+                character = recordCharacter(record)
+        self.cache[username] = character
+        self.evict()
+        return character
+
+    def register(self, username, password, email):
+        """ The new user's character, or None if the username is taken. """
+        if username in self.cache or username in self.dirty:
+            return None
+        character = Character.PlayerCharacter(username, password, email, 0)
+        if not self.backend.insert(characterRecord(character)):
+            return None
+        self.cache[username] = character
+        self.evict()
+        return character
+
+    def save(self, character):
+        self.dirty[character.username] = character
+
+    def evict(self):
+        # Dirty characters stay reachable through self.dirty until flushed.
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(False)
+
+    def flush(self):
+        if not self.dirty:
+            return 0
+        records = [ characterRecord(character) for character in self.dirty.itervalues() ]
+        self.backend.writeBatch(records)
+        self.dirty = {}
+        return len(records)
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+def openStore(kind, path, cacheSize=10000):
+    return UserStore(BACKENDS[kind](path), cacheSize)
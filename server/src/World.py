@@ -0,0 +1,239 @@
+#
+# The world loop.
+#
+# One tasklet steps the world at a fixed rate.  Input arriving between
+# ticks is only queued, with each character's latest move replacing any
+# earlier one not yet applied.  Each tick then applies the queued moves,
+# moves everything along its velocity, brings the spatial grid up to date,
+# runs every system added with addSystem() once, and finally sends the
+# clients their snapshot (see Snapshot.Replicator), all in one pass.
+#
+# Ticks are scheduled against the time the loop started rather than the
+# end of the previous tick, so the rate doesn't drift.  A tick that takes
+# longer than the interval, or starts late, is counted as an overrun, and
+# the ticks missed meanwhile are skipped rather than run back to back.  A
+# late tick still lets every other runnable tasklet have its turn first, so
+# the sockets keep being served while the world is falling behind.
+#
+# The rate is TICK_RATE ticks a second unless a World is given its own.
+#
+# With a baked Terrain (TERRAIN, or given to the World) the queued moves are
+# checked against it as one batch before they are applied, and those going
+# further than MAX_SPEED allows, across unwalkable ground or up or down too
+# steep a step are dropped.  The character stays where it was and the next
+# snapshot puts its client right.
+#
+# The world's NPCs are a Crowd, stepped as the first system; NPCS of them
+# are spawned when the world is created, within BOUNDS if this world is
+# only part of a bigger one.  Given a terrain the world also has a
+# Pathfinder, and sends the NPCs on Errands around it, the system after the
+# crowd.
+#
+# When the world is split into zones (see Zones), moves and chat from
+# characters simulated by another zone are passed on to it, and the zone
+# process's visitors are replicated to along with its own characters.
+#
+
+import time
+import numpy
+import stackless
+
+import Timers
+import Snapshot
+import EntityStore
+import SpatialGrid
+import Crowd
+import Pathfinding
+import Errands
+import Packets
+import Broadcast
+
+TICK_RATE = 20
+# Terrain.Terrain moves are checked against, None to allow any move
+TERRAIN = None
+# NPCs to start the world with
+NPCS = 0
+# Furthest a character may move in a second, checked along with the terrain.
+# The client runs at 5 units a second, but its moves can arrive bunched up.
+MAX_SPEED = 20.0
+# minX, minY, maxX, maxY of the part of the world NPCs are kept within,
+# None for all of it
+BOUNDS = None
+
+# How far away Say is heard, in world units.
+CHAT_RADIUS = 128.0
+
+class World(object):
+    def __init__(self, users, rate=None, terrain=None):
+        if rate is None:
+            rate = TICK_RATE
+        if terrain is None:
+            terrain = TERRAIN
+        self.users = users
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self.terrain = terrain
+
+        # character -> (x, y) of its latest move since the last tick
+        self.moves = {}
+        # Callables stepped with the tick interval every tick, in order
+        self.systems = []
+
+        # The position and motion of everything in the world
+        self.entities = EntityStore.EntityStore()
+        # Where they are, for finding what is near what
+        self.grid = SpatialGrid.SpatialGrid(self.entities)
+
+        self.paths = None
+        self.errands = None
+        self.crowd = Crowd.Crowd(self.entities, terrain, bounds=BOUNDS)
+        self.addSystem(self.crowd.tick)
+        if terrain is not None:
+            self.paths = Pathfinding.Pathfinder(terrain)
+            self.errands = Errands.Errands(self.crowd, self.entities, self.paths)
+            self.addSystem(self.errands.tick)
+        if NPCS:
+            self.crowd.spawn(NPCS)
+
+        # The Zones.ZoneNode, if the world is split into zones
+        self.zones = None
+
+        self.replicator = Snapshot.Replicator(self, self.entities, self.grid)
+
+        # Moves the terrain turned down
+        self.rejected = 0
+
+        # Frame budget accounting
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self.worst = 0.0
+
+        stackless.tasklet(self.run)()
+
+    def addSystem(self, system):
+        self.systems.append(system)
+
+    def characters(self):
+        """ The characters simulated here which have a client to keep up
+        to date. """
+        characters = self.users.characters()
+        if self.zones is None:
+            return characters
+        return [ character for character in characters if character.zone is None ] + self.zones.characters()
+
+    def queueMove(self, character, x, y):
+        if character.zone is not None:
+            self.zones.move(character, x, y)
+            return
+        self.moves[character] = (x, y)
+
+    def say(self, character, text):
+        """ Heard by everyone near enough, the character included. """
+        if character.zone is not None:
+            self.zones.say(character, text)
+            return
+        x, y = self.entities.position(character.entityId)
+        frame = Packets.BY_NAME["Chat"].encode(character.entityId, text)
+        Broadcast.send(frame, self.connectionsNear(x, y, CHAT_RADIUS))
+
+    def acknowledge(self, character, sequence):
+        """ The client has the snapshot sequence. """
+        if character.zone is not None:
+            self.zones.acknowledge(character, sequence)
+        elif sequence in self.replicator.history:
+            # Not one from another zone it was in
+            character.connection.baseline.acknowledge(sequence)
+
+    def connectionsNear(self, x, y, radius):
+        """ Connections of the characters within radius of (x, y). """
+        owners = self.entities.owners
+        connections = []
+        for entityId in self.grid.queryRadius(x, y, radius):
+            connection = getattr(owners[entityId], "connection", None)
+            if connection is not None:
+                connections.append(connection)
+        return connections
+
+    def run(self):
+        nextTick = time.time()
+        while 1:
+            nextTick += self.interval
+            wait = nextTick - time.time()
+            late = wait <= 0
+            if not late:
+                Timers.sleep(wait)
+            else:
+                if wait < -self.interval:
+                    # Too far behind to catch up, start afresh from now.
+                    skipped = int(-wait / self.interval)
+                    self.skipped += skipped
+                    nextTick += skipped * self.interval
+                stackless.schedule()
+
+            started = time.time()
+            self.tick()
+            took = time.time() - started
+
+            self.ticks += 1
+            self.busy += took
+            if took > self.worst:
+                self.worst = took
+            if late or took > self.interval:
+                self.overruns += 1
+
+    def applyMoves(self, moves):
+        place = self.entities.place
+        for character, (x, y) in moves.iteritems():
+            # Ignore anyone who logged out since
+            if character.entityId is not None:
+                place(character.entityId, x, y)
+
+    def applyCheckedMoves(self, moves):
+        ids = []
+        targets = []
+        for character, target in moves.iteritems():
+            if character.entityId is not None:
+                ids.append(character.entityId)
+                targets.append(target)
+        if not ids:
+            return
+        ids = numpy.array(ids, numpy.intp)
+        targets = numpy.array(targets, numpy.float64)
+        toX = targets[:, 0]
+        toY = targets[:, 1]
+
+        entities = self.entities
+        # Moves come in whole units, allow for the rounding
+        maxDistance = MAX_SPEED * self.interval + 2.0
+        allowed = self.terrain.validateMoves(entities.x[ids], entities.y[ids], toX, toY, maxDistance)
+        self.rejected += len(ids) - int(numpy.count_nonzero(allowed))
+        ids = ids[allowed]
+        entities.x[ids] = toX[allowed]
+        entities.y[ids] = toY[allowed]
+
+    def tick(self):
+        # Apply the moves, only the latest for each character counts
+        moves, self.moves = self.moves, {}
+        if self.terrain is None:
+            self.applyMoves(moves)
+        else:
+            self.applyCheckedMoves(moves)
+
+        # Move everything along, all at once
+        self.entities.integrate(self.interval)
+        self.grid.sync()
+
+        for system in self.systems:
+            system(self.interval)
+
+        self.replicator.tick()
+
+    def stats(self):
+        """ Ticks run, overruns, ticks skipped, and the mean and worst tick
+        time in seconds. """
+        mean = 0.0
+        if self.ticks:
+            mean = self.busy / self.ticks
+        return self.ticks, self.overruns, self.skipped, mean, self.worst
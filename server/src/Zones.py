@@ -0,0 +1,394 @@
+#
+# The world split into zones, each simulated by its own process.
+#
+# The map is cut into strips across x, one per zone process.  Every zone
+# process is also a server in its own right: clients connect to whichever
+# the kernel hands them to (SO_REUSEPORT, as with workers), which is their
+# gateway from then on, holding their Connection and logged in character.
+# A character is simulated by the zone it stands in though, which may not
+# be its gateway.  The processes are linked to each other by Unix stream
+# sockets, created before forking, carrying framed messages (Messages
+# ZONE_*):
+#
+#   ENTER      a character arriving in a zone: username, gateway, position
+#              and velocity.  Sent by the zone it is leaving.
+#   ROUTE      to a gateway, the zone now simulating one of its characters.
+#   MOVE, SAY, SNAPSHOT_ACK
+#              from a gateway, what a client sent for a character
+#              simulated elsewhere.
+#   DELIVER    to a gateway, output for one of its clients (snapshots and
+#              chat), written to the client as is.
+#   LEAVE      from a gateway, a character logging out.  Answered with
+#   LEFT       the character's final position, for saving.
+#   GHOSTS     the entities within MARGIN of the border, sent to the zone
+#              on the other side every tick.
+#
+# Each tick (as a World system) a zone hands off every character which has
+# gone more than HYSTERESIS past its strip to the zone it is now in, and
+# releases its entity.  Characters from other gateways are Visitors here,
+# their output going back through DELIVER.  Messages which get to a zone
+# after the character has moved on are dropped; moves are superseded by the
+# next anyway.  A client which changes zones has its snapshot baseline
+# reset, and gets everything afresh from the new zone, whose snapshot
+# sequence numbers never overlap with another zone's.
+#
+# Ghosts are entities flagged EntityStore.GHOST, placed where the zone
+# owning them last said they were.  They are replicated to clients and found
+# by spatial queries like anything else, but not simulated or handed off.
+#
+# NPCs stay within the zone they were spawned in (see World.BOUNDS).
+#
+# Output to other zones is buffered and sent once a tick.
+#
+# Handoff of connections themselves, i.e. passing the client's socket to
+# the zone process, is not done: the gateway stays in the path.
+#
+
+import struct, bisect, collections
+import numpy
+import stackless
+
+import Messages
+import Framing
+import Snapshot
+import EntityStore
+
+# How far past the edge of its strip a character goes before it is handed
+# off, so that walking along a border doesn't hand it back and forth.
+HYSTERESIS = 8.0
+# How far from a border entities are ghosted to the zone beyond it
+MARGIN = 64.0
+
+# Snapshot sequence numbers of each zone start this far apart
+SEQUENCE_SPAN = 1 << 24
+
+ENTER = struct.Struct("!32pHdddd")
+USERNAME = struct.Struct("!32p")
+ROUTE = struct.Struct("!32pH")
+MOVE = struct.Struct("!32pii")
+SAY = struct.Struct("!32p128p")
+SNAPSHOT_ACK = struct.Struct("!32pI")
+LEFT = struct.Struct("!32pdd")
+GHOSTS = struct.Struct("!BH")
+GHOST = numpy.dtype([ ("id", ">u4"), ("x", ">f4"), ("y", ">f4") ])
+
+# Most ghosts and delivered bytes in one frame
+GHOSTS_PER_FRAME = (Framing.MAX_PAYLOAD - GHOSTS.size) // GHOST.itemsize
+DELIVER_PER_FRAME = Framing.MAX_PAYLOAD - USERNAME.size
+
+# The ZoneNode of this process, if the world is split into zones
+local = None
+
+def install(world, zone, zoneMap, sockets):
+    global local
+    local = ZoneNode(world, zone, zoneMap, sockets)
+    return local
+
+class ZoneMap(object):
+    """ Which zone each part of the world belongs to. """
+
+    def __init__(self, count, bounds=(-4096.0, -4096.0, 4096.0, 4096.0)):
+        self.count = count
+        self.bounds = bounds
+        minX, minY, maxX, maxY = bounds
+        self.edges = [ minX + (maxX - minX) * i / count for i in xrange(count + 1) ]
+        # Where one zone ends and the next starts
+        self.borders = self.edges[1:-1]
+
+    def zoneOf(self, x):
+        return bisect.bisect_right(self.borders, x)
+
+    def zonesOf(self, x):
+        return numpy.searchsorted(self.borders, x, "right")
+
+    def strip(self, zone):
+        """ The bounds of a zone. """
+        minX, minY, maxX, maxY = self.bounds
+        return (self.edges[zone], minY, self.edges[zone + 1], maxY)
+
+class ZoneLink(object):
+    """ The socket to another zone process. """
+
+    def __init__(self, node, zone, sock):
+        self.node = node
+        self.zone = zone
+        self.sock = sock
+        self.outbound = []
+        stackless.tasklet(self.receive)()
+
+    def send(self, opcode, payload):
+        self.outbound.append(Framing.encodeFrame(opcode, payload))
+
+    def flush(self):
+        if self.outbound:
+            data = ''.join(self.outbound)
+            self.outbound = []
+            # Queued for the socket manager to write, without waiting for
+            # it to go as sendall() would
+            self.sock.send(data)
+
+    def receive(self):
+        decoder = Framing.FrameDecoder()
+        while 1:
+            data = self.sock.recv(65536)
+            if data == '':
+                break
+            for opcode, payload in decoder.feed(data):
+                self.node.handle(self.zone, opcode, payload)
+        print "Lost the link to zone %d" % self.zone
+
+class RemoteConnection(object):
+    """ Stands in for the Connection of a visiting character, passing its
+    output on to the gateway. """
+
+    def __init__(self, link, username):
+        self.link = link
+        self.username = username
+        self.baseline = Snapshot.ClientBaseline()
+        self.closed = False
+
+    def write(self, data):
+        prefix = USERNAME.pack(self.username)
+        for start in xrange(0, len(data), DELIVER_PER_FRAME):
+            self.link.send(Messages.ZONE_DELIVER, prefix + data[start:start + DELIVER_PER_FRAME])
+
+class Visitor(object):
+    """ A character simulated here for another zone's gateway. """
+    __slots__ = ("username", "gateway", "entityId", "connection", "zone")
+
+    def __init__(self, username, gateway, connection):
+        self.username = username
+        self.gateway = gateway
+        self.entityId = None
+        self.connection = connection
+        # Always simulated here, see PlayerCharacter.zone
+        self.zone = None
+
+class ZoneNode(object):
+    def __init__(self, world, zone, zoneMap, sockets):
+        """ sockets maps every other zone to the socket linked to it. """
+        self.world = world
+        self.entities = world.entities
+        self.zone = zone
+        self.map = zoneMap
+        minX, minY, maxX, maxY = zoneMap.strip(zone)
+        self.minX = minX
+        self.maxX = maxX
+        self.links = dict([ (other, ZoneLink(self, other, sock)) for other, sock in sockets.items() ])
+
+        # username -> Visitor
+        self.visitors = {}
+        # Characters of ours gone from the gateway, their LEFT not yet in
+        self.leaving = {}
+        # zone -> {their entity id: our ghost's entity id}
+        self.ghosts = collections.defaultdict(dict)
+        # zone -> GHOSTS entries received so far this tick
+        self.incoming = collections.defaultdict(list)
+
+        self.handoffs = 0
+
+        world.replicator.history.sequence = zone * SEQUENCE_SPAN
+        world.zones = self
+        world.addSystem(self.tick)
+
+        self.handlers = {
+            Messages.ZONE_ENTER: self.zoneEnter,
+            Messages.ZONE_ROUTE: self.zoneRoute,
+            Messages.ZONE_MOVE: self.zoneMove,
+            Messages.ZONE_SAY: self.zoneSay,
+            Messages.ZONE_SNAPSHOT_ACK: self.zoneSnapshotAck,
+            Messages.ZONE_DELIVER: self.zoneDeliver,
+            Messages.ZONE_LEAVE: self.zoneLeave,
+            Messages.ZONE_LEFT: self.zoneLeft,
+            Messages.ZONE_GHOSTS: self.zoneGhosts,
+        }
+
+    def characters(self):
+        return self.visitors.values()
+
+    # For the gateway, about its characters simulated elsewhere
+
+    def move(self, character, x, y):
+        self.links[character.zone].send(Messages.ZONE_MOVE, MOVE.pack(character.username, x, y))
+
+    def say(self, character, text):
+        self.links[character.zone].send(Messages.ZONE_SAY, SAY.pack(character.username, text))
+
+    def acknowledge(self, character, sequence):
+        self.links[character.zone].send(Messages.ZONE_SNAPSHOT_ACK, SNAPSHOT_ACK.pack(character.username, sequence))
+
+    def leave(self, character):
+        self.leaving[character.username] = character
+        self.links[character.zone].send(Messages.ZONE_LEAVE, USERNAME.pack(character.username))
+        character.zone = None
+
+    # Each tick
+
+    def tick(self, interval):
+        entities = self.entities
+        end = entities.end
+        flags = entities.flags[:end]
+        players = numpy.flatnonzero(((flags & EntityStore.PLAYER) != 0) & ((flags & EntityStore.GHOST) == 0))
+        x = entities.x[players]
+        gone = players[(x < self.minX - HYSTERESIS) | (x > self.maxX + HYSTERESIS)]
+        for entityId in gone.tolist():
+            self.handOff(entityId)
+
+        self.sendGhosts()
+        for link in self.links.itervalues():
+            link.flush()
+
+    def handOff(self, entityId):
+        entities = self.entities
+        owner = entities.owners[entityId]
+        x, y = entities.position(entityId)
+        vx = float(entities.vx[entityId])
+        vy = float(entities.vy[entityId])
+        zone = self.map.zoneOf(x)
+        if isinstance(owner, Visitor):
+            gateway = owner.gateway
+            del self.visitors[owner.username]
+        else:
+            gateway = self.zone
+            owner.zone = zone
+        entities.release(entityId)
+        owner.entityId = None
+        self.links[zone].send(Messages.ZONE_ENTER, ENTER.pack(owner.username, gateway, x, y, vx, vy))
+        self.handoffs += 1
+
+    def sendGhosts(self):
+        entities = self.entities
+        end = entities.end
+        flags = entities.flags[:end]
+        ours = numpy.flatnonzero(((flags & EntityStore.ALIVE) != 0) & ((flags & EntityStore.GHOST) == 0))
+        x = entities.x[ours]
+        for zone, near in ((self.zone - 1, x < self.minX + MARGIN), (self.zone + 1, x > self.maxX - MARGIN)):
+            if zone not in self.links:
+                continue
+            ids = ours[near]
+            ghosts = numpy.empty(len(ids), GHOST)
+            ghosts["id"] = ids
+            ghosts["x"] = entities.x[ids]
+            ghosts["y"] = entities.y[ids]
+            data = ghosts.tostring()
+            link = self.links[zone]
+            size = GHOSTS_PER_FRAME * GHOST.itemsize
+            # Always at least one frame, the last flagged, so that the
+            # other side knows the set is complete even when it's empty
+            starts = range(0, len(data), size) or [ 0 ]
+            for start in starts:
+                final = start == starts[-1]
+                count = len(data[start:start + size]) // GHOST.itemsize
+                link.send(Messages.ZONE_GHOSTS, GHOSTS.pack(final, count) + data[start:start + size])
+
+    # Messages from other zones
+
+    def handle(self, zone, opcode, payload):
+        handler = self.handlers.get(opcode)
+        if handler is None:
+            print "Unhandled zone message %d from zone %d" % (opcode, zone)
+            return
+        handler(zone, payload)
+
+    def findCharacter(self, username):
+        return self.world.users.findCharacter(username)
+
+    def zoneEnter(self, zone, payload):
+        username, gateway, x, y, vx, vy = ENTER.unpack_from(payload)
+        entities = self.entities
+        if gateway == self.zone:
+            owner = self.findCharacter(username)
+            if owner is None:
+                # Logged out on the way, this is where they ended up
+                self.saveLeft(username, x, y)
+                return
+            owner.zone = None
+            # Its snapshots come from here again, start them afresh
+            owner.connection.baseline = Snapshot.ClientBaseline()
+        else:
+            link = self.links[gateway]
+            owner = Visitor(username, gateway, RemoteConnection(link, username))
+            self.visitors[username] = owner
+            link.send(Messages.ZONE_ROUTE, ROUTE.pack(username, self.zone))
+        owner.entityId = entities.allocate(x, y, EntityStore.PLAYER, owner)
+        entities.setVelocity(owner.entityId, vx, vy)
+
+    def zoneRoute(self, zone, payload):
+        username, simulatedBy = ROUTE.unpack_from(payload)
+        character = self.findCharacter(username)
+        if character is None:
+            # Logged out on the way, so the LEAVE went to the wrong zone
+            if username in self.leaving:
+                self.links[simulatedBy].send(Messages.ZONE_LEAVE, USERNAME.pack(username))
+            return
+        character.zone = simulatedBy
+
+    def zoneMove(self, zone, payload):
+        username, x, y = MOVE.unpack_from(payload)
+        visitor = self.visitors.get(username)
+        if visitor is not None:
+            self.world.queueMove(visitor, x, y)
+
+    def zoneSay(self, zone, payload):
+        username, text = SAY.unpack_from(payload)
+        visitor = self.visitors.get(username)
+        if visitor is not None:
+            self.world.say(visitor, text)
+
+    def zoneSnapshotAck(self, zone, payload):
+        username, sequence = SNAPSHOT_ACK.unpack_from(payload)
+        visitor = self.visitors.get(username)
+        # Only our own snapshots, not ones from before it came here
+        if visitor is not None and sequence in self.world.replicator.history:
+            visitor.connection.baseline.acknowledge(sequence)
+
+    def zoneDeliver(self, zone, payload):
+        username, = USERNAME.unpack_from(payload)
+        character = self.findCharacter(username)
+        if character is not None and character.connection is not None:
+            character.connection.write(payload[USERNAME.size:].tobytes())
+
+    def zoneLeave(self, zone, payload):
+        username, = USERNAME.unpack_from(payload)
+        visitor = self.visitors.pop(username, None)
+        if visitor is None:
+            return
+        x, y = self.entities.position(visitor.entityId)
+        self.entities.release(visitor.entityId)
+        visitor.connection.closed = True
+        self.links[zone].send(Messages.ZONE_LEFT, LEFT.pack(username, x, y))
+
+    def zoneLeft(self, zone, payload):
+        username, x, y = LEFT.unpack_from(payload)
+        self.saveLeft(username, x, y)
+
+    def saveLeft(self, username, x, y):
+        character = self.leaving.pop(username, None)
+        if character is not None:
+            character.x = x
+            character.y = y
+            self.world.users.save(character)
+
+    def zoneGhosts(self, zone, payload):
+        final, count = GHOSTS.unpack_from(payload)
+        incoming = self.incoming[zone]
+        incoming.append(numpy.frombuffer(payload[GHOSTS.size:].tobytes(), GHOST, count))
+        if not final:
+            return
+        ghosts = numpy.concatenate(incoming)
+        del self.incoming[zone]
+
+        entities = self.entities
+        known = self.ghosts[zone]
+        current = {}
+        for theirs, x, y in zip(ghosts["id"].tolist(), ghosts["x"].tolist(), ghosts["y"].tolist()):
+            ours = known.pop(theirs, None)
+            if ours is None:
+                ours = entities.allocate(x, y, EntityStore.GHOST)
+            else:
+                entities.place(ours, x, y)
+            current[theirs] = ours
+        # Whatever wasn't in this lot has gone from near the border
+        for ours in known.itervalues():
+            entities.release(ours)
+        self.ghosts[zone] = current